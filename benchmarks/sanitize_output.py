@@ -0,0 +1,77 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+Micro-benchmark of sanitization of agent output.
+
+Run from the top directory: python3 -m benchmarks.sanitize_output
+"""
+
+import timeit
+
+from vmupdate.agent.source.common.process_result import ProcessResult
+
+LINE = (
+    b"  Upgrading        : python3-libs-3.12.4-1.fc40.x86_64"
+    b"                       123/456 \n"
+)
+# control characters and non-ASCII bytes mixed into the text
+MIXED_LINE = bytes(
+    byte if i % 7 else (i * 37) % 256 for i, byte in enumerate(LINE)
+)
+
+
+def reference_sanitize_output(untrusted_bytes, single=False):
+    """
+    The original implementation of `ProcessResult.sanitize_output`.
+    """
+    untrusted_str = untrusted_bytes.decode("ascii", errors="ignore")
+    return "".join(
+        [
+            c
+            for c in untrusted_str
+            if 0x20 <= ord(c) <= 0x7E or (c == "\n" and not single)
+        ]
+    )
+
+
+def main() -> None:
+    cases = {
+        "line": (LINE, True, 100_000),
+        "mixed line": (MIXED_LINE, True, 100_000),
+        "output 1 MiB": (LINE * (2**20 // len(LINE)), False, 10),
+    }
+    for name, (untrusted_bytes, single, number) in cases.items():
+        for impl_name, impl in (
+            ("reference", reference_sanitize_output),
+            ("translate", ProcessResult.sanitize_output),
+        ):
+            seconds = timeit.timeit(
+                lambda: impl(untrusted_bytes, single), number=number
+            )
+            print(
+                f"{name:>14} {impl_name:>10}: "
+                f"{seconds / number * 1e6:10.2f} us per call"
+            )
+
+
+if __name__ == "__main__":
+    main()
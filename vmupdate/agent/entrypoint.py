@@ -9,9 +9,11 @@ from typing import Any
 from source import plugins
 from source.args import AgentArgs
 from source.utils import get_os_data
-from source.log_config import init_logs
+from source.log_config import init_logs, LOGPATH, TRACE_FILE
 from source.common.exit_codes import EXIT
 from source.common.package_manager import AgentType
+from source.common.progress_reporter import Progress
+from source.common.tracing import TRACER
 
 
 def main(args: list[str] | None = None) -> int:
@@ -20,8 +22,36 @@ def main(args: list[str] | None = None) -> int:
     """
     parsed_args = parse_args(args)
     log, log_handler, log_level, _log_path, _log_formatter = init_logs(
-        level=parsed_args.log, truncate_file=True
+        level=parsed_args.log,
+        truncate_file=True,
+        stream_prefix=parsed_args.log_stream,
     )
+    trace_path = os.path.join(LOGPATH, TRACE_FILE)
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    TRACER.enabled = parsed_args.trace
+    Progress.MIN_INTERVAL = parsed_args.progress_interval
+    Progress.MIN_DELTA = parsed_args.progress_delta
+    try:
+        with TRACER.span("agent"):
+            return run(parsed_args, log, log_handler, log_level)
+    finally:
+        if TRACER.enabled:
+            try:
+                TRACER.dump(trace_path)
+            except OSError as err:
+                log.warning("Cannot write trace: %s", str(err))
+
+
+def run(
+    parsed_args: argparse.Namespace,
+    log: Logger,
+    log_handler: Handler,
+    log_level: str,
+) -> int:
+    """
+    Upgrade packages and clean up.
+    """
     log.debug("Run entrypoint with args: %s", str(parsed_args))
     os_data = get_os_data()
 
@@ -39,6 +69,9 @@ def main(args: list[str] | None = None) -> int:
         agent_type,
         parsed_args.no_progress,
     )
+    pkg_mng.refresh_policy = parsed_args.refresh_policy
+    pkg_mng.threads = parsed_args.threads
+    pkg_mng.install = not parsed_args.no_install
 
     log.debug("Running upgrades.")
     return_code = pkg_mng.upgrade(
@@ -55,12 +88,14 @@ def main(args: list[str] | None = None) -> int:
         else:
             print(f"{100:.2f}", flush=True, file=sys.stderr)
 
-    if agent_type is AgentType.VM:
+    if agent_type is AgentType.VM and pkg_mng.install:
         log.debug("Notify dom0 about upgrades.")
         os.system("/usr/lib/qubes/upgrades-status-notify")
 
-    if not parsed_args.no_cleanup:
-        return_code = max(pkg_mng.clean(), return_code)
+    # downloaded packages are kept for the next update
+    if not parsed_args.no_cleanup and pkg_mng.install:
+        with TRACER.span("clean"):
+            return_code = max(pkg_mng.clean(), return_code)
 
     if return_code not in EXIT.VM_HANDLED:
         return_code = EXIT.ERR_VM_UNHANDLED
@@ -70,6 +105,11 @@ def main(args: list[str] | None = None) -> int:
 def parse_args(args: list[str] | None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     AgentArgs.add_arguments(parser)
+    # log records are also printed to stdout with the given prefix,
+    # used by dom0 to collect them during the update
+    parser.add_argument(
+        "--log-stream", metavar="PREFIX", help=argparse.SUPPRESS
+    )
     parsed_args = parser.parse_args(args)
     return parsed_args
 
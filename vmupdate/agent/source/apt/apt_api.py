@@ -37,6 +37,7 @@ from .apt_cli import APTCLI
 
 class APT(APTCLI):
     PROGRESS_REPORTING = True
+    CHANGES_FROM_TRANSACTION = True
 
     def __init__(
         self, log_handler: Handler, log_level: int, agent_type: AgentType
@@ -90,6 +91,8 @@ class APT(APTCLI):
         try:
             self.log.debug("Performing package upgrade...")
             self.apt_cache.upgrade(dist_upgrade=remove_obsolete)
+            if not self.install:
+                return self._download()
             Path(
                 os.path.join(
                     apt_pkg.config.find_dir("Dir::Cache::Archives"), "partial"
@@ -97,11 +100,20 @@ class APT(APTCLI):
             ).mkdir(parents=True, exist_ok=True)
             apt_pkg.config.set("Dpkg::Options::", "--force-confdef")
             apt_pkg.config.set("Dpkg::Options::", "--force-confold")
+            # marks are lost on commit
+            installed: dict[str, list[str]] = {}
+            removed: dict[str, list[str]] = {}
+            for pkg in self.apt_cache.get_changes():
+                if pkg.installed is not None and not pkg.marked_keep:
+                    removed[pkg.shortname] = [pkg.installed.version]
+                if not pkg.marked_delete and pkg.candidate is not None:
+                    installed[pkg.shortname] = [pkg.candidate.version]
             self.log.debug("Committing upgrade...")
             self.apt_cache.commit(
                 self.progress.fetch_progress, self.progress.upgrade_progress
             )
             self.log.debug("Package upgrade successful.")
+            self.record_changes(removed=removed, installed=installed)
         except Exception as exc:
             self.log.error(
                 "An error occurred while upgrading packages: %s", str(exc)
@@ -113,6 +125,23 @@ class APT(APTCLI):
 
         return result
 
+    def _download(self) -> ProcessResult:
+        """
+        Download packages marked for upgrade to the archives cache.
+        """
+        if not self.apt_cache.get_changes():
+            self.log.info("No packages to upgrade, quitting.")
+            return ProcessResult(EXIT.OK_NO_UPDATES)
+        Path(
+            os.path.join(
+                apt_pkg.config.find_dir("Dir::Cache::Archives"), "partial"
+            )
+        ).mkdir(parents=True, exist_ok=True)
+        self.log.debug("Downloading packages...")
+        self.apt_cache.fetch_archives(progress=self.progress.fetch_progress)
+        self.log.debug("Packages downloaded.")
+        return ProcessResult()
+
 
 class FetchProgress(apt.progress.base.AcquireProgress, Progress):
     def __init__(self, weight: int, log: Logger, refresh: bool = False) -> None:
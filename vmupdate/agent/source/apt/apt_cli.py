@@ -118,7 +118,7 @@ class APTCLI(PackageManager):
         """
         result = super().upgrade_internal(remove_obsolete)
 
-        if remove_obsolete:
+        if remove_obsolete and self.install:
             result += self.remove_obsolete_kernels()
 
         return result
@@ -135,6 +135,8 @@ class APTCLI(PackageManager):
             "Dpkg::Options::=--force-confold",
         ]
         result += ["dist-upgrade"] if remove_obsolete else ["upgrade"]
+        if not self.install:
+            result.append("--download-only")
         return result
 
     def clean(self) -> int:
@@ -161,16 +163,23 @@ class APTCLI(PackageManager):
         result = self.run_cmd(cmd, realtime=False)
 
         if not result:  # no error
-            obsoletes = set()
+            obsoletes: dict[str, str] = {}
             for line in result.out.splitlines():
                 if line.startswith("Remv"):
                     package_name = line[len("Remv ") :]
                     # consider using wider pattern
                     if package_name.startswith("linux-image"):
-                        obsoletes.add(package_name.split(" ")[0])
+                        # e.g. `Remv linux-image-6.1.0-9-amd64 [6.1.27-1]`
+                        name, *version = package_name.split(" ")
+                        obsoletes[name] = (
+                            version[0].strip("[]") if version else ""
+                        )
             if obsoletes:
                 cmd = [self.package_manager, "remove", "-y", *obsoletes]
                 result = self.run_cmd(cmd, realtime=False)
+                if not result and self.changes is not None:
+                    for name, version in obsoletes.items():
+                        self.changes["removed"][name] = [version]
             else:
                 result = ProcessResult(EXIT.OK)
 
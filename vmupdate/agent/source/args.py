@@ -19,12 +19,13 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 import argparse
+from typing import Any
 
 
 class AgentArgs:
     # To avoid code repeating when we want to retrieve arguments
     OPTIONS: dict[
-        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, str]
+        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, Any]
     ] = {
         ("--log",): {
             "action": "store",
@@ -36,6 +37,25 @@ class AgentArgs:
             "action": "store_true",
             "help": "Do not refresh available packages before " "upgrading",
         },
+        ("--refresh-policy",): {
+            "action": "store",
+            "choices": ("always", "changed"),
+            "default": "always",
+            "help": "How to refresh available packages: `always` (default) "
+            "revalidate metadata and check for updates, `changed` only "
+            "revalidate metadata, without a separate check for updates "
+            "(dnf CLI only)",
+        },
+        ("--threads",): {
+            "action": "store",
+            "type": int,
+            "default": 1,
+            "metavar": "N",
+            "help": "Maximal number of threads of the dnf backend loading "
+            "repositories or checking signatures of packages at once "
+            "(default: 1); thread safety of dnf is not documented, "
+            "so use it with care",
+        },
         ("--force-upgrade", "-f"): {
             "action": "store_true",
             "help": "Try upgrade even if errors are "
@@ -53,9 +73,34 @@ class AgentArgs:
             "action": "store_true",
             "help": "Only download packages",
         },
+        ("--no-install",): {
+            "action": "store_true",
+            "help": "Only download packages and keep them in the cache of "
+            "the package manager, to be installed by the next update",
+        },
+        ("--trace",): {
+            "action": "store_true",
+            "help": "Record duration of update phases for profiling",
+        },
+        ("--progress-interval",): {
+            "action": "store",
+            "type": float,
+            "default": 0.1,
+            "metavar": "SECONDS",
+            "help": "Minimal time between progress reports of updated qube "
+            "(default: 0.1)",
+        },
+        ("--progress-delta",): {
+            "action": "store",
+            "type": float,
+            "default": 0.1,
+            "metavar": "PERCENT",
+            "help": "Minimal change of progress reported by updated qube "
+            "(default: 0.1)",
+        },
     }
     EXCLUSIVE_OPTIONS_1: dict[
-        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, str]
+        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, Any]
     ] = {
         ("--show-output", "--verbose", "-v"): {
             "action": "store_true",
@@ -67,7 +112,7 @@ class AgentArgs:
         },
     }
     EXCLUSIVE_OPTIONS_2: dict[
-        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, str]
+        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, Any]
     ] = {
         ("--no-progress",): {
             "action": "store_true",
@@ -79,7 +124,7 @@ class AgentArgs:
         },
     }
     ALL_OPTIONS: dict[
-        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, str]
+        tuple[str] | tuple[str, str] | tuple[str, str, str], dict[str, Any]
     ] = {
         **OPTIONS,
         **EXCLUSIVE_OPTIONS_1,
@@ -116,5 +161,5 @@ class AgentArgs:
                 if args_dict[param_name]:
                     cli_args.append(keys[0])
             else:
-                cli_args.extend((keys[0], args_dict[param_name]))
+                cli_args.extend((keys[0], str(args_dict[param_name])))
         return cli_args
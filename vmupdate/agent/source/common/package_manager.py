@@ -28,6 +28,7 @@ import enum
 from typing import Optional, Dict, List, Any
 from .process_result import ProcessResult
 from .exit_codes import EXIT
+from .tracing import TRACER
 
 
 class AgentType(enum.Enum):
@@ -39,6 +40,11 @@ class AgentType(enum.Enum):
 class PackageManager:
     """main package manager class"""
 
+    # changes of packages are taken from the upgrade transaction
+    # (see `record_changes`) instead of listing all installed packages
+    # before and after the upgrade
+    CHANGES_FROM_TRANSACTION = False
+
     def __init__(
         self,
         log_handler: logging.Handler,
@@ -54,6 +60,15 @@ class PackageManager:
         self.log.propagate = False
         self.requirements: Optional[Dict[str, str]] = None
         self.type = agent_type
+        # changes made by the last upgrade, see `record_changes`
+        self.changes: Optional[dict[str, dict]] = None
+        # `always` or `changed`, see `refresh`
+        self.refresh_policy = "always"
+        # maximal number of threads of the backend, see `DNF`
+        self.threads = 1
+        # if False, packages are only downloaded (to the cache
+        # of the package manager), see `upgrade_internal`
+        self.install = True
 
     def upgrade(
         self,
@@ -92,11 +107,23 @@ class PackageManager:
     ) -> ProcessResult:
         result = ProcessResult(realtime=True)
 
-        curr_pkg = self.get_packages()
+        # requirements are installed outside the upgrade transaction,
+        # so their changes have to be found by comparing installed packages
+        if not self.install:
+            # requirements are installed with updates
+            requirements = None
+        curr_pkg: Optional[Dict[str, List[str]]] = None
+        if self.install and (requirements or not self.CHANGES_FROM_TRANSACTION):
+            with TRACER.span("get_packages"):
+                curr_pkg = self.get_packages()
 
         if requirements:
+            assert curr_pkg is not None
             print("Install requirements", flush=True)
-            result_install = self.install_requirements(requirements, curr_pkg)
+            with TRACER.span("install_requirements"):
+                result_install = self.install_requirements(
+                    requirements, curr_pkg
+                )
             if result_install:
                 self.log.warning(
                     "Installing requirements failed with exit code: %d",
@@ -113,7 +140,8 @@ class PackageManager:
 
         if refresh:
             print("Refreshing package info", flush=True)
-            result_refresh = self.refresh(hard_fail)
+            with TRACER.span("refresh"):
+                result_refresh = self.refresh(hard_fail)
             if result_refresh:
                 self.log.warning(
                     "Refreshing failed with code: %d", result_refresh.code
@@ -127,20 +155,27 @@ class PackageManager:
                 )
                 return result
 
-        result_upgrade = self.upgrade_internal(remove_obsolete)
+        self.changes = None
+        with TRACER.span("upgrade_internal"):
+            result_upgrade = self.upgrade_internal(remove_obsolete)
         if result_upgrade.code not in (EXIT.OK, EXIT.OK_NO_UPDATES):
             result_upgrade.code = EXIT.ERR_VM_UPDATE
         result += result_upgrade
         if result:
             return result
 
-        if self.type == AgentType.UPDATE_VM:
+        if self.type == AgentType.UPDATE_VM or not self.install:
             # No package installation is required in UpdateVM, so changes are not checked.
             return result
 
-        new_pkg = self.get_packages()
-
-        changes = PackageManager.compare_packages(old=curr_pkg, new=new_pkg)
+        if curr_pkg is not None:
+            with TRACER.span("get_packages"):
+                new_pkg = self.get_packages()
+            changes = PackageManager.compare_packages(old=curr_pkg, new=new_pkg)
+        else:
+            if self.changes is None:
+                self.log.warning("Changes of packages are unknown.")
+            changes = self.changes or PackageManager.compare_packages({}, {})
         summary = self._print_changes(changes)
         if summary:
             summary.code = EXIT.ERR_VM
@@ -250,6 +285,21 @@ class PackageManager:
             "removed": {pkg: old[pkg] for pkg in old if pkg not in new},
         }
 
+    def record_changes(
+        self, removed: dict[str, list[str]], installed: dict[str, list[str]]
+    ) -> None:
+        """
+        Remember changes made by the upgrade transaction.
+
+        :param removed: Dict[package_name, version] packages removed
+                        or replaced by the transaction
+        :param installed: Dict[package_name, version] packages installed
+                          by the transaction (including new versions)
+        """
+        self.changes = PackageManager.compare_packages(
+            old=removed, new=installed
+        )
+
     def _print_changes(self, changes: dict[str, dict]) -> ProcessResult:
         result = ProcessResult()
         result.out += self._print_to_string("Installed packages:")
@@ -295,6 +345,11 @@ class PackageManager:
         """
         Refresh available packages for upgrade.
 
+        Only metadata of repositories changed since the last refresh
+        should be downloaded (e.g. checked by a checksum of `repomd.xml`).
+        If `refresh_policy` is `changed`, available updates are not
+        checked by a separate command.
+
         :param hard_fail: raise error if some repo is unavailable
         :return: (exit_code, stdout, stderr)
         """
@@ -315,6 +370,9 @@ class PackageManager:
     def upgrade_internal(self, remove_obsolete: bool) -> ProcessResult:
         """
         Just run upgrade via CLI.
+
+        If not `install`, packages should be only downloaded
+        (see `get_action`).
         """
         assert isinstance(self.package_manager, str)
         cmd = [self.package_manager, *self.get_action(remove_obsolete)]
@@ -18,12 +18,71 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
+import io
 import sys
 import subprocess
-from copy import deepcopy
-from typing import Union, Optional, Self
+import tempfile
+from typing import IO, Any, Union, Optional, Self
 from .exit_codes import EXIT
 
+# bytes removed by `ProcessResult.sanitize_output`, only printable ASCII
+# characters (and new lines if not in single line mode) are kept
+_PRINTABLE = range(0x20, 0x7F)
+_DELETE_SINGLE = bytes(b for b in range(256) if b not in _PRINTABLE)
+_DELETE_MULTI = _DELETE_SINGLE.replace(b"\n", b"")
+
+
+class _Output:
+    """
+    Text accumulated in chunks.
+
+    Joining is deferred until the text is read. Above `limit` characters
+    the text is moved to a temporary file, so long outputs do not stay
+    in memory.
+    """
+
+    def __init__(self, text: str = "", limit: Optional[int] = None) -> None:
+        self.limit = limit
+        self._chunks: list[str] = []
+        self._size = 0
+        self._file: Optional[IO[str]] = None
+        self.append(text)
+
+    def append(self, text: str) -> None:
+        if not text:
+            return
+        if self._file is not None:
+            self._file.write(text)
+            return
+        self._chunks.append(text)
+        self._size += len(text)
+        if self.limit is not None and self._size > self.limit:
+            self._spill()
+
+    def _spill(self) -> None:
+        # pylint: disable=consider-using-with
+        self._file = tempfile.TemporaryFile(
+            "w+", encoding="utf-8", errors="surrogateescape"
+        )
+        self._file.writelines(self._chunks)
+        self._chunks = []
+        self._size = 0
+
+    def getvalue(self) -> str:
+        if self._file is not None:
+            self._file.seek(0)
+            text = self._file.read()
+            self._file.seek(0, io.SEEK_END)
+            return text
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def __bool__(self) -> bool:
+        if self._file is not None:
+            return bool(self._file.tell())
+        return bool(self._size)
+
 
 class ProcessResult:
     """
@@ -31,8 +90,13 @@ class ProcessResult:
 
     Controls where the results of subprocesses are directed
     (e.g., to stdout or buffered).
+
+    Output is accumulated in chunks, above `MEMORY_LIMIT` characters
+    (of each stream) it is kept in a temporary file, see `_Output`.
     """
 
+    MEMORY_LIMIT: Optional[int] = 2**24
+
     def __init__(
         self,
         code: int = EXIT.OK,
@@ -41,8 +105,8 @@ class ProcessResult:
         realtime: bool = False,
     ) -> None:
         self.code: int = code
-        self.out: str = out
-        self.err: str = err
+        self._out = _Output(out, ProcessResult.MEMORY_LIMIT)
+        self._err = _Output(err, ProcessResult.MEMORY_LIMIT)
         self.realtime = realtime
         self.posted = False
         if self.realtime and not self.posted:
@@ -52,6 +116,35 @@ class ProcessResult:
                 print(self.err, file=sys.stderr, flush=True)
             self.posted = True
 
+    @property
+    def out(self) -> str:
+        return self._out.getvalue()
+
+    @out.setter
+    def out(self, text: str) -> None:
+        self._out = _Output(text, ProcessResult.MEMORY_LIMIT)
+
+    @property
+    def err(self) -> str:
+        return self._err.getvalue()
+
+    @err.setter
+    def err(self, text: str) -> None:
+        self._err = _Output(text, ProcessResult.MEMORY_LIMIT)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # results are sent between processes, temporary files are not
+        state = self.__dict__.copy()
+        state["_out"] = self.out
+        state["_err"] = self.err
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        out, err = state.pop("_out"), state.pop("_err")
+        self.__dict__.update(state)
+        self.out = out
+        self.err = err
+
     @classmethod
     def process_communicate(cls, proc: subprocess.Popen) -> Self:
         result = cls.from_untrusted_out_err(*proc.communicate())
@@ -84,17 +177,18 @@ class ProcessResult:
 
     @staticmethod
     def sanitize_output(untrusted_bytes: bytes, single: bool = False) -> str:
-        untrusted_str = untrusted_bytes.decode("ascii", errors="ignore")
-        return "".join(
-            [
-                c
-                for c in untrusted_str
-                if 0x20 <= ord(c) <= 0x7E or (c == "\n" and not single)
-            ]
-        )
+        """
+        Keep only printable ASCII characters (and new lines unless `single`).
+
+        Each byte is handled separately, so output could be sanitized
+        in arbitrary chunks.
+        """
+        delete = _DELETE_SINGLE if single else _DELETE_MULTI
+        return untrusted_bytes.translate(None, delete).decode("ascii")
 
     def __add__(self, other: Self) -> Self:
-        new = deepcopy(self)
+        new = self.__class__.__new__(self.__class__)
+        new.__setstate__(self.__getstate__())
         new += other
         return new
 
@@ -106,13 +200,14 @@ class ProcessResult:
                 f"'{other.__class__.__name__}'"
             )
         self.code = max(self.code, other.code)
-        self.out += other.out
-        self.err += other.err
+        other_out, other_err = other.out, other.err
+        self._out.append(other_out)
+        self._err.append(other_err)
         if self.realtime and not other.posted:
-            if other.out:
-                print(other.out, file=sys.stdout, flush=True)
-            if other.err:
-                print(other.err, file=sys.stderr, flush=True)
+            if other_out:
+                print(other_out, file=sys.stdout, flush=True)
+            if other_err:
+                print(other_err, file=sys.stderr, flush=True)
             other.posted = True
         return self
 
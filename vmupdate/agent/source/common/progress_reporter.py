@@ -22,11 +22,18 @@
 import io
 import os
 import sys
+import time
 from typing import Callable, Optional
 from logging import Logger
 
 
 class Progress:
+    # progress is reported if it rose by at least `MIN_DELTA` percent
+    # and `MIN_INTERVAL` seconds passed since the last report,
+    # the end of each phase is always reported
+    MIN_INTERVAL = 0.0
+    MIN_DELTA = 0.01
+
     def __init__(
         self,
         weight: int,
@@ -37,6 +44,7 @@ class Progress:
         self._start_percent: Optional[float] = None
         self._stop_percent: Optional[float] = None
         self._last_percent: Optional[float] = None
+        self._last_time = float("-inf")
         self._stdout: Optional[io.TextIOWrapper] = None
         self._stderr: Optional[io.TextIOWrapper] = None
         self.log: Logger = log
@@ -69,9 +77,17 @@ class Progress:
             + percent * (self._stop_percent - self._start_percent) / 100
         )
         _percent = round(_percent, 2)
-        if self._last_percent < _percent:
-            self._callback(_percent)
-            self._last_percent = _percent
+        if self._last_percent >= _percent:
+            return
+        now = time.monotonic()
+        if _percent < self._stop_percent and (
+            _percent - self._last_percent < Progress.MIN_DELTA
+            or now - self._last_time < Progress.MIN_INTERVAL
+        ):
+            return
+        self._callback(_percent)
+        self._last_percent = _percent
+        self._last_time = now
 
     @staticmethod
     def _format_bytes(size: int | float) -> str:
@@ -0,0 +1,179 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+Spans of update phases in the Chrome trace event format.
+
+Traces could be opened by chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import contextlib
+import json
+import re
+import time
+from typing import Any, Iterator
+
+# spans reported by agent are limited to simple names
+_SPAN_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+MAX_UNTRUSTED_SPANS = 10000
+
+
+class Tracer:
+    """
+    Collect spans of work.
+
+    Each span is a complete event (`"ph": "X"`), its `pid` and `tid` are
+    names of the process (e.g. a qube) and the thread (e.g. dom0 or agent),
+    they are replaced by numbers in `dump`.
+    """
+
+    def __init__(
+        self, enabled: bool = True, process: str = "", thread: str = ""
+    ) -> None:
+        self.enabled = enabled
+        self.process = process
+        self.thread = thread
+        self.spans: list[dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        """
+        Record the block as a span.
+        """
+        if not self.enabled:
+            yield
+            return
+        begin = time.time()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, begin, time.monotonic() - start, **args)
+
+    def add(
+        self, name: str, begin: float, duration: float, **args: Any
+    ) -> None:
+        """
+        Record a span started at `begin` (epoch seconds).
+        """
+        if not self.enabled:
+            return
+        span = {
+            "name": name,
+            "ph": "X",
+            "ts": int(begin * 1_000_000),
+            "dur": int(duration * 1_000_000),
+            "pid": self.process,
+            "tid": self.thread,
+        }
+        if args:
+            span["args"] = args
+        self.spans.append(span)
+
+    def extend(self, spans: list[dict[str, Any]]) -> None:
+        if self.enabled:
+            self.spans.extend(spans)
+
+    def dump(self, path: str) -> None:
+        """
+        Write all spans to a file in the Chrome trace event format.
+        """
+        processes: dict[str, int] = {}
+        threads: dict[tuple[str, str], int] = {}
+        events: list[dict[str, Any]] = []
+        for span in self.spans:
+            process, thread = str(span["pid"]), str(span["tid"])
+            if process not in processes:
+                processes[process] = len(processes) + 1
+                events.append(
+                    {
+                        "name": "process_name",
+                        "ph": "M",
+                        "pid": processes[process],
+                        "args": {"name": process},
+                    }
+                )
+            if (process, thread) not in threads:
+                threads[(process, thread)] = len(threads) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": processes[process],
+                        "tid": threads[(process, thread)],
+                        "args": {"name": thread},
+                    }
+                )
+            events.append(
+                {
+                    **span,
+                    "pid": processes[process],
+                    "tid": threads[(process, thread)],
+                }
+            )
+        with open(path, "w", encoding="ascii") as file:
+            json.dump({"traceEvents": events}, file)
+
+    def load_untrusted(self, untrusted_text: str) -> None:
+        """
+        Add spans from a trace dumped by an agent.
+
+        Only names and times of complete events are taken, they are
+        assigned to the process and thread of this tracer.
+        """
+        try:
+            untrusted_events = json.loads(untrusted_text)["traceEvents"]
+        except (ValueError, TypeError, KeyError):
+            return
+        if not isinstance(untrusted_events, list):
+            return
+        for untrusted_event in untrusted_events[:MAX_UNTRUSTED_SPANS]:
+            if not isinstance(untrusted_event, dict):
+                continue
+            if untrusted_event.get("ph") != "X":
+                continue
+            untrusted_name = untrusted_event.get("name")
+            untrusted_ts = untrusted_event.get("ts")
+            untrusted_dur = untrusted_event.get("dur")
+            if not isinstance(untrusted_name, str) or not _SPAN_NAME.match(
+                untrusted_name
+            ):
+                continue
+            if not isinstance(untrusted_ts, int) or not isinstance(
+                untrusted_dur, int
+            ):
+                continue
+            if isinstance(untrusted_dur, bool) or untrusted_dur < 0:
+                continue
+            self.spans.append(
+                {
+                    "name": untrusted_name,
+                    "ph": "X",
+                    "ts": untrusted_ts,
+                    "dur": untrusted_dur,
+                    "pid": self.process,
+                    "tid": self.thread,
+                }
+            )
+
+
+# tracer of the agent, enabled by the `--trace` option
+TRACER = Tracer(enabled=False, thread="agent")
@@ -41,8 +41,22 @@ class TransactionError(RuntimeError):
     pass
 
 
+# actions of transaction items which add or remove a package
+INBOUND_ACTIONS = (
+    libdnf5.transaction.TransactionItemAction_INSTALL,
+    libdnf5.transaction.TransactionItemAction_UPGRADE,
+    libdnf5.transaction.TransactionItemAction_DOWNGRADE,
+    libdnf5.transaction.TransactionItemAction_REINSTALL,
+)
+OUTBOUND_ACTIONS = (
+    libdnf5.transaction.TransactionItemAction_REMOVE,
+    libdnf5.transaction.TransactionItemAction_REPLACED,
+)
+
+
 class DNF5(DNFCLI):
     PROGRESS_REPORTING = True
+    CHANGES_FROM_TRANSACTION = True
 
     def __init__(
         self, log_handler: Handler, log_level: int, agent_type: AgentType
@@ -70,6 +84,9 @@ class DNF5(DNFCLI):
         # Create base object with the loaded config
         self.base.setup()
         self.config = self.base.get_config()
+        # repositories are loaded once, by refresh or by upgrade
+        self._repos_created = False
+        self._repos_loaded = False
         update = FetchProgress(weight=0, log=self.log)  # % of total time
         fetch = FetchProgress(weight=55, log=self.log)  # % of total time
         upgrade = UpgradeProgress(weight=45, log=self.log)  # % of total time
@@ -87,8 +104,9 @@ class DNF5(DNFCLI):
         result = ProcessResult()
         try:
             self.log.debug("Refreshing available packages...")
-
-            result += self.expire_cache()
+            # in UpdateVM we use preconfigured repos
+            self._load_repos(expire=self.type != AgentType.UPDATE_VM)
+            self.log.debug("Cache refresh successful.")
         except Exception as exc:
             self.log.error(
                 "An error occurred while refreshing packages: %s", str(exc)
@@ -97,6 +115,32 @@ class DNF5(DNFCLI):
 
         return result
 
+    def _load_repos(self, expire: bool = False) -> None:
+        """
+        Load metadata of enabled repositories unless already loaded.
+
+        If `expire`, cached metadata are revalidated, only repositories
+        with changed checksum of `repomd.xml` are downloaded again
+        (like after `dnf clean expire-cache`).
+        Repositories are not loaded again after a failure, so a forced
+        upgrade uses those which were loaded.
+        """
+        if self._repos_loaded:
+            return
+        repo_sack = self.base.get_repo_sack()
+        if not self._repos_created:
+            repo_sack.create_repos_from_system_configuration()
+            self._repos_created = True
+        if expire:
+            repos = libdnf5.repo.RepoQuery(self.base)
+            repos.filter_enabled(True)
+            for repo in repos:
+                repo.expire()
+        try:
+            repo_sack.load_repos()
+        finally:
+            self._repos_loaded = True
+
     def upgrade_internal(self, remove_obsolete: bool) -> ProcessResult:
         """
         Use `libdnf5` package to upgrade and track progress.
@@ -105,9 +149,7 @@ class DNF5(DNFCLI):
         result = ProcessResult()
         try:
             self.log.debug("Performing package upgrade...")
-            repo_sack = self.base.get_repo_sack()
-            repo_sack.create_repos_from_system_configuration()
-            repo_sack.load_repos()
+            self._load_repos()
 
             goal = Goal(self.base)
             if self.type == AgentType.UPDATE_VM:
@@ -140,7 +182,11 @@ class DNF5(DNFCLI):
                     f"GPG signatures check failed: {problems}"
                 )
 
-            if result.code == EXIT.OK and self.type is not AgentType.UPDATE_VM:
+            if (
+                result.code == EXIT.OK
+                and self.type is not AgentType.UPDATE_VM
+                and self.install
+            ):
                 self.log.debug("Committing upgrade...")
                 transaction.set_callbacks(
                     libdnf5.rpm.TransactionCallbacksUniquePtr(
@@ -153,6 +199,7 @@ class DNF5(DNFCLI):
                         transaction.transaction_result_to_string(tnx_result)
                     )
                 self.log.debug("Package upgrade successful.")
+                self._record_transaction(transaction)
                 if self.type is AgentType.VM:
                     self.log.info("Notifying dom0 about installed applications")
                     subprocess.call(["/etc/qubes-rpc/qubes.PostInstall"])
@@ -163,6 +210,23 @@ class DNF5(DNFCLI):
             result += ProcessResult(EXIT.ERR_VM_UPDATE, out="", err=str(exc))
         return result
 
+    def _record_transaction(self, transaction: Any) -> None:
+        installed: dict[str, list[str]] = {}
+        removed: dict[str, list[str]] = {}
+        for item in transaction.get_transaction_packages():
+            action = item.get_action()
+            if action in INBOUND_ACTIONS:
+                packages = installed
+            elif action in OUTBOUND_ACTIONS:
+                packages = removed
+            else:
+                continue
+            pkg = item.get_package()
+            packages.setdefault(pkg.get_name(), []).append(
+                f"{pkg.get_version()}-{pkg.get_release()}"
+            )
+        self.record_changes(removed=removed, installed=installed)
+
 
 class FetchProgress(DownloadCallbacks, Progress):
     def __init__(self, weight: int, log: Logger) -> None:
@@ -19,10 +19,12 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import concurrent.futures
 import os
 import subprocess
+import threading
 from logging import Handler, Logger
-from typing import Iterable
+from typing import Any, Iterable
 
 import dnf
 import dnf.conf
@@ -41,6 +43,7 @@ from .dnf_cli import DNFCLI
 
 class DNF(DNFCLI):
     PROGRESS_REPORTING = True
+    CHANGES_FROM_TRANSACTION = True
 
     def __init__(
         self, log_handler: Handler, log_level: int, agent_type: AgentType
@@ -98,13 +101,9 @@ class DNF(DNFCLI):
         self.base.conf.skip_if_unavailable = True
         try:
             self.log.debug("Refreshing available packages...")
-            repos = tuple(self.base.repos.iter_enabled())
-            # we do not know the size of the repositories
-            self.progress.update_progress.start(len(repos), len(repos))
-            for repo in repos:
-                self.progress.update_progress.progress(repo.id, 1)
-                repo.load()
-                self.progress.update_progress.end(repo.id, 0, "")
+            result += self._load_repos()
+            if result:
+                return result
             updated = self.base.update_cache()
             if updated:
                 self.log.debug("Cache refresh successful.")
@@ -118,6 +117,45 @@ class DNF(DNFCLI):
             result += ProcessResult(EXIT.ERR_VM_REFRESH, out="", err=str(exc))
         return result
 
+    def _load_repos(self) -> ProcessResult:
+        """
+        Load metadata of enabled repositories.
+
+        Repositories share the sack and configuration of one `dnf.Base`,
+        which is not documented as thread-safe, so they are loaded one by
+        one, unless more `threads` are allowed. Then at most
+        `max_parallel_downloads` (from dnf configuration) repositories
+        are loaded at once. Errors of all repositories are returned.
+        """
+        result = ProcessResult()
+        update_progress = self.progress.update_progress
+        repos = tuple(self.base.repos.iter_enabled())
+        update_progress.start(len(repos), 0)
+        for repo in repos:
+            repo.set_progress_bar(RepoProgress(repo.id, update_progress))
+        workers = min(
+            self.threads, self.base.conf.max_parallel_downloads, len(repos)
+        )
+        if workers <= 1:
+            for repo in repos:
+                result += self._load_repo(repo)
+            return result
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for repo_result in executor.map(self._load_repo, repos):
+                result += repo_result
+        return result
+
+    def _load_repo(self, repo: Any) -> ProcessResult:
+        update_progress = self.progress.update_progress
+        try:
+            repo.load()
+        except Exception as exc:
+            self.log.error("Cannot load repository %s: %s", repo.id, str(exc))
+            return ProcessResult(EXIT.ERR_VM_REFRESH, out="", err=str(exc))
+        update_progress.repo_progress(repo.id, 1.0)
+        update_progress.end(repo.id, 0, "")
+        return ProcessResult()
+
     def upgrade_internal(self, remove_obsolete: bool) -> ProcessResult:
         """
         Use `dnf` package to upgrade and track progress.
@@ -144,13 +182,23 @@ class DNF(DNFCLI):
             self.base.download_packages(
                 trans.install_set, progress=self.progress.fetch_progress
             )
-            result += sign_check(self.base, trans.install_set, self.log)
+            result += sign_check(
+                self.base, trans.install_set, self.log, self.threads
+            )
 
-            if result.code == EXIT.OK and self.type is not AgentType.UPDATE_VM:
+            if (
+                result.code == EXIT.OK
+                and self.type is not AgentType.UPDATE_VM
+                and self.install
+            ):
                 print("Updating packages.", flush=True)
                 self.log.debug("Committing upgrade...")
                 self.base.do_transaction(self.progress.upgrade_progress)
                 self.log.debug("Package upgrade successful.")
+                self.record_changes(
+                    removed=_versions(trans.remove_set),
+                    installed=_versions(trans.install_set),
+                )
                 if self.type is AgentType.VM:
                     self.log.info("Notifying dom0 about installed applications")
                     subprocess.call(["/etc/qubes-rpc/qubes.PostInstall"])
@@ -166,33 +214,66 @@ class DNF(DNFCLI):
         return result
 
 
+def _versions(packages: Iterable) -> dict[str, list[str]]:
+    result: dict[str, list[str]] = {}
+    for package in packages:
+        result.setdefault(package.name, []).append(
+            f"{package.version}-{package.release}"
+        )
+    return result
+
+
 def sign_check(
-    base: dnf.Base, packages: Iterable, log: Logger
+    base: dnf.Base, packages: Iterable, log: Logger, threads: int = 1
 ) -> ProcessResult:
     """
     Check a signature of packages.
+
+    The checks share the rpm transaction set of `base`, which is not
+    documented as thread-safe, so by default they are done one by one.
+    With more `threads`, signatures are checked in parallel (the check
+    is mostly CPU-bound in rpm). Packages signed by a key which is
+    not imported yet are handled one by one afterwards: the key is
+    imported (once, later packages signed by it pass the check) and
+    the signature is checked again.
     """
     log.debug("Check signature of packages.")
-    result = ProcessResult()
-    for package in packages:
-        ret_code, message = base.package_signature_check(package)
+    packages = list(packages)
+    workers = min(threads, os.cpu_count() or 1, len(packages))
+    if workers <= 1:
+        checks = [base.package_signature_check(pkg) for pkg in packages]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            checks = list(executor.map(base.package_signature_check, packages))
+
+    codes = [EXIT.OK]
+    out: list[str] = []
+    err: list[str] = []
+    imported = False
+    for package, (ret_code, message) in zip(packages, checks):
+        if ret_code != EXIT.OK and imported:
+            # the key could be imported for one of previous packages
+            ret_code, message = base.package_signature_check(package)
         if ret_code != EXIT.OK:
             # Import key and re-try the check
             try:
                 base.package_import_key(package, askcb=(lambda a, b, c: True))
             except Exception as ex:
-                result += ProcessResult(ret_code, out="", err=str(ex))
+                codes.append(ret_code)
+                err.append(str(ex))
                 continue
+            imported = True
             # base.package_import_key does verify package as a side effect, but
             # do that explicitly anyway, in case the behavior would change
             # (intentionally or not)
             ret_code, message = base.package_signature_check(package)
+        codes.append(ret_code)
         if ret_code != EXIT.OK:
-            result += ProcessResult(ret_code, out="", err=message)
+            err.append(message)
         else:
-            result += ProcessResult(EXIT.OK, out=message, err="")
+            out.append(message)
 
-    return result
+    return ProcessResult(max(codes), out="".join(out), err="".join(err))
 
 
 class FetchProgress(DownloadProgress, Progress):
@@ -202,6 +283,11 @@ class FetchProgress(DownloadProgress, Progress):
         self.bytes_fetched = 0
         self.action = "refresh" if refresh else "fetch"
         self.package_bytes: dict[str, int] = {}
+        # fraction of metadata downloaded for each repository,
+        # updated by `RepoProgress` from multiple threads
+        self.repos_total = 0
+        self.repos_done: dict[str, float] = {}
+        self._lock = threading.Lock()
 
     def end(self, payload: str, status: int, msg: bytes | str) -> None:
         """Communicate the information that `payload` has finished downloading.
@@ -248,6 +334,8 @@ class FetchProgress(DownloadProgress, Progress):
         self.log.info(f"{self.action.capitalize()} started.")
         self.bytes_to_fetch = total_size
         if self.action == "refresh":
+            self.repos_total = total_files
+            self.repos_done = {}
             print("Refreshing available packages.", flush=True)
         else:
             print(
@@ -258,6 +346,42 @@ class FetchProgress(DownloadProgress, Progress):
             self.package_bytes = {}
         self.notify_callback(0)
 
+    def repo_progress(self, repo_id: str, fraction: float) -> None:
+        """
+        Report the downloaded fraction of metadata of the repository.
+
+        Each repository counts the same, since sizes of others
+        are not known until they start downloading.
+        """
+        with self._lock:
+            self.repos_done[repo_id] = fraction
+            percent = sum(self.repos_done.values()) / self.repos_total * 100
+            self.notify_callback(percent)
+
+
+class RepoProgress(DownloadProgress):
+    """
+    Forward progress of metadata download of a single repository.
+    """
+
+    def __init__(self, repo_id: str, progress: FetchProgress) -> None:
+        self.repo_id = repo_id
+        self._progress = progress
+
+    def start(
+        self, total_files: int, total_size: int, total_drpms: int = 0
+    ) -> None:
+        pass
+
+    def progress(self, payload: Any, done: int) -> None:
+        # length of the payload is the size of the metadata
+        total = len(payload)
+        if total > 0:
+            self._progress.repo_progress(self.repo_id, min(done / total, 1.0))
+
+    def end(self, payload: Any, status: int, msg: bytes | str) -> None:
+        pass
+
 
 class UpgradeProgress(TransactionDisplay, Progress):
     def __init__(self, weight: int, log: Logger) -> None:
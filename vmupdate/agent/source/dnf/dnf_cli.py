@@ -54,6 +54,9 @@ class DNFCLI(PackageManager):
         :param hard_fail: raise error if some repo is unavailable
         :return: (exit_code, stdout, stderr)
         """
+        if self.refresh_policy == "changed":
+            return self.make_cache(hard_fail)
+
         result = self.expire_cache()
 
         cmd = [
@@ -76,6 +79,28 @@ class DNFCLI(PackageManager):
 
         return result
 
+    def make_cache(self, hard_fail: bool) -> ProcessResult:
+        """
+        Use package manager to revalidate metadata by a single command.
+
+        Metadata are expired, but a repository is downloaded again only
+        if its `repomd.xml` changed. Available updates are not resolved.
+        """
+        cmd = [
+            self.package_manager,
+            "-q",
+            "makecache",
+            "--refresh",
+            f"--setopt=skip_if_unavailable={int(not hard_fail)}",
+        ]
+        if self.type != AgentType.UPDATE_VM:
+            result = self.run_cmd(cmd)
+            result.error_from_messages()
+        else:
+            # In UpdateVM we use preconfigured repos
+            result = ProcessResult()
+        return result
+
     def expire_cache(self) -> ProcessResult:
         """
         Use package manager to expire cache.
@@ -143,6 +168,8 @@ class DNFCLI(PackageManager):
             else:
                 # yum
                 result.append("update")
+        if not self.install:
+            result.append("--downloadonly")
         return result
 
     def clean(self) -> int:
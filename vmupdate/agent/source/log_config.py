@@ -20,14 +20,45 @@
 # USA.
 
 import os
+import sys
 import logging
 import grp
-from logging import Logger, FileHandler, Formatter
+from logging import Logger, FileHandler, Formatter, LogRecord
 from pathlib import Path
 
 LOGPATH = "/var/log/qubes/qubes-update"
 FORMAT_LOG = "%(asctime)s [Agent] %(message)s"
 LOG_FILE = "update-agent.log"
+TRACE_FILE = "update-agent-trace.json"
+
+
+class StreamedFileHandler(FileHandler):
+    """
+    Write records to the file and also to the standard output.
+
+    Each line on the standard output starts with the prefix, so dom0 can
+    tell log records from other output and write them to its log during
+    the update.
+    """
+
+    def __init__(self, filename: str, prefix: str) -> None:
+        super().__init__(filename, encoding="utf-8")
+        self.prefix = prefix
+        # package managers may redirect stdout, keep the original one
+        self.side_stream = os.fdopen(
+            os.dup(sys.stdout.fileno()), "w", encoding="utf-8"
+        )
+
+    def emit(self, record: LogRecord) -> None:
+        super().emit(record)
+        try:
+            msg = self.format(record)
+            self.side_stream.write(
+                "".join(f"{self.prefix} {line}\n" for line in msg.split("\n"))
+            )
+            self.side_stream.flush()
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
 
 
 def init_logs(
@@ -37,6 +68,7 @@ def init_logs(
     level: str = "INFO",
     truncate_file: bool = False,
     qname: str | None = None,
+    stream_prefix: str | None = None,
 ) -> tuple[Logger, FileHandler, str, str, Formatter]:
     Path(directory).mkdir(parents=True, exist_ok=True)
     log_path = os.path.join(directory, file)
@@ -47,7 +79,11 @@ def init_logs(
             # Persistent logs are at dom0.
             pass
 
-    log_handler = logging.FileHandler(log_path, encoding="utf-8")
+    log_handler: FileHandler
+    if stream_prefix is not None:
+        log_handler = StreamedFileHandler(log_path, stream_prefix)
+    else:
+        log_handler = logging.FileHandler(log_path, encoding="utf-8")
     log_formatter = logging.Formatter(format_)
     log_handler.setFormatter(log_formatter)
 
@@ -74,6 +74,8 @@ class PACMANCLI(PackageManager):
         """
         Pacman will handle obsoletions itself
         """
+        if not self.install:
+            return ["--noconfirm", "-Syuw"]
         return ["--noconfirm", "-Syu"]
 
     def clean(self) -> int:
@@ -1,13 +1,11 @@
 import importlib
-import os.path
-import glob
+import pkgutil
 
-modules_str = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py")))
-__all__ = [
-    os.path.basename(f)[:-3]
-    for f in modules_str
-    if os.path.isfile(f) and not f.endswith("__init__.py")
-]
+# plugins are found by the import system, so the agent could be run
+# from a zipapp as well as from a directory
+__all__ = sorted(
+    module.name for module in pkgutil.iter_modules(__path__) if not module.ispkg
+)
 modules = [
     importlib.import_module("source.plugins." + name) for name in __all__
 ]
@@ -21,7 +21,7 @@
 
 from __future__ import annotations
 from enum import Enum
-from typing import Any, Self, cast
+from typing import Any, Iterator, Self, cast
 
 from qubesadmin.vm import QubesVM
 
@@ -76,3 +76,37 @@ class FormatedLine:
 
     def __str__(self) -> str:
         return f"{self.qname}:{self.stream}: {self.message}"
+
+
+class StatusBatch:
+    """
+    Status events of a qube sent together.
+
+    Consecutive progress updates of the same qube are merged,
+    only the latest value is kept.
+    """
+
+    def __init__(self) -> None:
+        self.events: list[StatusInfo | FormatedLine] = []
+
+    def add(self, event: StatusInfo | FormatedLine) -> None:
+        if (
+            isinstance(event, StatusInfo)
+            and event.status == Status.UPDATING
+            and self.events
+        ):
+            last = self.events[-1]
+            if (
+                isinstance(last, StatusInfo)
+                and last.status == Status.UPDATING
+                and last.qname == event.qname
+            ):
+                self.events[-1] = event
+                return
+        self.events.append(event)
+
+    def __iter__(self) -> Iterator[StatusInfo | FormatedLine]:
+        return iter(self.events)
+
+    def __len__(self) -> int:
+        return len(self.events)
@@ -0,0 +1,136 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+Archive of the update agent transferred to qubes.
+
+The archive is a zipapp, executed by `python3` without extraction
+(only modules used by the qube are loaded). It is built once and kept
+in the cache directory under a name derived from the content of the agent,
+so all workers (and subsequent runs) share it until the agent changes.
+"""
+
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+import zipapp
+from typing import Iterator, Optional
+
+ARCHIVE_PREFIX = "agent-"
+ARCHIVE_SUFFIX = ".pyz"
+
+_LOCK = threading.Lock()
+_BUILT: dict[tuple[str, str], str] = {}
+
+
+def cache_dir() -> str:
+    """
+    Return the directory for cached archives.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "qubes-vm-update")
+
+
+def _files(src_dir: str) -> Iterator[str]:
+    """
+    Yield relative paths of agent files in a stable order.
+    """
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(files):
+            if _included(name):
+                yield os.path.relpath(os.path.join(root, name), src_dir)
+
+
+def _included(name: str) -> bool:
+    return not name.endswith(".pyc")
+
+
+def _filter(path: pathlib.Path) -> bool:
+    return "__pycache__" not in path.parts and _included(path.name)
+
+
+def digest(src_dir: str) -> str:
+    """
+    Return a hash of names and content of agent files.
+    """
+    sha = hashlib.sha256()
+    for rel_path in _files(src_dir):
+        sha.update(rel_path.encode() + b"\0")
+        with open(os.path.join(src_dir, rel_path), "rb") as file:
+            sha.update(hashlib.sha256(file.read()).digest())
+    return sha.hexdigest()
+
+
+def build(src_dir: str, directory: Optional[str] = None) -> str:
+    """
+    Return path to the archive of `src_dir`, build it if needed.
+
+    `src_dir` has to contain `__main__.py`.
+    Archives of previous versions of the agent are removed.
+    """
+    directory = directory or cache_dir()
+    key = (src_dir, directory)
+    with _LOCK:
+        path = _BUILT.get(key)
+        if path is not None and os.path.exists(path):
+            return path
+
+        name = ARCHIVE_PREFIX + digest(src_dir)[:16] + ARCHIVE_SUFFIX
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            _write(src_dir, directory, path)
+            _prune(directory, keep=name)
+        _BUILT[key] = path
+        return path
+
+
+def _write(src_dir: str, directory: str, path: str) -> None:
+    # other processes may build the same archive, so it is written
+    # under a temporary name and atomically renamed
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            zipapp.create_archive(
+                src_dir, file, filter=_filter, compressed=True
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _prune(directory: str, keep: str) -> None:
+    for name in os.listdir(directory):
+        if (
+            name.startswith(ARCHIVE_PREFIX)
+            and name.endswith(ARCHIVE_SUFFIX)
+            and name != keep
+        ):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
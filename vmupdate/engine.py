@@ -0,0 +1,134 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+In-process engine running updates of multiple qubes on one event loop.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Callable, Optional
+
+ENGINES = ("async", "pool")
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_event_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """
+    Return the event loop of the running `AsyncPool` if any.
+
+    Workers use it to read streams of qrexec processes of all qubes.
+    """
+    return _LOOP
+
+
+class Flag:
+    """
+    In-process replacement of `multiprocessing.Manager().Value("b", False)`.
+    """
+
+    def __init__(self, value: bool = False) -> None:
+        self.value = value
+
+
+class AsyncPool:
+    """
+    Replacement of `multiprocessing.Pool` based on a single event loop.
+
+    Blocking Admin API calls are run in worker threads, streams of qrexec
+    processes are read by the event loop. Callbacks are called in the worker
+    thread right after the task, so they never block the loop.
+    """
+
+    def __init__(self, processes: Optional[int] = None) -> None:
+        global _LOOP  # pylint: disable=global-statement
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=processes, thread_name_prefix="vm-update"
+        )
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="vm-update-loop", daemon=True
+        )
+        self.thread.start()
+        self.tasks = 0
+        self.closed = False
+        self.done = threading.Condition()
+        _LOOP = self.loop
+
+    def apply_async(
+        self,
+        func: Callable,
+        args: tuple = (),
+        callback: Optional[Callable[[Any], None]] = None,
+        error_callback: Optional[Callable[[BaseException], None]] = None,
+    ) -> None:
+        assert not self.closed
+        with self.done:
+            self.tasks += 1
+        self.loop.call_soon_threadsafe(
+            self.loop.create_task,
+            self._run(func, args, callback, error_callback),
+        )
+
+    async def _run(
+        self,
+        func: Callable,
+        args: tuple,
+        callback: Optional[Callable[[Any], None]],
+        error_callback: Optional[Callable[[BaseException], None]],
+    ) -> None:
+        def task() -> None:
+            try:
+                result = func(*args)
+            except Exception as exc:  # pylint: disable=broad-except
+                if error_callback is not None:
+                    error_callback(exc)
+            else:
+                if callback is not None:
+                    callback(result)
+
+        try:
+            await self.loop.run_in_executor(self.executor, task)
+        finally:
+            with self.done:
+                self.tasks -= 1
+                self.done.notify_all()
+
+    def close(self) -> None:
+        self.closed = True
+
+    def join(self) -> None:
+        """
+        Wait for all tasks and stop the event loop.
+        """
+        global _LOOP  # pylint: disable=global-statement
+        assert self.closed
+        with self.done:
+            self.done.wait_for(lambda: not self.tasks)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown()
+        self.loop.close()
+        if _LOOP is self.loop:
+            _LOOP = None
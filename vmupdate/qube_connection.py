@@ -20,39 +20,188 @@
 # USA.
 
 import argparse
-import os
-import shutil
-import signal
+import asyncio
+import secrets
 import subprocess
-import tempfile
+import threading
+import time
 import concurrent.futures
-from os.path import join
+from os.path import join, split
 from subprocess import CalledProcessError
 from logging import Logger
-from typing import List, Self, Any, Type
+from typing import IO, Callable, List, Optional, Self, Any, Type
 
 import qubesadmin
 import qubesadmin.exc
 from qubesadmin.vm import QubesVM
 from vmupdate.agent.source.args import AgentArgs
-from vmupdate.agent.source.log_config import LOGPATH, LOG_FILE
-from vmupdate.agent.source.status import StatusInfo, FinalStatus, FormatedLine
+from vmupdate.agent.source.log_config import LOGPATH, LOG_FILE, TRACE_FILE
+from vmupdate.agent.source.status import (
+    StatusInfo,
+    FinalStatus,
+    FormatedLine,
+    StatusBatch,
+)
 from vmupdate.agent.source.common.process_result import ProcessResult
+from vmupdate.agent.source.common.tracing import Tracer
+from vmupdate.engine import get_event_loop
+from vmupdate.timings import timed
 from vmupdate.utils import shutdown_domains
 
 
+class NotEnoughMemoryError(Exception):
+    """
+    The qube cannot be started because there is not enough free memory.
+    """
+
+    def __init__(self, qube_name: str, message: str) -> None:
+        super().__init__(qube_name, message)
+        self.qube_name = qube_name
+        self.message = message
+
+    def __str__(self) -> str:
+        return f"Not enough memory to start {self.qube_name}: {self.message}"
+
+
+class StatusBatcher:
+    """
+    Send status events in batches instead of one by one.
+
+    A batch is sent `INTERVAL` seconds after its first event or when it
+    reaches `MAX_EVENTS`, whichever comes first. `flush` sends the rest.
+    Within an event loop, the batch is sent by a callback of the loop.
+    Otherwise, it is sent by a single flusher thread, started with the
+    first event and stopped by `close`.
+    """
+
+    INTERVAL = 0.05
+    MAX_EVENTS = 64
+
+    def __init__(self, status_notifier: Any) -> None:
+        self.status_notifier = status_notifier
+        self._batch = StatusBatch()
+        self._started = 0.0
+        self._cond = threading.Condition()
+        self._handle: Optional[
+            tuple[asyncio.AbstractEventLoop, asyncio.TimerHandle]
+        ] = None
+        self._flusher: Optional[threading.Thread] = None
+
+    def put(self, event: StatusInfo | FormatedLine) -> None:
+        with self._cond:
+            first = not self._batch
+            self._batch.add(event)
+            if len(self._batch) >= StatusBatcher.MAX_EVENTS:
+                self._send()
+            elif first:
+                self._started = time.monotonic()
+                self._schedule()
+
+    def _schedule(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._run_flusher, name="status-flusher", daemon=True
+                )
+                self._flusher.start()
+            self._cond.notify()
+            return
+        self._handle = (
+            loop,
+            loop.call_later(StatusBatcher.INTERVAL, self.flush),
+        )
+
+    def _run_flusher(self) -> None:
+        with self._cond:
+            while self._flusher is threading.current_thread():
+                if not self._batch:
+                    self._cond.wait()
+                    continue
+                remaining = (
+                    self._started + StatusBatcher.INTERVAL - time.monotonic()
+                )
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._send()
+
+    def flush(self) -> None:
+        with self._cond:
+            self._send()
+
+    def close(self) -> None:
+        """
+        Send the rest and stop the flusher thread.
+        """
+        with self._cond:
+            self._send()
+            flusher, self._flusher = self._flusher, None
+            self._cond.notify()
+        if flusher is not None:
+            flusher.join()
+
+    def _send(self) -> None:
+        if self._handle is not None:
+            loop, handle = self._handle
+            self._handle = None
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                handle.cancel()
+            else:
+                # TimerHandle is not thread-safe
+                try:
+                    loop.call_soon_threadsafe(handle.cancel)
+                except RuntimeError:
+                    # the loop is closed, the callback will not run anyway
+                    pass
+        if self._batch:
+            self.status_notifier.put(self._batch)
+            self._batch = StatusBatch()
+
+
 class QubeConnection:
     """
     Run scripts in the qube.
 
     1. Initialize the state of connection.
-    2. Transfer files to a new directory, start the qube if not running.
+    2. Start the qube if not running, transfer the agent to a path named
+       after its version unless the qube already has it.
     3. Run an entrypoint script, return the output.
-    4. On close, remove the created directory,
+    4. On close, remove other versions of transferred files,
        stop the qube if it was started by this connection.
     """
 
     PYTHON_PATH = "/usr/bin/python3"
+    # maximal length of a line read from the agent by the event loop
+    STREAM_LIMIT = 2**20
+    # write the archive from stdin (unless already there), run the command,
+    # remove other versions and print files, each after the marker
+    BOOTSTRAP = r"""
+dest="$1" cleanup="$2" marker="$3"
+shift 3
+files=""
+while [ "$1" != "--" ]; do files="$files $1"; shift; done
+shift
+if [ -e "$dest" ]; then
+    cat > /dev/null
+else
+    { mkdir -p "${dest%/*}" && cat > "$dest.part" && mv "$dest.part" "$dest"; } \
+        || { echo "Cannot install $dest" >&2; exit 1; }
+fi
+"$@" < /dev/null
+code=$?
+if [ "$cleanup" = 1 ]; then
+    find "${dest%/*}" -mindepth 1 -maxdepth 1 ! -name "${dest##*/}" \
+        -exec rm -r {} +
+fi
+for file in $files; do printf '\n%s\n' "$marker"; cat "$file" 2>/dev/null; done
+exit $code
+"""
 
     def __init__(
         self,
@@ -62,6 +211,9 @@ class QubeConnection:
         logger: Logger,
         show_progress: bool,
         status_notifier: Any,
+        prestarted: bool = False,
+        tracer: Optional[Tracer] = None,
+        agent_log: Optional[Callable[[str], None]] = None,
     ) -> None:
         self.qube = qube
         self.dest_dir = dest_dir
@@ -69,15 +221,56 @@ class QubeConnection:
         self.logger = logger
         self.show_progress = show_progress
         self.status_notifier = status_notifier
+        # events from the agent output are sent in batches
+        self._batcher = StatusBatcher(status_notifier)
         self.status = FinalStatus.ERROR
+        # started in advance by the caller, handled as not running before
+        self.prestarted = prestarted
         self._initially_running = None
+        self._progress_finished = False
+        # output of the bootstrap is split into sections by the marker
+        self._marker: Optional[str] = None
+        self._sections: list[list[str]] = []
+        # durations of update phases in seconds
+        self.timings: dict[str, float] = {}
+        # spans of update phases, disabled unless given by the caller
+        self.tracer = tracer or Tracer(enabled=False)
+        # called with each line of the agent log as soon as it is written,
+        # the agent prints them to stdout after the prefix
+        self.agent_log = agent_log
+        self._log_prefix: Optional[str] = None
+        if agent_log is not None:
+            self._log_prefix = secrets.token_hex(8)
         self.__connected = False
 
     def __enter__(self) -> Self:
-        self._initially_running = self.qube.is_running()
+        running = self.qube.is_running()
+        self._initially_running = running and not self.prestarted
+        if not running:
+            with timed(self.timings, "start", self.tracer):
+                self._start()
         self.__connected = True
         return self
 
+    def _start(self) -> None:
+        """
+        Start the qube, distinguish failures caused by lack of memory.
+
+        Other failures are only logged, qrexec will try to start the qube
+        with the first command anyway.
+        """
+        self.logger.info("Start %s", self.qube.name)
+        try:
+            self.qube.start()
+        except qubesadmin.exc.QubesMemoryError as err:
+            raise NotEnoughMemoryError(self.qube.name, str(err)) from err
+        except qubesadmin.exc.QubesVMError as err:
+            self.logger.error(
+                "Cannot start %s, because of error: %s",
+                self.qube.name,
+                str(err),
+            )
+
     def __exit__(
         self,
         exc_type: Type[BaseException],
@@ -89,35 +282,39 @@ class QubeConnection:
 
         1. If a progress collector is provided, send a signal that the update
            has been completed.
-        2. Delete the uploaded files from the updated qube.
+        2. Delete obsolete files from the workdir of the updated qube,
+           the current version is kept to be reused by the next update.
         3. Shut down qube if it wasn't running before the update.
         """
         self.status_notifier.put(StatusInfo.done(self.qube, self.status))
 
         if self.cleanup:
-            self.logger.info("Remove %s", self.dest_dir)
+            assert self.dest_dir is not None
+            workdir, current = split(self.dest_dir)
+            self.logger.info("Remove obsolete files from %s", workdir)
+            command = ["find", workdir, "-mindepth", "1", "-maxdepth", "1"]
+            command += ["!", "-name", current, "-exec", "rm", "-r", "{}", "+"]
             try:
-                assert self.dest_dir is not None
-                self._run_shell_command_in_qube(
-                    self.qube, ["rm", "-r", self.dest_dir]
-                )
+                with timed(self.timings, "cleanup", self.tracer):
+                    self._run_shell_command_in_qube(self.qube, command)
             except Exception as err:
                 self.logger.error(
-                    "Cannot remove %s, because of error: %s",
-                    self.dest_dir,
+                    "Cannot remove files from %s, because of error: %s",
+                    workdir,
                     str(err),
                 )
 
         if self.qube.is_running() and not self._initially_running:
-            if self._has_assigned_pci_devices(self.qube):
-                self.logger.info(
-                    "Waiting for full shutdown %s (PCI devices assigned)",
-                    self.qube.name,
-                )
-                shutdown_domains([self.qube], self.logger)
-            else:
-                self.logger.info("Shutdown %s", self.qube.name)
-                self.qube.shutdown()
+            with timed(self.timings, "shutdown", self.tracer):
+                if self._has_assigned_pci_devices(self.qube):
+                    self.logger.info(
+                        "Waiting for full shutdown %s (PCI devices assigned)",
+                        self.qube.name,
+                    )
+                    shutdown_domains([self.qube], self.logger)
+                else:
+                    self.logger.info("Shutdown %s", self.qube.name)
+                    self.qube.shutdown()
 
         self.__connected = False
 
@@ -129,56 +326,67 @@ class QubeConnection:
         except qubesadmin.exc.QubesDaemonAccessError:
             return False
 
-    def transfer_agent(self, src_dir: str) -> ProcessResult:
+    def transfer_agent(self, src_arch: str) -> ProcessResult:
         """
-        Copy a directory content to the workdir in the qube.
+        Copy an archive to the workdir in the qube.
 
-        :param src_dir: str: path to local (dom0) directory
+        The destination is named after the version of the archive, so
+        nothing is transferred if the qube already has it. The archive is
+        written under a temporary name first, so an interrupted transfer
+        is never taken for a complete one.
+
+        :param src_arch: str: path to local (dom0) archive,
+                         see `vmupdate.bundle`
         """
         assert self.__connected  # open the connection first
         assert self.dest_dir is not None
 
-        arch_format = ".tar.gz"
-
-        arch_dir = tempfile.mkdtemp()
-        root_dir = os.path.dirname(src_dir)
-        base_dir = os.path.basename(src_dir.strip(os.sep))
-        src_arch = join(arch_dir, base_dir + arch_format)
-        dest_arch = join(self.dest_dir, base_dir + arch_format)
-        shutil.make_archive(
-            base_name=join(arch_dir, base_dir),
-            format="gztar",
-            root_dir=root_dir,
-            base_dir=base_dir,
-        )
-
-        command = ["mkdir", "-p", self.dest_dir]
-        result = self._run_shell_command_in_qube(self.qube, command)
-        if result:
-            return result
-
-        result += self._copy_file_from_dom0(src_arch, dest_arch)
-        if result:
-            return result
-
-        command = ["tar", "-xzf", dest_arch, "-C", self.dest_dir]
-        result += self._run_shell_command_in_qube(self.qube, command)
-        return result
+        # /run of a qube started for this update is always empty
+        if self._initially_running and self._has_dest():
+            self.logger.info("%s already present, skip transfer", self.dest_dir)
+            return ProcessResult()
+
+        command = [
+            "sh",
+            "-c",
+            'mkdir -p "${2%/*}" && cat > "$1" && mv "$1" "$2"',
+            "sh",
+            self.dest_dir + ".part",
+            self.dest_dir,
+        ]
+        return self._stream_file_from_dom0(src_arch, command)
+
+    def _has_dest(self) -> bool:
+        assert self.dest_dir is not None
+        try:
+            self.qube.run_with_args("test", "-e", self.dest_dir, user="root")
+        except (CalledProcessError, qubesadmin.exc.QubesException):
+            return False
+        return True
 
-    def _copy_file_from_dom0(self, src: str, dest: str) -> ProcessResult:
-        write_dest = ["cat", ">", dest]
-        command = " ".join(write_dest)
-        self.logger.debug("run command: %s < %s", command, src)
+    def _stream_file_from_dom0(
+        self, src: str, command: List[str]
+    ) -> ProcessResult:
+        """
+        Run the command in the qube with the file on its standard input.
+        """
+        self.logger.debug("run command: %s < %s", " ".join(command), src)
         try:
             with open(src, "rb") as file:
-                untrusted_stdout_and_stderr = self.qube.run(
-                    command, user="root", input=file.read()
-                )
-                result = ProcessResult.from_untrusted_out_err(
-                    *untrusted_stdout_and_stderr
+                proc = self.qube.run_service(
+                    "qubes.VMExec+"
+                    + qubesadmin.utils.encode_for_vmexec(command),
+                    user="root",
+                    stdin=file,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
                 )
-            if result.code:
-                raise OSError(f"Command returns code: {result.code}")
+                untrusted_stdout_and_stderr = proc.communicate()
+            result = ProcessResult.from_untrusted_out_err(
+                *untrusted_stdout_and_stderr
+            )
+            if proc.returncode:
+                raise OSError(f"Command returns code: {proc.returncode}")
         except OSError as exc:
             result = ProcessResult(1, str(exc))
 
@@ -190,23 +398,141 @@ class QubeConnection:
         """
         Run a script in the qube.
 
-        :param entrypoint_path: path to the entrypoint.py in the qube
+        :param entrypoint_path: path to the agent in the qube
+                                (entrypoint.py or its archive)
         :param agent_args: args for agent entrypoint
         :return: return code and output of the script
         """
         if isinstance(entrypoint_path, str):
-            command = [
-                QubeConnection.PYTHON_PATH,
-                entrypoint_path,
-                *AgentArgs.to_cli_args(agent_args),
-            ]
+            command = self._agent_command(entrypoint_path, agent_args)
         else:
             command = entrypoint_path
 
         result = self._run_shell_command_in_qube(
             self.qube, command, show=self.show_progress
         )
+        if isinstance(entrypoint_path, str):
+            result.out = self._take_agent_log(result.out)
+            result.err = self._take_agent_log(result.err, forward=False)
+
+        return result
+
+    def _agent_command(
+        self, entrypoint_path: str, agent_args: argparse.Namespace
+    ) -> List[str]:
+        command = [
+            QubeConnection.PYTHON_PATH,
+            entrypoint_path,
+            *AgentArgs.to_cli_args(agent_args),
+        ]
+        if self._log_prefix is not None:
+            command += ["--log-stream", self._log_prefix]
+        return command
+
+    def _take_agent_log(
+        self, untrusted_output: str, forward: bool = True
+    ) -> str:
+        """
+        Remove lines of the agent log from the output.
+
+        If `forward`, they are passed to `agent_log`.
+        """
+        if self._log_prefix is None:
+            return untrusted_output
+        prefix = self._log_prefix + " "
+        untrusted_lines = []
+        for untrusted_line in untrusted_output.split("\n"):
+            if not untrusted_line.startswith(prefix):
+                untrusted_lines.append(untrusted_line)
+            elif forward:
+                assert self.agent_log is not None
+                self.agent_log(untrusted_line[len(prefix) :])
+        return "\n".join(untrusted_lines)
+
+    def bootstrap(
+        self,
+        src_arch: str,
+        agent_args: argparse.Namespace,
+    ) -> tuple[ProcessResult, str, str]:
+        """
+        Install the agent, run it and read its logs with a single call.
+
+        The archive is sent on the standard input of the call, it is
+        written to the workdir unless it is already there.
+
+        :param src_arch: path to local (dom0) archive, see `vmupdate.bundle`
+        :param agent_args: args for agent entrypoint
+        :return: result of the entrypoint, untrusted content of the agent
+                 log (unless streamed to `agent_log`) and of the trace
+                 (if `agent_args.trace`)
+        """
+        assert self.__connected  # open the connection first
+        assert self.dest_dir is not None
+        files = {}
+        if self.agent_log is None:
+            files["log"] = join(LOGPATH, LOG_FILE)
+        if agent_args.trace:
+            files["trace"] = join(LOGPATH, TRACE_FILE)
+        self._marker = secrets.token_hex(16)
+        self._sections = []
+        command = [
+            "sh",
+            "-c",
+            QubeConnection.BOOTSTRAP,
+            "sh",
+            self.dest_dir,
+            "1" if self.cleanup else "0",
+            self._marker,
+            *files.values(),
+            "--",
+            *self._agent_command(self.dest_dir, agent_args),
+        ]
+        self.logger.debug(
+            "run bootstrap in %s: %s", self.qube.name, self.dest_dir
+        )
+        try:
+            with open(src_arch, "rb") as file:
+                proc = self.qube.run_service(
+                    "qubes.VMExec+"
+                    + qubesadmin.utils.encode_for_vmexec(command),
+                    user="root",
+                    stdin=file,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True,
+                )
+                if self.show_progress:
+                    result = self._report_progress(proc)
+                else:
+                    result = self._wait_for_bootstrap(proc)
+        except (OSError, qubesadmin.exc.QubesException) as exc:
+            result = ProcessResult(1, "", str(exc))
+        else:
+            # already done by the bootstrap
+            self.cleanup = False
+        untrusted_files = dict(
+            zip(files, ("\n".join(lines) for lines in self._sections))
+        )
+        self._marker = None
+        return (
+            result,
+            untrusted_files.get("log", ""),
+            untrusted_files.get("trace", ""),
+        )
 
+    def _wait_for_bootstrap(self, proc: subprocess.Popen) -> ProcessResult:
+        untrusted_stdout, untrusted_stderr = proc.communicate()
+        result = ProcessResult.from_untrusted_out_err(
+            untrusted_stdout, untrusted_stderr
+        )
+        output, *sections = result.out.split(f"\n{self._marker}\n")
+        result.out = self._take_agent_log(output)
+        result.err = self._take_agent_log(result.err, forward=False)
+        self._sections = [section.split("\n") for section in sections]
+        result.code = proc.returncode
+        if result.code == 100:
+            self.status = FinalStatus.NO_UPDATES
+            result.code = 0
         return result
 
     def read_logs(self) -> ProcessResult:
@@ -217,6 +543,14 @@ class QubeConnection:
         result = self._run_shell_command_in_qube(self.qube, command)
         return result
 
+    def read_trace(self) -> ProcessResult:
+        """
+        Read the trace file written by the agent run with `--trace`.
+        """
+        command = ["cat", str(join(LOGPATH, TRACE_FILE))]
+        result = self._run_shell_command_in_qube(self.qube, command)
+        return result
+
     def _run_shell_command_in_qube(
         self, target: QubesVM, command: List[str], show: bool = False
     ) -> ProcessResult:
@@ -271,6 +605,8 @@ class QubeConnection:
         self, target: QubesVM, command: List[str]
     ) -> ProcessResult:
         self.logger.debug("Progress reporting enabled.")
+        # a new session keeps SIGINT from the terminal away from the qrexec
+        # client; unlike preexec_fn, it is safe with many threads running
         if self.qube.klass == "AdminVM":
             proc = subprocess.Popen(
                 command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
@@ -281,24 +617,38 @@ class QubeConnection:
                 "qubes.VMExec+"
                 + qubesadmin.utils.encode_for_vmexec(["fakeroot"] + command),
                 user="user",
-                preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_IGN),
+                start_new_session=True,
             )
         else:
             proc = target.run_service(
                 "qubes.VMExec+" + qubesadmin.utils.encode_for_vmexec(command),
                 user="root",
-                preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_IGN),
+                start_new_session=True,
             )
+        return self._report_progress(proc)
 
+    def _report_progress(self, proc: subprocess.Popen) -> ProcessResult:
         self.logger.debug("Fetching agent process stdout/stderr.")
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            # Submit the methods to the executor
-            future_err = executor.submit(self._collect_stderr, proc=proc)
-            future_out = executor.submit(self._collect_stdout, proc=proc)
+        self._progress_finished = False
+        loop = get_event_loop()
+        if loop is not None:
+            # read streams of all qubes by one event loop
+            asyncio.run_coroutine_threadsafe(
+                self._collect_streams(proc), loop
+            ).result()
+            result = ProcessResult()
+        else:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                # Submit the methods to the executor
+                future_err = executor.submit(self._collect_stderr, proc=proc)
+                future_out = executor.submit(self._collect_stdout, proc=proc)
 
-            result = ProcessResult.from_untrusted_out_err(
-                future_out.result(), future_err.result()
-            )
+                try:
+                    result = ProcessResult.from_untrusted_out_err(
+                        future_out.result(), future_err.result()
+                    )
+                finally:
+                    self._batcher.close()
 
         result.code = proc.wait()
         self.logger.debug("Agent process finished.")
@@ -307,57 +657,101 @@ class QubeConnection:
             result.code = 0
         return result
 
+    async def _collect_streams(self, proc: subprocess.Popen) -> None:
+        try:
+            await asyncio.gather(
+                self._read_stream(
+                    proc.stdout, self._handle_stdout_line, "stdout"
+                ),
+                self._read_stream(
+                    proc.stderr, self._handle_stderr_line, "stderr"
+                ),
+            )
+        finally:
+            self._batcher.flush()
+
+    async def _read_stream(
+        self,
+        pipe: Optional[IO[bytes]],
+        handle: Callable[[bytes], None],
+        name: str,
+    ) -> None:
+        if pipe is None:
+            return
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=QubeConnection.STREAM_LIMIT)
+        transport, _protocol = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe
+        )
+        try:
+            while True:
+                try:
+                    untrusted_line = await reader.readline()
+                except ValueError:
+                    # too long line is dropped
+                    continue
+                if not untrusted_line:
+                    break
+                handle(untrusted_line)
+        finally:
+            transport.close()
+        self.logger.debug("Agent %s closed.", name)
+
     def _collect_stderr(self, proc: subprocess.Popen) -> bytes:
-        progress_finished = False
         if proc.stderr is None:
             return b""
         for untrusted_line in iter(proc.stderr.readline, b""):
-            if not untrusted_line:
-                continue
-            line = ProcessResult.sanitize_output(untrusted_line, single=True)
-            if not line:
-                continue
-            if not progress_finished:
-                try:
-                    progress = float(line)
-                except ValueError:
-                    try:
-                        progress = float(line.split()[-1])
-                    except ValueError:
-                        self.status_notifier.put(
-                            FormatedLine(self.qube.name, "err", line)
-                        )
-                        continue
-
-                if progress == 100.0:
-                    progress_finished = True
-                self.status_notifier.put(
-                    StatusInfo.updating(self.qube, progress)
-                )
-            else:
-                self.status_notifier.put(
-                    FormatedLine(self.qube.name, "err", line)
-                )
+            self._handle_stderr_line(untrusted_line)
 
         proc.stderr.close()
         self.logger.debug("Agent stderr closed.")
 
         return b""
 
+    def _handle_stderr_line(self, untrusted_line: bytes) -> None:
+        if not untrusted_line:
+            return
+        line = ProcessResult.sanitize_output(untrusted_line, single=True)
+        if not line:
+            return
+        if not self._progress_finished:
+            try:
+                progress = float(line)
+            except ValueError:
+                try:
+                    progress = float(line.split()[-1])
+                except (ValueError, IndexError):
+                    self._batcher.put(FormatedLine(self.qube.name, "err", line))
+                    return
+
+            if progress == 100.0:
+                self._progress_finished = True
+            self._batcher.put(StatusInfo.updating(self.qube, progress))
+        else:
+            self._batcher.put(FormatedLine(self.qube.name, "err", line))
+
     def _collect_stdout(self, proc: subprocess.Popen) -> bytes:
         if proc.stdout is None:
             return b""
         for untrusted_line in iter(proc.stdout.readline, b""):
-            if untrusted_line:
-                line = ProcessResult.sanitize_output(
-                    untrusted_line, single=True
-                )
-                if line:
-                    self.status_notifier.put(
-                        FormatedLine(self.qube.name, "out", line)
-                    )
+            self._handle_stdout_line(untrusted_line)
 
         proc.stdout.close()
         self.logger.debug("Agent stdout closed.")
 
         return b""
+
+    def _handle_stdout_line(self, untrusted_line: bytes) -> None:
+        if untrusted_line:
+            line = ProcessResult.sanitize_output(untrusted_line, single=True)
+            if self._log_prefix is not None and line.startswith(
+                self._log_prefix + " "
+            ):
+                assert self.agent_log is not None
+                self.agent_log(line[len(self._log_prefix) + 1 :])
+            elif self._marker is not None and line == self._marker:
+                self._sections.append([])
+            elif self._sections:
+                self._sections[-1].append(line)
+            elif line:
+                self._batcher.put(FormatedLine(self.qube.name, "out", line))
@@ -18,12 +18,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
+import contextlib
 import itertools
 import queue
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import pytest
 
+import qubesadmin.exc
+
+from vmupdate import vmupdate
+from vmupdate.agent.source.common.exit_codes import EXIT
 from vmupdate.agent.source.common.process_result import ProcessResult
 from vmupdate.agent.source.status import StatusInfo, FinalStatus
 
@@ -33,9 +38,15 @@ class TestApp:
         def __iter__(self):
             return iter(self.values())
 
+        def get_blind(self, name):
+            return self[name]
+
     def __init__(self):
         self.domains = TestApp.Domains()
 
+    def qubesd_call(self, dest, method, arg=None, payload=None):
+        raise qubesadmin.exc.QubesDaemonAccessError(method)
+
 
 class TestVM:
     def __init__(self, name, app, klass, template=None, **kwargs):
@@ -46,6 +57,7 @@ class TestVM:
         self.running = True
         if self.klass in ("AppVM", "DispVM"):
             template.derived_vms.append(self)
+            self.template = template
         self.derived_vms = []
         self.auto_cleanup = False
         self.features = Features(name, app)
@@ -90,7 +102,7 @@ class MPManager:
         def __init__(self):
             self._queue = []
 
-        def get(self, block):
+        def get(self, block=True, timeout=None):
             if not self._queue:
                 raise queue.Empty
             return self._queue.pop(0)
@@ -98,6 +110,9 @@ class MPManager:
         def put(self, obj):
             self._queue.append(obj)
 
+    def shutdown(self):
+        pass
+
 
 @pytest.fixture()
 def test_manager():
@@ -105,8 +120,13 @@ def test_manager():
 
 
 class MPPool(Mock):
-    def apply_async(self, func, args, *, callback, **_kwargs):
-        callback(func(*args))
+    def apply_async(self, func, args, *, callback, error_callback, **_kwargs):
+        try:
+            result = func(*args)
+        except Exception as exc:
+            error_callback(exc)
+        else:
+            callback(result)
 
 
 @pytest.fixture()
@@ -122,12 +142,35 @@ def test_qapp():
 
 @pytest.fixture()
 def test_agent():
-    def closure(results, unexpected):
+    def closure(results, unexpected, order=None):
         class UpdateAgentManager:
-            def __init__(self, app, qube, agent_args, show_progress, dom0):
+            def __init__(
+                self,
+                app,
+                qube,
+                agent_args,
+                show_progress,
+                dom0,
+                prestarted=False,
+            ):
                 self.qube = qube
+                self.timings = {}
+                self.spans = []
+                if agent_args.trace:
+                    self.spans.append(
+                        {
+                            "name": "update",
+                            "ph": "X",
+                            "ts": 0,
+                            "dur": 1,
+                            "pid": qube.name,
+                            "tid": "dom0",
+                        }
+                    )
 
             def run_agent(self, agent_args, status_notifier, termination):
+                if order is not None:
+                    order.append(self.qube.name)
                 if self.qube.name not in results:
                     status_notifier.put(
                         StatusInfo.done(self.qube, FinalStatus.UNKNOWN)
@@ -145,6 +188,72 @@ def test_agent():
     return closure
 
 
+class UpdateRun:
+    """
+    Run `main` for given targets with mocked logging, processes and agent.
+
+    By default every target is updated successfully, `feed` of a call maps
+    names of qubes to their statuses and exit code instead. Names of updated
+    qubes are collected in `order`.
+    """
+
+    def __init__(self, app, agent, monkeypatch, mp_manager, mp_pool, agent_mng):
+        self.app = app
+        self.monkeypatch = monkeypatch
+        self.mp_manager = mp_manager
+        self.mp_pool = mp_pool
+        self.agent_mng = agent_mng
+        self.feed = {}
+        self.unexpected = []
+        self.order = []
+        # agent feeding results, base for agents of particular tests
+        self.Agent = agent(self.feed, self.unexpected, self.order)
+
+    def __call__(self, targets, *args, feed=None, agent=None, pool=None):
+        if feed is None:
+            feed = {
+                vm.name: {"statuses": [FinalStatus.SUCCESS], "retcode": EXIT.OK}
+                for vm in targets
+            }
+        self.feed.update(feed)
+        self.agent_mng.side_effect = agent or self.Agent
+        if pool is not None:
+            self.mp_pool.return_value = pool
+        self.monkeypatch.setattr(vmupdate, "get_targets", lambda *_: targets)
+
+        retcode = vmupdate.main(args, self.app)
+
+        # each qube got exactly its result
+        assert not self.unexpected
+        assert not self.feed
+        return retcode
+
+
+@pytest.fixture()
+def update_run(test_qapp, test_manager, test_pool, test_agent, monkeypatch):
+    with contextlib.ExitStack() as stack:
+        for target in (
+            "vmupdate.update_manager.TerminalMultiBar.print",
+            "os.chmod",
+            "os.chown",
+            "logging.FileHandler",
+            "logging.getLogger",
+        ):
+            stack.enter_context(patch(target))
+        agent_mng = stack.enter_context(
+            patch("vmupdate.update_manager.UpdateAgentManager")
+        )
+        mp_pool = stack.enter_context(
+            patch("multiprocessing.Pool", return_value=test_pool)
+        )
+        mp_manager = stack.enter_context(
+            patch("multiprocessing.Manager", return_value=test_manager)
+        )
+        yield UpdateRun(
+            test_qapp, test_agent, monkeypatch, mp_manager, mp_pool, agent_mng
+        )
+
+
 def generate_vm_variations(app, variations, include_cancelled=False):
     """
     Generate all possible variations of vms for the given list of features.
@@ -0,0 +1,159 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+import argparse
+import importlib
+import os
+from unittest.mock import Mock
+
+import pytest
+
+import vmupdate.agent
+from vmupdate.agent.source.args import AgentArgs
+from vmupdate.agent.source.common.exit_codes import EXIT
+from vmupdate.agent.source.common.package_manager import (
+    AgentType,
+    PackageManager,
+)
+from vmupdate.agent.source.common.process_result import ProcessResult
+
+
+class Transaction(PackageManager):
+    CHANGES_FROM_TRANSACTION = True
+
+    def __init__(self):
+        super().__init__(Mock(level=0), 0, AgentType.VM)
+        self.get_packages = Mock(return_value={"a": ["1-1"], "b": ["1-1"]})
+        self.install_requirements = Mock(return_value=ProcessResult())
+
+    def refresh(self, hard_fail):
+        return ProcessResult()
+
+    def upgrade_internal(self, remove_obsolete):
+        self.record_changes(
+            removed={"a": ["1-1"], "c": ["1-1"], "d": ["1-1"]},
+            installed={"a": ["2-1"], "b": ["1-1"], "d": ["1-1"]},
+        )
+        return ProcessResult()
+
+
+def test_changes_from_transaction():
+    pkg_mng = Transaction()
+    result = pkg_mng._upgrade(  # pylint: disable=protected-access
+        refresh=True, hard_fail=True, remove_obsolete=True
+    )
+
+    pkg_mng.get_packages.assert_not_called()
+    assert result.code == EXIT.OK
+    assert result.out.endswith(
+        "Installed packages:\n"
+        "b ['1-1']\n"
+        "Updated packages:\n"
+        "a 1-1 -> 2-1\n"
+        "Removed packages:\n"
+        "c ['1-1']\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "installed, code", (({"b": ["1-1"]}, EXIT.OK), ({}, EXIT.OK_NO_UPDATES))
+)
+def test_changes_with_requirements_are_compared(installed, code):
+    pkg_mng = Transaction()
+    pkg_mng.get_packages.side_effect = [
+        {"a": ["1-1"]},
+        {"a": ["1-1"], **installed},
+    ]
+    result = pkg_mng._upgrade(  # pylint: disable=protected-access
+        refresh=False,
+        hard_fail=True,
+        remove_obsolete=True,
+        requirements={"a": "1"},
+    )
+
+    assert pkg_mng.get_packages.call_count == 2
+    assert result.code == code
+
+
+def test_download_without_install():
+    pkg_mng = Transaction()
+    pkg_mng.install = False
+    pkg_mng.upgrade_internal = Mock(return_value=ProcessResult())
+    result = pkg_mng._upgrade(  # pylint: disable=protected-access
+        refresh=True,
+        hard_fail=True,
+        remove_obsolete=True,
+        requirements={"a": "1"},
+    )
+
+    pkg_mng.get_packages.assert_not_called()
+    pkg_mng.install_requirements.assert_not_called()
+    pkg_mng.upgrade_internal.assert_called_once_with(True)
+    assert result.code == EXIT.OK
+    assert not result.out
+
+
+@pytest.mark.parametrize(
+    "policy, commands",
+    (
+        pytest.param(
+            "always",
+            [
+                ["dnf", "-q", "clean", "expire-cache"],
+                [
+                    "dnf",
+                    "-q",
+                    "check-update",
+                    "--assumeyes",
+                    "--setopt=skip_if_unavailable=0",
+                ],
+            ],
+        ),
+        pytest.param(
+            "changed",
+            [
+                [
+                    "dnf",
+                    "-q",
+                    "makecache",
+                    "--refresh",
+                    "--setopt=skip_if_unavailable=0",
+                ],
+            ],
+        ),
+    ),
+)
+def test_dnf_cli_refresh_policy(policy, commands, monkeypatch):
+    # the agent imports its modules from its own directory
+    monkeypatch.syspath_prepend(os.path.dirname(vmupdate.agent.__file__))
+    dnf_cli = importlib.import_module("source.dnf.dnf_cli")
+    monkeypatch.setattr(dnf_cli.shutil, "which", lambda _: "/usr/bin/dnf")
+    parser = argparse.ArgumentParser()
+    AgentArgs.add_arguments(parser)
+    args = parser.parse_args(["--refresh-policy", policy])
+
+    pkg_mng = dnf_cli.DNFCLI(Mock(level=0), 0, dnf_cli.AgentType.VM)
+    pkg_mng.refresh_policy = args.refresh_policy
+    pkg_mng.run_cmd = Mock(return_value=dnf_cli.ProcessResult())
+    result = pkg_mng.refresh(hard_fail=True)
+
+    assert result.code == EXIT.OK
+    assert [call.args[0] for call in pkg_mng.run_cmd.call_args_list] == commands
@@ -0,0 +1,146 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+import pickle
+import random
+
+import pytest
+
+from vmupdate.agent.source.common.process_result import ProcessResult
+
+
+def reference_sanitize_output(untrusted_bytes, single=False):
+    """
+    The original implementation of `ProcessResult.sanitize_output`.
+    """
+    untrusted_str = untrusted_bytes.decode("ascii", errors="ignore")
+    return "".join(
+        [
+            c
+            for c in untrusted_str
+            if 0x20 <= ord(c) <= 0x7E or (c == "\n" and not single)
+        ]
+    )
+
+
+def random_bytes(rng, size):
+    # mostly text, sometimes control characters and non-ASCII bytes
+    alphabet = list(range(0x20, 0x7F)) * 4 + [0x0A] * 8 + list(range(256))
+    return bytes(rng.choice(alphabet) for _ in range(size))
+
+
+@pytest.mark.parametrize("single", (False, True))
+def test_sanitize_output_every_byte(single):
+    for byte in range(256):
+        untrusted_bytes = bytes([byte])
+        assert ProcessResult.sanitize_output(
+            untrusted_bytes, single
+        ) == reference_sanitize_output(untrusted_bytes, single)
+
+
+@pytest.mark.parametrize("single", (False, True))
+def test_sanitize_output_equivalence(single):
+    rng = random.Random(2025)
+    for _ in range(500):
+        untrusted_bytes = random_bytes(rng, rng.randrange(0, 300))
+        assert ProcessResult.sanitize_output(
+            untrusted_bytes, single
+        ) == reference_sanitize_output(untrusted_bytes, single)
+        assert ProcessResult.sanitize_output(
+            bytearray(untrusted_bytes), single
+        ) == reference_sanitize_output(untrusted_bytes, single)
+
+
+@pytest.mark.parametrize("single", (False, True))
+def test_sanitize_output_in_chunks(single):
+    rng = random.Random(2025)
+    for _ in range(100):
+        untrusted_bytes = random_bytes(rng, 1000)
+        cuts = sorted(rng.sample(range(1000), 10))
+        chunks = [
+            untrusted_bytes[begin:end]
+            for begin, end in zip([0] + cuts, cuts + [1000])
+        ]
+        assert "".join(
+            ProcessResult.sanitize_output(chunk, single) for chunk in chunks
+        ) == ProcessResult.sanitize_output(untrusted_bytes, single)
+
+
+@pytest.mark.parametrize("limit", (None, 0, 10, 2**24))
+def test_accumulated_output(monkeypatch, limit):
+    monkeypatch.setattr(ProcessResult, "MEMORY_LIMIT", limit)
+    result = ProcessResult(out="a\n", err="b\n")
+    expected_out, expected_err = "a\n", "b\n"
+    for i in range(100):
+        result += ProcessResult(i % 2, out=f"out {i}\n", err=f"err {i}\n")
+        expected_out += f"out {i}\n"
+        expected_err += f"err {i}\n"
+        if i % 10 == 0:
+            assert result.out == expected_out
+    assert result.code == 1
+    assert result.out == expected_out
+    assert result.err == expected_err
+
+    # reading does not break further accumulation
+    result += ProcessResult(out="last\n")
+    assert result.out == expected_out + "last\n"
+
+    result.out = "replaced"
+    assert result.out == "replaced"
+    assert result.err == expected_err
+
+
+def test_added_output_is_copied(monkeypatch):
+    monkeypatch.setattr(ProcessResult, "MEMORY_LIMIT", 4)
+    first = ProcessResult(out="first\n")
+    second = ProcessResult(2, out="second\n", err="err\n")
+    total = first + second
+    total += ProcessResult(out="third\n")
+    assert total.code == 2
+    assert total.out == "first\nsecond\nthird\n"
+    assert total.err == "err\n"
+    assert first.code == 0
+    assert first.out == "first\n"
+    assert not first.err
+
+
+def test_spilled_output_is_not_in_memory(monkeypatch):
+    monkeypatch.setattr(ProcessResult, "MEMORY_LIMIT", 100)
+    result = ProcessResult()
+    for _ in range(1000):
+        result += ProcessResult(out="x" * 10)
+    # pylint: disable=protected-access
+    assert result._out._file is not None
+    assert not result._out._chunks
+    assert result.out == "x" * 10000
+    assert not result.err
+
+
+@pytest.mark.parametrize("limit", (None, 4))
+def test_pickled_result(monkeypatch, limit):
+    monkeypatch.setattr(ProcessResult, "MEMORY_LIMIT", limit)
+    result = ProcessResult(out="out\n")
+    result += ProcessResult(100, out="more\n", err="err\n")
+    copy = pickle.loads(pickle.dumps(result))
+    assert copy.code == 100
+    assert copy.out == "out\nmore\n"
+    assert copy.err == "err\n"
+    assert not copy.realtime
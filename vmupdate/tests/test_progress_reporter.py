@@ -0,0 +1,75 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+from unittest.mock import Mock, patch
+
+import pytest
+
+from vmupdate.agent.source.common.progress_reporter import Progress
+
+
+def reported(percents, interval, delta, times=None):
+    callback = Mock()
+    progress = Progress(weight=1, log=Mock())
+    progress.init(50, 100, callback, Mock(), Mock())
+    times = times or [float(i) for i in range(len(percents))]
+    with patch.object(Progress, "MIN_INTERVAL", interval), patch.object(
+        Progress, "MIN_DELTA", delta
+    ), patch("time.monotonic", side_effect=times):
+        for percent in percents:
+            progress.notify_callback(percent)
+    return [c.args[0] for c in callback.call_args_list]
+
+
+def test_progress_is_reported_when_rising():
+    assert reported([0, 10, 10, 5, 20, 100], 0, 0.01) == [55, 60, 100]
+
+
+@pytest.mark.parametrize(
+    "interval, delta, expected",
+    ((0, 10, [60, 70, 80, 90, 100]), (1000, 0.01, [50.05, 100])),
+)
+def test_end_of_phase_is_always_reported(interval, delta, expected):
+    percents = [i / 10 for i in range(1, 1001)]
+    assert reported(percents, interval, delta) == expected
+
+
+def test_progress_is_throttled_by_delta():
+    percents = [i / 10 for i in range(1, 1001)]
+    assert reported(percents, 0, 10) == [60, 70, 80, 90, 100]
+
+
+def test_progress_is_throttled_by_interval():
+    percents = [i / 10 for i in range(1, 1001)]
+    times = [i / 4 for i in range(1, 1001)]
+    assert reported(percents, 25, 0.01, times) == [
+        50.05,
+        55.05,
+        60.05,
+        65.05,
+        70.05,
+        75.05,
+        80.05,
+        85.05,
+        90.05,
+        95.05,
+        100,
+    ]
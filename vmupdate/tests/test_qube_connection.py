@@ -18,9 +18,28 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
-from unittest.mock import Mock, patch
+import asyncio
+import io
+import threading
+import time
+from subprocess import CalledProcessError
+from unittest.mock import Mock, call, patch
 
-from vmupdate.qube_connection import QubeConnection
+import pytest
+
+import qubesadmin
+from vmupdate.agent.source.status import (
+    FinalStatus,
+    FormatedLine,
+    Status,
+    StatusBatch,
+    StatusInfo,
+)
+from vmupdate.qube_connection import (
+    NotEnoughMemoryError,
+    QubeConnection,
+    StatusBatcher,
+)
 
 
 @patch("vmupdate.qube_connection.shutdown_domains")
@@ -71,6 +90,32 @@ def test_do_not_wait_for_shutdown_without_assigned_pci(shutdown_domains):
     shutdown_domains.assert_not_called()
 
 
+def test_start_failure_because_of_memory():
+    vm = Mock()
+    vm.name = "tmpl"
+    vm.is_running.return_value = False
+    vm.start.side_effect = qubesadmin.exc.QubesMemoryError(
+        "Not enough memory to start domain 'tmpl'"
+    )
+    connection = QubeConnection(
+        vm,
+        "/tmp/qubes-update",
+        cleanup=False,
+        logger=Mock(),
+        show_progress=False,
+        status_notifier=Mock(),
+    )
+
+    with pytest.raises(NotEnoughMemoryError):
+        connection._start()
+
+    # other failures are left to qrexec, even if they mention memory
+    vm.start.side_effect = qubesadmin.exc.QubesVMError(
+        "Cannot set memory balloon target"
+    )
+    connection._start()
+
+
 @patch("vmupdate.qube_connection.shutdown_domains")
 def test_do_not_shutdown_if_vm_was_already_running(shutdown_domains):
     vm = Mock()
@@ -93,3 +138,287 @@ def test_do_not_shutdown_if_vm_was_already_running(shutdown_domains):
 
     vm.shutdown.assert_not_called()
     shutdown_domains.assert_not_called()
+
+
+def test_skip_transfer_if_qube_has_current_agent(tmp_path):
+    vm = Mock()
+    vm.name = "app"
+    vm.klass = "AppVM"
+    vm.is_running.return_value = True
+    vm.run_with_args.return_value = (b"", b"")
+
+    with QubeConnection(
+        vm,
+        "/run/qubes-update/agent-0123456789abcdef.pyz",
+        cleanup=True,
+        logger=Mock(),
+        show_progress=False,
+        status_notifier=Mock(),
+    ) as qconn:
+        result = qconn.transfer_agent(str(tmp_path / "agent.pyz"))
+
+    assert result.code == 0
+    vm.run_service.assert_not_called()
+    assert vm.run_with_args.call_args_list[0] == call(
+        "test",
+        "-e",
+        "/run/qubes-update/agent-0123456789abcdef.pyz",
+        user="root",
+    )
+    # the current version is kept for the next update
+    assert vm.run_with_args.call_args_list[1] == call(
+        "find",
+        "/run/qubes-update",
+        "-mindepth",
+        "1",
+        "-maxdepth",
+        "1",
+        "!",
+        "-name",
+        "agent-0123456789abcdef.pyz",
+        "-exec",
+        "rm",
+        "-r",
+        "{}",
+        "+",
+        user="root",
+    )
+
+
+def test_transfer_if_qube_has_no_current_agent(tmp_path):
+    archive = tmp_path / "agent.pyz"
+    archive.write_bytes(b"archive")
+    vm = Mock()
+    vm.name = "app"
+    vm.klass = "AppVM"
+    vm.is_running.return_value = True
+    vm.run_with_args.side_effect = CalledProcessError(1, "test")
+    vm.run_service.return_value.communicate.return_value = (b"", b"")
+    vm.run_service.return_value.returncode = 0
+
+    with QubeConnection(
+        vm,
+        "/run/qubes-update/agent-0123456789abcdef.pyz",
+        cleanup=False,
+        logger=Mock(),
+        show_progress=False,
+        status_notifier=Mock(),
+    ) as qconn:
+        result = qconn.transfer_agent(str(archive))
+
+    assert result.code == 0
+    vm.run_service.assert_called_once()
+    assert vm.run_service.call_args.args[0].startswith("qubes.VMExec+sh+")
+
+
+@patch("vmupdate.qube_connection.shutdown_domains")
+def test_transfer_to_started_qube_without_check(_shutdown_domains, tmp_path):
+    archive = tmp_path / "agent.pyz"
+    archive.write_bytes(b"archive")
+    vm = Mock()
+    vm.name = "tmpl"
+    vm.klass = "TemplateVM"
+    vm.is_running.side_effect = [False, True, True]
+    vm.devices = {"pci": Mock()}
+    vm.devices["pci"].get_assigned_devices.return_value = []
+    vm.run_service.return_value.communicate.return_value = (b"", b"")
+    vm.run_service.return_value.returncode = 0
+
+    with QubeConnection(
+        vm,
+        "/run/qubes-update/agent-0123456789abcdef.pyz",
+        cleanup=False,
+        logger=Mock(),
+        show_progress=False,
+        status_notifier=Mock(),
+    ) as qconn:
+        result = qconn.transfer_agent(str(archive))
+
+    assert result.code == 0
+    # the qube was halted, so it cannot have the agent
+    vm.run_with_args.assert_not_called()
+    vm.run_service.assert_called_once()
+
+
+@patch("secrets.token_hex", return_value="marker")
+def test_bootstrap_splits_output_and_logs(_token_hex, tmp_path):
+    archive = tmp_path / "agent.pyz"
+    archive.write_bytes(b"archive")
+    vm = Mock()
+    vm.name = "app"
+    vm.klass = "AppVM"
+    vm.is_running.return_value = True
+    proc = vm.run_service.return_value
+    proc.communicate.return_value = (
+        b"output\n\nmarker\nlog 1\nlog 2\nmarker\n{}",
+        b"",
+    )
+    proc.returncode = 100
+    agent_args = Mock(trace=True)
+
+    with patch(
+        "vmupdate.qube_connection.AgentArgs.to_cli_args", return_value=[]
+    ), QubeConnection(
+        vm,
+        "/run/qubes-update/agent-0123456789abcdef.pyz",
+        cleanup=True,
+        logger=Mock(),
+        show_progress=False,
+        status_notifier=Mock(),
+    ) as qconn:
+        result, untrusted_log, untrusted_trace = qconn.bootstrap(
+            str(archive), agent_args
+        )
+        status = qconn.status
+
+    assert result.code == 0
+    assert result.out == "output\n"
+    assert untrusted_log == "log 1\nlog 2"
+    assert untrusted_trace == "{}"
+    assert status == FinalStatus.NO_UPDATES
+    # the only call, cleanup is done by the bootstrap
+    vm.run_service.assert_called_once()
+    vm.run_with_args.assert_not_called()
+
+
+@patch("secrets.token_hex", return_value="prefix")
+def test_agent_log_is_streamed(_token_hex):
+    vm = Mock()
+    vm.name = "app"
+    vm.klass = "AppVM"
+    vm.is_running.return_value = True
+    vm.run_with_args.return_value = (
+        b"prefix 2025-01-01 [Agent] log 1\noutput\nprefix log 2\n",
+        b"",
+    )
+    agent_log = Mock()
+
+    with patch(
+        "vmupdate.qube_connection.AgentArgs.to_cli_args", return_value=[]
+    ), QubeConnection(
+        vm,
+        "/run/qubes-update/agent-0123456789abcdef.pyz",
+        cleanup=False,
+        logger=Mock(),
+        show_progress=False,
+        status_notifier=Mock(),
+        agent_log=agent_log,
+    ) as qconn:
+        result = qconn.run_entrypoint(
+            "/run/qubes-update/agent-0123456789abcdef.pyz", Mock()
+        )
+
+    assert vm.run_with_args.call_args.args[-2:] == ("--log-stream", "prefix")
+    assert result.out == "output\n"
+    assert agent_log.call_args_list == [
+        call("2025-01-01 [Agent] log 1"),
+        call("log 2"),
+    ]
+
+
+def test_status_batch_keeps_latest_progress():
+    vm = Mock()
+    vm.name = "app"
+    batch = StatusBatch()
+    batch.add(StatusInfo.updating(vm, 1.0))
+    batch.add(StatusInfo.updating(vm, 2.0))
+    batch.add(FormatedLine("app", "err", "line"))
+    batch.add(StatusInfo.updating(vm, 3.0))
+    batch.add(StatusInfo.updating(vm, 4.0))
+    batch.add(StatusInfo.done(vm, FinalStatus.SUCCESS))
+
+    assert [(type(e), getattr(e, "info", None)) for e in batch] == [
+        (StatusInfo, 2.0),
+        (FormatedLine, None),
+        (StatusInfo, 4.0),
+        (StatusInfo, FinalStatus.SUCCESS),
+    ]
+
+
+def test_status_events_are_batched(monkeypatch):
+    # everything fits into one batch, sent when the output is read
+    monkeypatch.setattr(StatusBatcher, "INTERVAL", 60)
+    vm = Mock()
+    vm.name = "app"
+    vm.klass = "AppVM"
+    vm.is_running.return_value = True
+    proc = Mock()
+    proc.stdout = io.BytesIO(b"")
+    proc.stderr = io.BytesIO(
+        b"".join(b"%d\n" % percent for percent in range(0, 101, 10)) + b"err\n"
+    )
+    proc.wait.return_value = 0
+    status_notifier = Mock()
+
+    with QubeConnection(
+        vm,
+        "/run/qubes-update/agent-0123456789abcdef.pyz",
+        cleanup=False,
+        logger=Mock(),
+        show_progress=True,
+        status_notifier=status_notifier,
+    ) as qconn:
+        qconn._report_progress(proc)  # pylint: disable=protected-access
+        batches = [c.args[0] for c in status_notifier.put.call_args_list]
+
+    assert len(batches) == 1
+    assert isinstance(batches[0], StatusBatch)
+    events = list(batches[0])
+    # consecutive progress events are reduced to the latest one
+    assert [type(event) for event in events] == [StatusInfo, FormatedLine]
+    assert (events[0].status, events[0].info) == (Status.UPDATING, 100.0)
+    assert str(events[1]) == "app:err: err"
+
+
+def flushers():
+    return [t for t in threading.enumerate() if t.name == "status-flusher"]
+
+
+def test_status_batcher_uses_one_flusher_thread():
+    status_notifier = Mock()
+    batcher = StatusBatcher(status_notifier)
+
+    for i in range(3):
+        batcher.put(FormatedLine("app", "out", f"line {i}"))
+        assert len(flushers()) == 1
+        # the batch is sent by the flusher after the interval
+        deadline = time.monotonic() + 5
+        while status_notifier.put.call_count <= i:
+            assert time.monotonic() < deadline
+            time.sleep(StatusBatcher.INTERVAL / 5)
+    batcher.put(FormatedLine("app", "out", "rest"))
+    batcher.close()
+
+    assert not flushers()
+    batches = [c.args[0] for c in status_notifier.put.call_args_list]
+    assert [[str(event) for event in batch] for batch in batches] == [
+        ["app:out: line 0"],
+        ["app:out: line 1"],
+        ["app:out: line 2"],
+        ["app:out: rest"],
+    ]
+
+
+def test_status_batcher_cancels_timer_in_its_loop():
+    status_notifier = Mock()
+    batcher = StatusBatcher(status_notifier)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+
+        async def put():
+            batcher.put(FormatedLine("app", "out", "line"))
+            # pylint: disable=protected-access
+            return batcher._handle[1]
+
+        handle = asyncio.run_coroutine_threadsafe(put(), loop).result()
+        # flushed from another thread than the loop one
+        batcher.flush()
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result()
+        assert handle.cancelled()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    status_notifier.put.assert_called_once()
@@ -18,18 +18,37 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
+import functools
 import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import zipfile
 
-from unittest.mock import patch
+from unittest.mock import patch, Mock, ANY
 
 import pytest
 
 import qubesadmin
 from vmupdate.agent.source.common.exit_codes import EXIT
-from vmupdate.tests.conftest import generate_vm_variations, TestVM, Features
-from vmupdate.agent.source.status import FinalStatus
+from vmupdate.agent.source.common.process_result import ProcessResult
+from vmupdate.agent.source.common.tracing import Tracer
+from vmupdate.tests.conftest import (
+    generate_vm_variations,
+    TestVM,
+    Features,
+    MPPool,
+)
+from vmupdate.agent.source.status import FinalStatus, StatusInfo
+from vmupdate.qube_connection import NotEnoughMemoryError
+from vmupdate.timings import TimingStore
+from vmupdate.update_manager import SimpleTerminalBar, TerminalMultiBar
+from vmupdate.utils import QubesSnapshot, is_stale
 from vmupdate.vmupdate import main
-from vmupdate import vmupdate
+from vmupdate import bundle, update_manager, vmupdate
 
 
 @patch("os.chmod")
@@ -714,6 +733,176 @@ def test_error(
     assert retcode == EXIT.ERR
 
 
+class HoldingPool(MPPool):
+    """
+    Synchronous pool which holds the job of one qube until the job of
+    another one has run. The held job is released after a timeout anyway,
+    so a wrong order fails the test instead of hanging it.
+    """
+
+    def __init__(self, hold, until, timeout=5):
+        super().__init__()
+        self.hold = hold
+        self.until = until
+        self.held = None
+        self.timer = threading.Timer(timeout, self._release)
+
+    def _get_child_mock(self, **kwargs):
+        return Mock(**kwargs)
+
+    def apply_async(self, func, args, **kwargs):
+        if args[0].name == self.hold:
+            self.held = (func, args, kwargs)
+            self.timer.start()
+            return
+        super().apply_async(func, args, **kwargs)
+        if args[0].name == self.until:
+            self.timer.cancel()
+            self._release()
+
+    def _release(self):
+        held, self.held = self.held, None
+        if held is not None:
+            func, args, kwargs = held
+            super().apply_async(func, args, **kwargs)
+
+
+def test_derived_qubes_wait_only_for_own_template(test_qapp, update_run):
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    tmpl1 = TestVM("tmpl1", test_qapp, klass="TemplateVM")
+    tmpl2 = TestVM("tmpl2", test_qapp, klass="TemplateVM")
+    dvm = TestVM("dvm", test_qapp, klass="AppVM", template=tmpl2)
+    app1 = TestVM("app1", test_qapp, klass="AppVM", template=tmpl1)
+    disp = TestVM("disp", test_qapp, klass="DispVM", template=dvm)
+
+    retcode = update_run(
+        [tmpl1, tmpl2, app1, dvm, disp],
+        "--just-print-progress",
+        "--all",
+        "--force-update",
+        "-x",
+        "8",
+        "--engine",
+        "pool",
+        # tmpl2 is still updating until app1 is done, which is only possible
+        # if app1 does not wait for all templates
+        pool=HoldingPool(hold="tmpl2", until="app1"),
+    )
+    assert retcode == EXIT.OK
+    assert update_run.order == ["tmpl1", "app1", "tmpl2", "dvm", "disp"]
+
+
+def test_async_engine(test_qapp, update_run):
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM")
+    apps = [
+        TestVM(f"app{i}", test_qapp, klass="AppVM", template=tmpl)
+        for i in range(8)
+    ]
+
+    retcode = update_run(
+        [tmpl, *apps],
+        "--just-print-progress",
+        "--all",
+        "--force-update",
+        "-x",
+        "3",
+        "--engine",
+        "async",
+    )
+    assert retcode == EXIT.OK
+    # AppVMs are updated by three workers, in any order
+    assert update_run.order[0] == "tmpl"
+    assert sorted(update_run.order[1:]) == [f"app{i}" for i in range(8)]
+    # no process is involved
+    update_run.mp_manager.assert_not_called()
+    update_run.mp_pool.assert_not_called()
+
+
+@patch("vmupdate.update_manager.get_free_memory")
+def test_memory_admission(free_memory, test_qapp, update_run, monkeypatch):
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    targets = [
+        TestVM(name, test_qapp, klass="TemplateVM", running=False, memory=400)
+        for name in ("tmpl1", "tmpl2", "tmpl3")
+    ]
+
+    managers = []
+    init = update_manager.UpdateManager.__init__
+
+    def spy_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        managers.append(self)
+
+    monkeypatch.setattr(update_manager.UpdateManager, "__init__", spy_init)
+
+    unlocked = []
+
+    def probe():
+        # the lock is held by another thread, if it cannot be acquired here
+        acquired = managers[-1].finished.acquire(blocking=False)
+        if acquired:
+            managers[-1].finished.release()
+        unlocked.append(acquired)
+
+    def get_free_memory():
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        # only one more qube fits into memory
+        return 1000
+
+    free_memory.side_effect = get_free_memory
+    retcode = update_run(
+        targets,
+        "--just-print-progress",
+        "--force-update",
+        "--memory-admission",
+        "-x",
+        "8",
+        "--engine",
+        "pool",
+    )
+    assert retcode == EXIT.OK
+    assert update_run.order == ["tmpl1", "tmpl2", "tmpl3"]
+    # free memory is measured without blocking other callbacks
+    assert unlocked == [True, True]
+
+
+@patch("vmupdate.update_manager.get_free_memory")
+def test_back_off_when_out_of_memory(free_memory, test_qapp, update_run):
+    free_memory.return_value = None
+
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    tmpl1 = TestVM("tmpl1", test_qapp, klass="TemplateVM", running=False)
+    tmpl2 = TestVM("tmpl2", test_qapp, klass="TemplateVM", running=False)
+    out_of_memory = {"tmpl1"}
+
+    class UpdateAgentManager(update_run.Agent):
+        def run_agent(self, agent_args, status_notifier, termination):
+            if self.qube.name in out_of_memory:
+                out_of_memory.remove(self.qube.name)
+                update_run.order.append("oom:" + self.qube.name)
+                raise NotEnoughMemoryError(self.qube.name, "no memory")
+            return super().run_agent(agent_args, status_notifier, termination)
+
+    retcode = update_run(
+        [tmpl1, tmpl2],
+        "--just-print-progress",
+        "--force-update",
+        "-x",
+        "8",
+        "--engine",
+        "pool",
+        agent=UpdateAgentManager,
+    )
+    assert retcode == EXIT.OK
+    # tmpl1 is retried after tmpl2 finished
+    assert update_run.order == ["oom:tmpl1", "tmpl2", "tmpl1"]
+    # without --memory-admission only the back-off is used
+    free_memory.assert_not_called()
+
+
 @patch("vmupdate.update_manager.TerminalMultiBar.print")
 @patch("os.chmod")
 @patch("os.chown")
@@ -754,7 +943,7 @@ def test_error_apply(
     monkeypatch.setattr(
         vmupdate,
         "run_update",
-        lambda *_: [EXIT.OK, {"vm": FinalStatus.SUCCESS}],
+        lambda *_, **__: [EXIT.OK, {"vm": FinalStatus.SUCCESS}],
     )
 
     def raiser(*_args, **_kwargs):
@@ -793,3 +982,502 @@ def test_error_usage_wrong_param(
         test_qapp,
     )
     assert retcode == EXIT.ERR_USAGE
+
+
+def test_one_context_for_all_phases(test_qapp, update_run):
+    dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM")
+    app = TestVM("app", test_qapp, klass="AppVM", template=tmpl)
+
+    retcode = update_run(
+        [dom0, tmpl, app],
+        "--just-print-progress",
+        "--force-update",
+        "--engine",
+        "pool",
+    )
+    assert retcode == EXIT.OK
+    assert update_run.order == ["dom0", "tmpl", "app"]
+    # admin phase and qubes phase share workers
+    update_run.mp_manager.assert_called_once()
+    update_run.mp_pool.assert_called_once()
+
+
+def test_selection_snapshot(test_qapp):
+    tmpl = TestVM(
+        "tmpl",
+        test_qapp,
+        klass="TemplateVM",
+        updateable=True,
+        features=Features(
+            "tmpl",
+            test_qapp,
+            {
+                "qrexec": True,
+                "os": "Linux",
+                "last-updates-check": "2020-01-01 00:00:00",
+            },
+        ),
+    )
+    apps = [
+        TestVM(
+            f"app{i}",
+            test_qapp,
+            klass="AppVM",
+            template=tmpl,
+            updateable=False,
+            features=Features(
+                f"app{i}", test_qapp, {"qrexec": True, "os": "Linux"}
+            ),
+        )
+        for i in range(3)
+    ]
+    for vm in (tmpl, *apps):
+        vm.features.keys = Mock(wraps=vm.features.keys)
+        vm.features.get = Mock(wraps=vm.features.get)
+
+    snapshot = QubesSnapshot()
+    for _ in range(2):
+        for vm in apps:
+            assert is_stale(vm, expiration_period=7, snapshot=snapshot)
+            # missing features are not fetched at all
+            assert not snapshot.get_feature(vm, "skip-update", False)
+
+    for vm in (tmpl, *apps):
+        vm.features.keys.assert_called_once()
+    # the template is asked only once for all derived qubes
+    tmpl.features.get.assert_called_once_with("last-updates-check", ANY)
+    for vm in apps:
+        assert vm.features.get.call_count == 1  # os
+
+
+def test_timing_store(tmp_path):
+    path = str(tmp_path / "timings.sqlite")
+    log = Mock()
+    for run in range(TimingStore.HISTORY + 2):
+        store = TimingStore(log, path)
+        store.run = run
+        store.record("vm", {"start": 1.0, "update": float(run)})
+        store.save()
+
+    store = TimingStore(log, path)
+    # only the latest runs are kept
+    runs = range(2, TimingStore.HISTORY + 2)
+    assert store.estimate("vm") == sum(1.0 + run for run in runs) / len(runs)
+    assert store.estimate("unknown") is None
+
+
+def test_timing_store_unavailable(tmp_path):
+    store = TimingStore(Mock(), str(tmp_path / "missing" / "timings.sqlite"))
+    assert store.estimates() == {}
+    store.record("vm", {"update": 1.0})
+    store.save()
+
+
+def test_longest_first(test_qapp, update_run, monkeypatch, tmp_path):
+    path = str(tmp_path / "timings.sqlite")
+    store = TimingStore(Mock(), path)
+    store.record("short", {"update": 10.0})
+    store.record("long", {"update": 100.0})
+    store.record("base", {"update": 20.0})
+    store.record("app", {"update": 90.0})
+    store.save()
+    monkeypatch.setattr(TimingStore, "PATH", path)
+
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    short = TestVM("short", test_qapp, klass="StandaloneVM")
+    long = TestVM("long", test_qapp, klass="StandaloneVM")
+    base = TestVM("base", test_qapp, klass="TemplateVM")
+    app = TestVM("app", test_qapp, klass="AppVM", template=base)
+    new = TestVM("new", test_qapp, klass="StandaloneVM")
+
+    retcode = update_run(
+        [short, new, long, base, app],
+        "--just-print-progress",
+        "--all",
+        "--force-update",
+        "-x",
+        "1",
+        "--engine",
+        "pool",
+    )
+    assert retcode == EXIT.OK
+    # the template goes first because of the long update of its AppVM,
+    # a qube without history is expected to take an average time
+    assert update_run.order == ["base", "long", "app", "new", "short"]
+
+
+@patch("vmupdate.update_manager.get_free_memory")
+@pytest.mark.parametrize("out_of_memory", (False, True))
+def test_prestart(free_memory, test_qapp, update_run, out_of_memory):
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    targets = [
+        TestVM(name, test_qapp, klass="TemplateVM", running=False, memory=400)
+        for name in ("tmpl1", "tmpl2", "tmpl3")
+    ]
+    for vm in targets:
+        vm.start.side_effect = functools.partial(setattr, vm, "running", True)
+    if out_of_memory:
+        targets[1].start.side_effect = qubesadmin.exc.QubesMemoryError(
+            "Not enough memory to start domain 'tmpl2'"
+        )
+    prestarted = {}
+
+    class UpdateAgentManager(update_run.Agent):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            prestarted[self.qube.name] = kwargs["prestarted"]
+
+    retcode = update_run(
+        targets,
+        "--just-print-progress",
+        "--force-update",
+        "-x",
+        "1",
+        "--prestart",
+        "2",
+        # the budget is enough for only one qube
+        "--prestart-memory",
+        "400",
+        "--engine",
+        "pool",
+        agent=UpdateAgentManager,
+    )
+    assert retcode == EXIT.OK
+    assert update_run.order == ["tmpl1", "tmpl2", "tmpl3"]
+    targets[0].start.assert_not_called()
+    targets[1].start.assert_called_once_with()
+    if out_of_memory:
+        # no more qubes are started in advance
+        assert prestarted == {"tmpl1": False, "tmpl2": False, "tmpl3": False}
+        targets[2].start.assert_not_called()
+    else:
+        assert prestarted == {"tmpl1": False, "tmpl2": True, "tmpl3": True}
+        targets[2].start.assert_called_once_with()
+    # free Xen memory is not used, it is given out by qmemman
+    free_memory.assert_not_called()
+
+
+def test_terminal_bar_coalescing(capsys, monkeypatch):
+    # at most one frame per 1000 s
+    monkeypatch.setattr(TerminalMultiBar, "FPS", 0.001)
+    SimpleTerminalBar.reinit_class()
+    multi_bar = SimpleTerminalBar.PARENT_MULTI_BAR
+    multi_bar.printed_at = float("-inf")
+    bars = [SimpleTerminalBar(100, i, f"vm{i} (pending)") for i in range(3)]
+
+    bars[0].set_description("vm0 (updating)")
+    for _ in range(50):
+        bars[0].update(1.0)
+    # final status is printed immediately together with pending changes
+    bars[1].set_description("vm1 (success)")
+    # nothing changed in the output
+    bars[0].update(0.0)
+    multi_bar.print()
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines == [
+        "vm0 updating 0.0",
+        "vm0 updating 50.0",
+        "vm1 done success",
+    ]
+
+
+def test_terminal_bar_flush_held_back(capsys, monkeypatch):
+    monkeypatch.setattr(TerminalMultiBar, "FPS", 0.001)
+    SimpleTerminalBar.reinit_class()
+    multi_bar = SimpleTerminalBar.PARENT_MULTI_BAR
+    multi_bar.printed_at = float("-inf")
+    bar = SimpleTerminalBar(100, 0, "vm0 (pending)")
+
+    bar.set_description("vm0 (updating)")
+    bar.update(10.0)
+    # the last change is held back until the next flush
+    assert capsys.readouterr().err.splitlines() == ["vm0 updating 0.0"]
+    multi_bar.flush()
+    assert capsys.readouterr().err.splitlines() == ["vm0 updating 10.0"]
+    # nothing to print
+    multi_bar.flush()
+    assert not capsys.readouterr().err
+
+
+def test_json_events(test_qapp, update_run, capsys):
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM")
+    app = TestVM("app", test_qapp, klass="AppVM", template=tmpl)
+
+    retcode = update_run(
+        [tmpl, app],
+        "--json-events",
+        "--all",
+        "--force-update",
+        "--engine",
+        "pool",
+        feed={
+            tmpl.name: {"statuses": [FinalStatus.SUCCESS], "retcode": EXIT.OK},
+            app.name: {"statuses": [FinalStatus.ERROR], "retcode": EXIT.ERR_VM},
+        },
+    )
+    assert retcode == EXIT.ERR_VM
+
+    records = [
+        json.loads(line) for line in capsys.readouterr().out.splitlines()
+    ]
+    events = [
+        (record["event"], record.get("qube"), record.get("status"))
+        for record in records
+        if record["event"] != "timings"
+    ]
+    assert events == [
+        ("pending", "tmpl", None),
+        ("pending", "app", None),
+        ("done", "tmpl", "success"),
+        ("done", "app", "error"),
+        ("exit", None, None),
+    ]
+    assert records[-1]["code"] == EXIT.ERR_VM
+    assert records[-1]["qubes"] == EXIT.ERR_VM
+
+
+def test_tracer_untrusted():
+    untrusted_trace = json.dumps(
+        {
+            "traceEvents": [
+                {"name": "refresh", "ph": "X", "ts": 10, "dur": 5},
+                {"name": "bad name\n", "ph": "X", "ts": 10, "dur": 5},
+                {"name": "clean", "ph": "X", "ts": 10, "dur": -1},
+                {"name": "clean", "ph": "X", "ts": "10", "dur": 1},
+                {"name": "clean", "ph": "X", "ts": 10, "dur": True},
+                {"name": "agent", "ph": "B", "ts": 10},
+                "span",
+            ]
+        }
+    )
+    tracer = Tracer(process="vm", thread="agent")
+    tracer.load_untrusted(untrusted_trace)
+    tracer.load_untrusted("{not a trace")
+    tracer.load_untrusted('{"traceEvents": {}}')
+    assert tracer.spans == [
+        {
+            "name": "refresh",
+            "ph": "X",
+            "ts": 10,
+            "dur": 5,
+            "pid": "vm",
+            "tid": "agent",
+        }
+    ]
+
+
+def test_trace(test_qapp, update_run, monkeypatch, tmp_path):
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM")
+    app = TestVM("app", test_qapp, klass="AppVM", template=tmpl)
+    trace_path = tmp_path / "trace.json"
+    monkeypatch.setattr(vmupdate, "TRACEPATH", str(trace_path))
+
+    retcode = update_run(
+        [tmpl, app], "--trace", "--all", "--force-update", "--engine", "pool"
+    )
+    assert retcode == EXIT.OK
+
+    events = json.loads(trace_path.read_text())["traceEvents"]
+    processes = {
+        event["pid"]: event["args"]["name"]
+        for event in events
+        if event["name"] == "process_name"
+    }
+    spans = {
+        (processes[event["pid"]], event["name"])
+        for event in events
+        if event["ph"] == "X"
+    }
+    assert spans == {
+        ("qubes-vm-update", "qubes-vm-update"),
+        ("qubes-vm-update", "selection"),
+        ("qubes-vm-update", "qubes"),
+        ("qubes-vm-update", "apply"),
+        ("tmpl", "update"),
+        ("app", "update"),
+    }
+
+
+def test_two_stage_update(test_qapp, update_run, monkeypatch, tmp_path):
+    path = str(tmp_path / "timings.sqlite")
+    monkeypatch.setattr(TimingStore, "PATH", path)
+
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM")
+    tmpl_no_updates = TestVM("tmpl-no-updates", test_qapp, klass="TemplateVM")
+    app = TestVM("app", test_qapp, klass="AppVM", template=tmpl)
+    calls = []
+
+    class UpdateAgentManager:
+        def __init__(self, _app, qube, agent_args, *_args, **_kwargs):
+            self.qube = qube
+            self.timings = {"update": 1.0}
+            self.spans = []
+
+        def run_agent(self, agent_args, status_notifier, termination):
+            calls.append(
+                (self.qube.name, agent_args.no_install, agent_args.no_refresh)
+            )
+            status = FinalStatus.SUCCESS
+            if self.qube.name == tmpl_no_updates.name:
+                status = FinalStatus.NO_UPDATES
+            status_notifier.put(StatusInfo.done(self.qube, status))
+            return ProcessResult(code=EXIT.OK)
+
+    retcode = update_run(
+        [tmpl, tmpl_no_updates, app],
+        "--all",
+        "--force-update",
+        "--engine",
+        "pool",
+        "--download-concurrency",
+        "8",
+        # the agent does not take results from the feed
+        feed={},
+        agent=UpdateAgentManager,
+    )
+    assert retcode == EXIT.OK
+    # packages are downloaded first, and installed only if there are any
+    assert sorted(calls[:2]) == [
+        ("tmpl", True, False),
+        ("tmpl-no-updates", True, False),
+    ]
+    assert calls[2:] == [("tmpl", False, True), ("app", False, False)]
+    # both stages are recorded as one run
+    assert TimingStore(Mock(), path).estimate("tmpl") == 2.0
+
+
+def test_agent_bundle(tmp_path):
+    src_dir = tmp_path / "agent"
+    (src_dir / "source" / "__pycache__").mkdir(parents=True)
+    (src_dir / "__main__.py").write_text("import entrypoint\n")
+    (src_dir / "entrypoint.py").write_text("print('v1')\n")
+    (src_dir / "source" / "__init__.py").write_text("")
+    (src_dir / "source" / "__pycache__" / "x.pyc").write_bytes(b"\0")
+    cache = tmp_path / "cache"
+
+    path = bundle.build(str(src_dir), str(cache))
+    assert bundle.build(str(src_dir), str(cache)) == path
+    with zipfile.ZipFile(path) as archive:
+        assert sorted(
+            name for name in archive.namelist() if not name.endswith("/")
+        ) == ["__main__.py", "entrypoint.py", "source/__init__.py"]
+    assert subprocess.check_output([sys.executable, path]) == b"v1\n"
+
+    (src_dir / "entrypoint.py").write_text("print('v2')\n")
+    new_path = bundle.build(str(src_dir), str(cache))
+    assert new_path == path  # built once per process
+    bundle._BUILT.clear()
+    new_path = bundle.build(str(src_dir), str(cache))
+    assert new_path != path
+    assert os.listdir(cache) == [os.path.basename(new_path)]
+
+
+@patch("vmupdate.update_manager.UpdateAgentManager._run_agent")
+def test_agent_log_handlers_are_closed(
+    run_agent, test_qapp, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(
+        update_manager.UpdateAgentManager, "LOGPATH", str(tmp_path)
+    )
+    run_agent.return_value = ProcessResult(code=EXIT.OK)
+    tmpl = TestVM("tmpl-log", test_qapp, klass="TemplateVM")
+    agent_args = Mock(log="INFO", trace=False, show_output=True)
+
+    # e.g. download and install stages of the same qube
+    for _ in range(2):
+        runner = update_manager.UpdateAgentManager(
+            test_qapp, tmpl, agent_args, show_progress=False, dom0=False
+        )
+        runner.run_agent(agent_args, Mock(), Mock(value=False))
+        assert not logging.getLogger("tmpl-log").handlers
+        assert not logging.getLogger("tmpl-log.agent").handlers
+        assert runner.agent_log_handler.stream is None
+
+
+def test_selection_snapshot_bulk_calls(test_qapp, monkeypatch):
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM", running=True)
+    app = TestVM("app", test_qapp, klass="AppVM", template=tmpl)
+    responses = {
+        ("dom0", "admin.vm.List"): b"tmpl class=TemplateVM state=Halted\n"
+        b"app class=AppVM state=Running\n",
+        ("tmpl", "admin.vm.property.GetAll"): b"updateable default=True "
+        b"type=bool True\nlabel default=False type=label black\n",
+        ("app", "admin.vm.property.GetAll"): b"updateable default=True "
+        b"type=bool False\ntemplate default=False type=vm tmpl\n",
+    }
+    test_qapp.qubesd_call = Mock(
+        side_effect=lambda dest, method: responses[(dest, method)]
+    )
+    # domains are not listed again by qubesadmin
+    monkeypatch.setattr(type(test_qapp.domains), "__iter__", None)
+
+    snapshot = QubesSnapshot()
+    assert snapshot.domains(test_qapp) == [tmpl, app]
+    # power state is taken from the list of domains
+    assert not snapshot.is_running(tmpl)
+    assert snapshot.is_running(app)
+    assert snapshot.get_property(tmpl, "updateable", False)
+    assert not snapshot.get_property(app, "updateable", True)
+    assert snapshot.get_property(app, "template") is tmpl
+    assert snapshot.get_property(tmpl, "template", None) is None
+
+    assert test_qapp.qubesd_call.call_count == 3
+
+
+def test_selection_snapshot_fallback_per_qube(test_qapp):
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM", updateable=True)
+    app = TestVM("app", test_qapp, klass="AppVM", template=tmpl)
+
+    def qubesd_call(dest, method):
+        if method == "admin.vm.List":
+            raise qubesadmin.exc.QubesDaemonAccessError(method)
+        if dest == "tmpl":
+            raise qubesadmin.exc.QubesDaemonAccessError(method)
+        return b"updateable default=True type=bool True\n"
+
+    test_qapp.qubesd_call = Mock(side_effect=qubesd_call)
+
+    snapshot = QubesSnapshot()
+    assert snapshot.domains(test_qapp) == [tmpl, app]
+    # tmpl falls back to single values, app still uses the bulk call
+    assert snapshot.get_property(tmpl, "updateable", False)
+    assert snapshot.get_property(app, "updateable", False)
+    assert test_qapp.qubesd_call.call_args_list == [
+        (("dom0", "admin.vm.List"),),
+        (("tmpl", "admin.vm.property.GetAll"),),
+        (("app", "admin.vm.property.GetAll"),),
+    ]
+
+
+def test_json_events_reject_dry_run(test_qapp, capsys):
+    _dom0 = TestVM("dom0", test_qapp, klass="AdminVM")
+    with pytest.raises(SystemExit):
+        main(("--json-events", "--dry-run"), test_qapp)
+    assert not capsys.readouterr().out
+
+
+@patch("vmupdate.update_manager.bundle.build")
+def test_agent_archive_error(build, test_qapp, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        update_manager.UpdateAgentManager, "LOGPATH", str(tmp_path)
+    )
+    build.side_effect = OSError("No space left on device")
+    tmpl = TestVM("tmpl", test_qapp, klass="TemplateVM")
+    agent_args = Mock(log="INFO", trace=False, show_output=True)
+    status_notifier = Mock()
+
+    runner = update_manager.UpdateAgentManager(
+        test_qapp, tmpl, agent_args, show_progress=False, dom0=False
+    )
+    result = runner.run_agent(agent_args, status_notifier, Mock(value=False))
+
+    assert result.code == EXIT.ERR_VM
+    assert "No space left on device" in result.err
+    status_notifier.put.assert_called_once()
+    status = status_notifier.put.call_args.args[0]
+    assert (status.qname, status.info) == ("tmpl", FinalStatus.ERROR)
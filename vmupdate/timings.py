@@ -0,0 +1,144 @@
+# coding=utf-8
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2025  Piotr Bartman-Szwarc
+#                                   <prbartman@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+Durations of updates of qubes kept between runs.
+"""
+
+import contextlib
+import sqlite3
+import time
+from logging import Logger
+from typing import Iterator, Optional
+
+from vmupdate.agent.source.common.tracing import Tracer
+
+# phases of qube update measured in dom0
+PHASES = ("start", "transfer", "update", "cleanup", "shutdown")
+
+
+@contextlib.contextmanager
+def timed(
+    timings: dict[str, float], phase: str, tracer: Optional[Tracer] = None
+) -> Iterator[None]:
+    """
+    Add duration (in seconds) of the block to `timings[phase]`.
+
+    If `tracer` is given, the block is also recorded as a span.
+    """
+    epoch = time.time()
+    begin = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - begin
+        timings[phase] = timings.get(phase, 0.0) + duration
+        if tracer is not None:
+            tracer.add(phase, epoch, duration)
+
+
+class TimingStore:
+    """
+    SQLite database of durations of update phases for each qube.
+
+    It is used on the best effort basis, any database error only disables it.
+    """
+
+    PATH = "/var/lib/qubes/vm-update/timings.sqlite"
+    # number of the latest runs used to estimate duration of the next one
+    HISTORY = 5
+
+    def __init__(self, log: Logger, path: Optional[str] = None) -> None:
+        self.log = log
+        self.path = path or TimingStore.PATH
+        self.run = time.time()
+        self._estimates: Optional[dict[str, float]] = None
+        self._pending: list[tuple[str, float, str, float]] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS timings ("
+            "qube TEXT NOT NULL, run REAL NOT NULL, "
+            "phase TEXT NOT NULL, seconds REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS timings_qube ON timings (qube, run)"
+        )
+        return conn
+
+    def estimates(self) -> dict[str, float]:
+        """
+        Return expected duration of update (in seconds) for each known qube.
+        """
+        if self._estimates is not None:
+            return self._estimates
+        self._estimates = {}
+        runs: dict[str, list[float]] = {}
+        try:
+            with contextlib.closing(self._connect()) as conn:
+                rows = conn.execute(
+                    "SELECT qube, run, SUM(seconds) FROM timings "
+                    "GROUP BY qube, run ORDER BY qube, run DESC"
+                ).fetchall()
+        except sqlite3.Error as err:
+            self.log.debug("Cannot read update timings: %s", str(err))
+            return self._estimates
+        for qube, _run, seconds in rows:
+            durations = runs.setdefault(qube, [])
+            if len(durations) < TimingStore.HISTORY:
+                durations.append(seconds)
+        for qube, durations in runs.items():
+            self._estimates[qube] = sum(durations) / len(durations)
+        return self._estimates
+
+    def estimate(self, qube_name: str) -> Optional[float]:
+        return self.estimates().get(qube_name)
+
+    def record(self, qube_name: str, timings: dict[str, float]) -> None:
+        """
+        Remember durations of phases of the qube update, see `save`.
+        """
+        for phase, seconds in timings.items():
+            self._pending.append((qube_name, self.run, phase, seconds))
+
+    def save(self) -> None:
+        """
+        Write recorded durations and forget runs older than `HISTORY`.
+        """
+        if not self._pending:
+            return
+        qubes = sorted({row[0] for row in self._pending})
+        try:
+            with contextlib.closing(self._connect()) as conn, conn:
+                conn.executemany(
+                    "INSERT INTO timings VALUES (?, ?, ?, ?)", self._pending
+                )
+                for qube in qubes:
+                    conn.execute(
+                        "DELETE FROM timings WHERE qube = ? AND run NOT IN "
+                        "(SELECT DISTINCT run FROM timings WHERE qube = ? "
+                        "ORDER BY run DESC LIMIT ?)",
+                        (qube, qube, TimingStore.HISTORY),
+                    )
+        except sqlite3.Error as err:
+            self.log.debug("Cannot save update timings: %s", str(err))
+        self._pending = []
@@ -23,76 +23,159 @@
 # USA.
 
 import argparse
+import concurrent.futures
+import functools
+import json
 import os
+import shutil
 import signal
 import sys
 import queue
 import logging
+import threading
+import time
 import multiprocessing
 import multiprocessing.managers
 from logging import Logger
 from os.path import join
 from types import FrameType
-from typing import Any, Optional, Tuple, Callable, Union
+from typing import IO, Any, Optional, Tuple, Callable, Union
 
 from tqdm import tqdm
 
+import qubesadmin.exc
 from qubesadmin.app import QubesBase
 from qubesadmin.vm import QubesVM
 from vmupdate.agent.source.log_config import init_logs
 from vmupdate.agent.source.common.process_result import ProcessResult
 from vmupdate.agent.source.common.exit_codes import EXIT
-from .agent.source.status import StatusInfo, FinalStatus, Status, FormatedLine
-from .qube_connection import QubeConnection
+from vmupdate.agent.source.common.tracing import Tracer
+from .agent.source.status import (
+    StatusInfo,
+    FinalStatus,
+    Status,
+    FormatedLine,
+    StatusBatch,
+)
+from . import bundle
+from .engine import AsyncPool, Flag
+from .qube_connection import QubeConnection, NotEnoughMemoryError
+from .timings import TimingStore, timed
+from .utils import get_free_memory
 
 
 class UpdateManager:
     """
     Update multiple qubes simultaneously.
+
+    Derived qubes (e.g. AppVMs) whose template is updated in the same batch
+    are started as soon as their template reaches a final status.
+    All qubes share one concurrency budget. With memory admission, a qube
+    which has to be started is admitted only if there is enough free memory
+    for it.
+    Qubes expected to take the longest (with the qubes waiting for them)
+    are started first, based on durations of previous updates.
+    Optionally, the next queued qubes are started in advance, so their boot
+    overlaps with updates of other qubes.
     """
 
+    # MiB kept free on top of the memory required by the started qube
+    MEMORY_MARGIN = 512
+
     def __init__(
         self,
         qubes: list[QubesVM],
         args: argparse.Namespace,
         log: Logger,
         dom0: bool = False,
+        context: Optional["MultipleUpdateMultipleProgressBar"] = None,
+        qube_args: Optional[dict[str, argparse.Namespace]] = None,
     ) -> None:
         self.qubes = qubes
+        self.args = args
+        self.context = context
+        # agent args of particular qubes, instead of args given to `run`
+        self.qube_args = qube_args or {}
         self.max_concurrency = args.max_concurrency
+        self.engine = args.engine
         self.show_output = args.show_output
         self.quiet = args.quiet
         self.no_progress = args.no_progress
+        self.json_events = args.json_events
         self.just_print_progress = args.just_print_progress
         self.download_only = args.download_only
         self.buffered = not args.just_print_progress and not args.no_progress
-        self.buffer = ""
+        self.buffer: list[str] = []
         self.cleanup = not args.no_cleanup
         self.ret_code = EXIT.OK
         self.log = log
         self.dom0 = dom0
+        self.concurrency = self.max_concurrency or os.cpu_count() or 1
+        # name of updated template -> qubes waiting for it
+        self.dependants: dict[str, list[QubesVM]] = {}
+        # qubes ready to update, but not yet admitted
+        self.queue: list[QubesVM] = []
+        self.in_flight: dict[str, QubesVM] = {}
+        self.unfinished = 0
+        self.finished = threading.Condition()
+        # `_dispatch` may be called again from a callback of the qube it
+        # submits; such calls only ask the running dispatch for another round
+        self._dispatching = False
+        self._dispatch_requested = False
+        # free Xen memory is mostly given out to running qubes by qmemman,
+        # so by default only the back-off after a failed start is used
+        self.memory_admission = args.memory_admission
+        self.memory_aware = True
+        # all stages of one invocation are recorded as a single run
+        timing_store = context.timing_store if context is not None else None
+        self.timing_store = timing_store or TimingStore(log)
+        # expected duration of the qube update and the qubes waiting for it
+        self.priorities: dict[str, float] = {}
+        self.submitted_at: dict[str, float] = {}
+        self.prestart = args.prestart
+        self.prestart_memory = args.prestart_memory
+        # queued qubes started in advance: name -> (qube, start)
+        self.warming: dict[
+            str, tuple[QubesVM, concurrent.futures.Future[bool]]
+        ] = {}
+        self.warm_timings: dict[str, dict[str, float]] = {}
+        self.warm_executor: Optional[concurrent.futures.ThreadPoolExecutor] = (
+            None
+        )
+        self.progress_bar: Optional["MultipleUpdateMultipleProgressBar"] = None
+        self.agent_args: Optional[argparse.Namespace] = None
+        self.show_progress = False
 
     def run(self, agent_args: argparse.Namespace) -> tuple[int, dict]:
         """
-        Run simultaneously `update_qube` for all qubes as separate processes.
+        Run simultaneously `update_qube` for all qubes.
+
+        Depending on the engine, qubes are handled by worker threads driven
+        by a single event loop or by separate processes.
         """
         self.log.info("Update Manager: New batch of qubes to update")
         if not self.qubes:
             self.log.info("Update Manager: No qubes to update, quiting.")
             return EXIT.OK, {}
 
-        show_progress = not self.quiet and not self.no_progress
-        SimpleTerminalBar.reinit_class(self.download_only)
-        progress_output = (
-            SimpleTerminalBar if self.just_print_progress else tqdm
-        )
-        progress_bar = MultipleUpdateMultipleProgressBar(
-            dummy=not show_progress,
-            output=progress_output,
-            max_concurrency=self.max_concurrency,
-            printer=self.print if self.show_output else None,
+        # machine-readable events are based on the progress reported by agents
+        show_progress = (
+            not self.quiet or self.json_events
+        ) and not self.no_progress
+        progress_bar = (
+            self.context
+            or MultipleUpdateMultipleProgressBar.from_args(
+                self.args, len(self.qubes)
+            )
         )
+        progress_bar.start()
+        progress_bar.print = self.print if self.show_output else None
+        self.progress_bar = progress_bar
+        self.agent_args = agent_args
+        self.show_progress = show_progress
 
+        names = {qube.name for qube in self.qubes}
+        bars = set()
         for qube in self.qubes:
             disp_name = (
                 agent_args.display_name
@@ -100,35 +183,50 @@ class UpdateManager:
                 else qube.name
             )
             progress_bar.add_bar(disp_name)
-            progress_bar.pool.apply_async(
-                update_qube,
-                (
-                    qube,
-                    agent_args,
-                    show_progress,
-                    progress_bar.status_notifier,
-                    progress_bar.termination,
-                    self.dom0,
-                ),
-                callback=self.collect_result,
-                error_callback=print,
-            )
-            if qube.klass == "AdminVM" and show_progress:
+            bars.add(disp_name)
+            if (
+                qube.klass == "AdminVM"
+                and disp_name in progress_bar.progress_bars
+            ):
                 # progress of AdminVM is continuation of different process,
                 # so we want to skip 0 value at beginning
-                progress_bar.progress_bars[qube.name].reset()
+                progress_bar.progress_bars[disp_name].reset()
 
-        progress_bar.pool.close()
+            template = self._updated_template(qube, names)
+            if template is None:
+                self.queue.append(qube)
+            else:
+                self.log.debug(
+                    "Update Manager: %s waits for %s", qube.name, template
+                )
+                self.dependants.setdefault(template, []).append(qube)
+        self.unfinished = len(self.qubes)
+        self._prioritize()
+
+        self._dispatch()
+
+        progress_bar.eta = self.eta
         progress_bar.feeding()
-        progress_bar.pool.join()
-        progress_bar.close()
+        with self.finished:
+            self.finished.wait_for(lambda: not self.unfinished)
+        progress_bar.print = None
+        progress_bar.eta = None
+        self._cool_down()
+        self.timing_store.save()
         self.log.info("Update Manager: Finished, collecting success info")
 
         # inform caller about requested cancel, even if all requested targets were updated
         if progress_bar.termination.value:
             self.ret_code = EXIT.SIGINT
-
-        stats = list(progress_bar.statuses.values())
+        if self.context is None:
+            progress_bar.close()
+
+        statuses = {
+            name: stat
+            for name, stat in progress_bar.statuses.items()
+            if name in bars
+        }
+        stats = list(statuses.values())
         if FinalStatus.CANCELLED in stats:
             self.ret_code = max(self.ret_code, EXIT.SIGINT)
         if FinalStatus.ERROR in stats:
@@ -138,15 +236,385 @@ class UpdateManager:
             self.ret_code = max(self.ret_code, EXIT.ERR_QREXEX)
 
         if self.buffer:
-            print(self.buffer)
+            print("".join(self.buffer))
+
+        return self.ret_code, statuses
+
+    @staticmethod
+    def _updated_template(qube: QubesVM, names: set[str]) -> Optional[str]:
+        """
+        Return the name of the closest ancestor of the qube which is
+        updated in the same batch.
+        """
+        try:
+            template = getattr(qube, "template", None)
+            while template is not None:
+                if template.name in names:
+                    return template.name
+                template = getattr(template, "template", None)
+        except qubesadmin.exc.QubesDaemonAccessError:
+            pass
+        return None
+
+    def _estimate(self, qube_name: str) -> float:
+        """
+        Expected duration of the qube update in seconds.
+
+        Qubes never updated before are expected to take an average time.
+        """
+        estimates = self.timing_store.estimates()
+        if qube_name in estimates:
+            return estimates[qube_name]
+        if estimates:
+            return sum(estimates.values()) / len(estimates)
+        return 0.0
+
+    def _priority(self, qube: QubesVM) -> float:
+        if qube.name not in self.priorities:
+            self.priorities[qube.name] = self._estimate(qube.name) + max(
+                (
+                    self._priority(dependant)
+                    for dependant in self.dependants.get(qube.name, [])
+                ),
+                default=0.0,
+            )
+        return self.priorities[qube.name]
+
+    def _prioritize(self) -> None:
+        """
+        Order queue to start the longest jobs first.
+        """
+        self.queue.sort(key=self._priority, reverse=True)
+        eta = self.eta()
+        if eta is not None:
+            self.log.info("Update Manager: Expected duration: %ds", eta)
 
-        return self.ret_code, progress_bar.statuses
+    def eta(self) -> Optional[float]:
+        """
+        Estimate time (in seconds) needed to finish updating all qubes.
+        """
+        if not self.timing_store.estimates():
+            return None
+        now = time.monotonic()
+        with self.finished:
+            work = 0.0
+            longest = 0.0
+            for name in self.in_flight:
+                elapsed = now - self.submitted_at.get(name, now)
+                left = max(self._estimate(name) - elapsed, 0.0)
+                work += left
+                longest = max(
+                    longest,
+                    left
+                    + max(
+                        (
+                            self._priority(dependant)
+                            for dependant in self.dependants.get(name, [])
+                        ),
+                        default=0.0,
+                    ),
+                )
+            for qube in self.queue:
+                work += self._estimate(qube.name)
+                longest = max(longest, self._priority(qube))
+            for waiting in self.dependants.values():
+                work += sum(self._estimate(qube.name) for qube in waiting)
+        return max(work / self.concurrency, longest)
+
+    def _dispatch(self) -> None:
+        """
+        Submit queued qubes as long as concurrency and memory allow.
 
-    def collect_result(self, result_tuple: Tuple[str, ProcessResult]) -> None:
+        Non-reentrant: a nested call only requests another admission round
+        from the dispatch which is already running.
+        """
+        with self.finished:
+            self._dispatch_requested = True
+            if self._dispatching:
+                return
+            self._dispatching = True
+        try:
+            while True:
+                with self.finished:
+                    if not self._dispatch_requested:
+                        self._dispatching = False
+                        return
+                    self._dispatch_requested = False
+                    to_check = self._memory_to_check()
+                # qubesd and `xl info` are not queried with the lock held
+                memory = self._measure_memory(*to_check) if to_check else None
+                with self.finished:
+                    to_submit = self._admit(memory)
+                for qube, prestarted in to_submit:
+                    self._submit(qube, prestarted)
+                self._prestart()
+        except BaseException:
+            with self.finished:
+                self._dispatching = False
+            raise
+
+    def _memory_to_check(
+        self,
+    ) -> Optional[tuple[list[QubesVM], list[QubesVM]]]:
+        """
+        Return qubes which hold memory reserved for them and queued qubes
+        which may be admitted next, if admission depends on free memory.
+
+        Must be called with `self.finished` held.
+        """
+        if not self.memory_admission or not self.memory_aware:
+            return None
+        slots = self.concurrency - len(self.in_flight)
+        # at least one qube is always admitted to make progress
+        if slots <= 0 or len(self.queue) <= (0 if self.in_flight else 1):
+            return None
+        reserved = [
+            *self.in_flight.values(),
+            *(qube for qube, _start in self.warming.values()),
+        ]
+        queued = [
+            qube for qube in self.queue[:slots] if qube.name not in self.warming
+        ]
+        return reserved, queued
+
+    def _measure_memory(
+        self, reserved: list[QubesVM], queued: list[QubesVM]
+    ) -> Optional[tuple[int, dict[str, int]]]:
+        """
+        Return free memory and memory required by each of the queued qubes.
+        """
+        free_memory = self._free_memory(reserved)
+        if free_memory is None:
+            return None
+        required = {qube.name: self._required_memory(qube) for qube in queued}
+        return free_memory, required
+
+    def _admit(
+        self, memory: Optional[tuple[int, dict[str, int]]]
+    ) -> list[tuple[QubesVM, bool]]:
+        """
+        Move qubes from the queue to in-flight as long as concurrency and
+        memory measured by `_measure_memory` allow.
+
+        Must be called with `self.finished` held.
+        """
+        to_submit = []
+        free_memory, required = memory if memory else (None, {})
+        while self.queue and len(self.in_flight) < self.concurrency:
+            qube = self.queue[0]
+            prestarted = False
+            if qube.name in self.warming:
+                _qube, start = self.warming[qube.name]
+                if not start.done():
+                    # it will be admitted as soon as it is started
+                    break
+                del self.warming[qube.name]
+                prestarted = start.result()
+            elif free_memory is not None:
+                if qube.name not in required:
+                    # the queue has changed since the memory was measured
+                    self._dispatch_requested = True
+                    break
+                if self.in_flight and free_memory < required[qube.name]:
+                    self.log.debug(
+                        "Update Manager: %s waits for free memory",
+                        qube.name,
+                    )
+                    break
+                free_memory -= required[qube.name]
+            self.queue.pop(0)
+            self.in_flight[qube.name] = qube
+            self.submitted_at[qube.name] = time.monotonic()
+            to_submit.append((qube, prestarted))
+        return to_submit
+
+    def _prestart(self) -> None:
+        """
+        Start next queued qubes in advance, within the memory budget.
+
+        Free Xen memory is not a useful measure here, since qmemman gives it
+        out to running qubes. Only --prestart-memory limits the memory of
+        these qubes, and a start refused for lack of memory stops starting
+        qubes in advance.
+
+        Must be called without `self.finished` held.
+        """
+        assert self.progress_bar is not None
+        if not self.prestart or self.progress_bar.termination.value:
+            return
+        with self.finished:
+            candidates = [
+                qube
+                for qube in self.queue[: self.prestart]
+                if qube.name not in self.warming
+            ]
+            warming = [qube for qube, _start in self.warming.values()]
+        if not candidates:
+            return
+
+        # qubesd is not queried with the lock held
+        budget = self.prestart_memory
+        if budget is not None:
+            budget -= sum(self._memory(qube) for qube in warming)
+        to_start = []
+        for qube in candidates:
+            if qube.is_running():
+                continue
+            if budget is not None:
+                memory = self._memory(qube)
+                if budget < memory:
+                    break
+                budget -= memory
+            to_start.append(qube)
+
+        with self.finished:
+            for qube in to_start:
+                if qube.name in self.warming or qube not in self.queue:
+                    # already admitted
+                    continue
+                if self.warm_executor is None:
+                    self.warm_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.prestart,
+                        thread_name_prefix="vm-prestart",
+                    )
+                self.log.debug("Update Manager: Start %s in advance", qube.name)
+                start = self.warm_executor.submit(self._warm_up, qube)
+                self.warming[qube.name] = (qube, start)
+                start.add_done_callback(lambda _: self._dispatch())
+
+    def _warm_up(self, qube: QubesVM) -> bool:
+        """
+        Start the qube, return True on success.
+        """
+        timings: dict[str, float] = {}
+        assert self.progress_bar is not None
+        tracer = Tracer(
+            enabled=self.progress_bar.tracer.enabled,
+            process=qube.name,
+            thread="dom0",
+        )
+        try:
+            with timed(timings, "start", tracer):
+                qube.start()
+        except qubesadmin.exc.QubesMemoryError as err:
+            with self.finished:
+                self.prestart = 0
+            self.log.warning(
+                "Update Manager: Cannot start %s in advance: %s, "
+                "no more qubes will be started in advance",
+                qube.name,
+                str(err),
+            )
+            return False
+        except qubesadmin.exc.QubesException as err:
+            # the qube will be started in a usual way
+            self.log.debug(
+                "Update Manager: Cannot start %s in advance: %s",
+                qube.name,
+                str(err),
+            )
+            return False
+        self.warm_timings[qube.name] = timings
+        self.progress_bar.tracer.extend(tracer.spans)
+        return True
+
+    def _cool_down(self) -> None:
+        """
+        Shut down qubes started in advance, which have not been updated.
+        """
+        with self.finished:
+            warming = list(self.warming.values())
+            self.warming.clear()
+        for qube, start in warming:
+            try:
+                if start.result():
+                    self.log.info("Update Manager: Shutdown %s", qube.name)
+                    qube.shutdown()
+            except qubesadmin.exc.QubesException as err:
+                self.log.error(
+                    "Update Manager: Cannot shutdown %s: %s",
+                    qube.name,
+                    str(err),
+                )
+        if self.warm_executor is not None:
+            self.warm_executor.shutdown()
+            self.warm_executor = None
+
+    def _free_memory(self, reserved: list[QubesVM]) -> Optional[int]:
+        """
+        Return free memory (MiB) reduced by the memory reserved for admitted
+        or prestarted qubes which are not started yet.
+        """
+        free = get_free_memory()
+        if free is None:
+            self.log.info(
+                "Update Manager: Cannot get free memory, "
+                "memory-aware admission disabled."
+            )
+            self.memory_aware = False
+            return None
+        for qube in reserved:
+            if not qube.is_running():
+                free -= self._required_memory(qube)
+        return free
+
+    def _required_memory(self, qube: QubesVM) -> int:
+        if qube.is_running():
+            return 0
+        return self._memory(qube) + self.MEMORY_MARGIN
+
+    @staticmethod
+    def _memory(qube: QubesVM) -> int:
+        try:
+            return int(getattr(qube, "memory", 0) or 0)
+        except (qubesadmin.exc.QubesException, ValueError, TypeError):
+            return 0
+
+    def _submit(self, qube: QubesVM, prestarted: bool = False) -> None:
+        assert self.progress_bar is not None
+        self.progress_bar.pool.apply_async(
+            update_qube,
+            (
+                qube,
+                self.qube_args.get(qube.name, self.agent_args),
+                self.show_progress,
+                self.progress_bar.status_notifier,
+                self.progress_bar.termination,
+                self.dom0,
+                prestarted,
+            ),
+            callback=self.collect_result,
+            error_callback=functools.partial(self.collect_error, qube),
+        )
+
+    def _finish(self, qube_name: str) -> None:
+        """
+        Mark the qube as finished and start qubes waiting for it.
+        """
+        with self.finished:
+            self.in_flight.pop(qube_name, None)
+            self.queue.extend(self.dependants.pop(qube_name, []))
+            self.queue.sort(key=self._priority, reverse=True)
+            self.unfinished -= 1
+            self.finished.notify_all()
+        self._dispatch()
+
+    def collect_result(
+        self,
+        result_tuple: Tuple[str, ProcessResult, dict[str, float], list[dict]],
+    ) -> None:
         """
         Callback method to process `update_qube` output.
         """
-        qube_name, result = result_tuple
+        qube_name, result, timings, spans = result_tuple
+        timings = {**self.warm_timings.pop(qube_name, {}), **timings}
+        self.timing_store.record(qube_name, timings)
+        assert self.progress_bar is not None
+        self.progress_bar.tracer.extend(spans)
+        if self.progress_bar.events is not None:
+            self.progress_bar.events.emit(
+                "timings", qube=qube_name, phases=timings
+            )
 
         vm_code = result.code
         if result.code not in EXIT.VM_HANDLED:
@@ -164,9 +632,47 @@ class UpdateManager:
         elif not self.quiet and self.no_progress:
             self.print(result.out)
 
+        self._finish(qube_name)
+
+    def collect_error(self, qube: QubesVM, exc: BaseException) -> None:
+        """
+        Callback method to process unexpected `update_qube` failure.
+        """
+        if isinstance(exc, NotEnoughMemoryError):
+            with self.finished:
+                self.in_flight.pop(qube.name, None)
+                retry = bool(self.in_flight)
+                if retry:
+                    # back off: wait for currently updated qubes
+                    self.concurrency = max(1, len(self.in_flight))
+                    self.queue.insert(0, qube)
+            if retry:
+                self.log.warning(
+                    "Update Manager: %s, concurrency lowered to %d",
+                    str(exc),
+                    self.concurrency,
+                )
+                self._dispatch()
+                return
+            assert self.progress_bar is not None
+            assert self.agent_args is not None
+            status_notifier = self.progress_bar.status_notifier
+            if self.agent_args.display_name is not None:
+                status_notifier = StatusNotifierWrapper(
+                    status_notifier, self.agent_args.display_name
+                )
+            status_notifier.put(StatusInfo.done(qube, FinalStatus.ERROR))
+        elif self.progress_bar and self.progress_bar.events is not None:
+            self.progress_bar.events.line(str(exc))
+        else:
+            print(exc)
+        self.log.error("Update Manager: %s failed: %s", qube.name, str(exc))
+        self.ret_code = max(self.ret_code, EXIT.ERR_VM_UNHANDLED)
+        self._finish(qube.name)
+
     def print(self, *args: Any) -> None:
         if self.buffered:
-            self.buffer += " ".join(map(str, args)) + "\n"
+            self.buffer.append(" ".join(map(str, args)) + "\n")
         else:
             print(*args, file=sys.stdout, flush=True)
 
@@ -174,14 +680,78 @@ class UpdateManager:
 class TerminalMultiBar:
     """
     Handles multiple progress bars in terminal.
+
+    Changes of bars are coalesced and printed at most `FPS` times
+    per second, only bars which output changed are printed again.
+    Final statuses are printed immediately.
+    In the summary mode all bars are shown as a single line with active
+    qubes and counts of finished ones.
     """
 
-    def __init__(self) -> None:
+    FPS = 10
+
+    def __init__(self, summary: bool = False) -> None:
         self.progresses: list[SimpleTerminalBar] = []
+        self.summary = summary
+        self.summary_bar: Optional[tqdm] = None
+        # positions of bars changed since the last print
+        self.dirty: dict[int, None] = {}
+        self.printed: dict[int, str] = {}
+        self.printed_at = 0.0
+
+    def changed(self, bar: "SimpleTerminalBar", force: bool = False) -> None:
+        """
+        Schedule printing of the bar.
+        """
+        self.dirty[bar.position] = None
+        if force or time.monotonic() - self.printed_at >= 1 / self.FPS:
+            self.print()
+
+    def flush(self) -> None:
+        """
+        Print changes held back by the rate limit.
+        """
+        if self.dirty:
+            self.print()
 
     def print(self) -> None:
+        """
+        Print all pending changes.
+        """
+        self.printed_at = time.monotonic()
+        dirty, self.dirty = self.dirty, {}
+        if self.summary:
+            if dirty:
+                if self.summary_bar is None:
+                    self.summary_bar = tqdm(
+                        total=0, position=1, bar_format="{desc}"
+                    )
+                self.summary_bar.set_description_str(self._summarize())
+            return
+        for position in dirty:
+            line = str(self.progresses[position])
+            if not line or self.printed.get(position) == line:
+                continue
+            self.printed[position] = line
+            print(line, file=sys.stderr, flush=True)
+
+    def _summarize(self) -> str:
+        counts: dict[str, int] = {}
+        active = []
         for progress in self.progresses:
-            print(progress, file=sys.stderr, flush=True)
+            if progress.status == Status.UPDATING.value:
+                active.append(f"{progress.name} {progress.progress or 0:.0f}%")
+            else:
+                counts[progress.status] = counts.get(progress.status, 0) + 1
+        summary = ", ".join(
+            f"{status}: {count}" for status, count in sorted(counts.items())
+        )
+        return f"[{summary}] updating: {', '.join(active)}"
+
+    def close(self) -> None:
+        self.print()
+        if self.summary_bar is not None:
+            self.summary_bar.close()
 
 
 class SimpleTerminalBar:
@@ -189,8 +759,14 @@ class SimpleTerminalBar:
     Simple progress bar for terminal output. Could be used by TerminalMultiBar.
     """
 
-    PARENT_MULTI_BAR = None
+    PARENT_MULTI_BAR: Optional[TerminalMultiBar] = None
     DOWNLOAD_ONLY = False
+    FINAL_STATUSES = (
+        FinalStatus.SUCCESS.value,
+        FinalStatus.ERROR.value,
+        FinalStatus.CANCELLED.value,
+        FinalStatus.NO_UPDATES.value,
+    )
 
     def __init__(
         self, total: int | float, position: int, desc: Optional[str]
@@ -198,20 +774,26 @@ class SimpleTerminalBar:
         assert SimpleTerminalBar.PARENT_MULTI_BAR is not None
         assert position == len(SimpleTerminalBar.PARENT_MULTI_BAR.progresses)
         SimpleTerminalBar.PARENT_MULTI_BAR.progresses.append(self)
-        self.desc: str = desc
+        self.position = position
+        self.name = ""
+        self.status = ""
+        self._parse(desc)
         self.progress: float | None = 0.0
         self.total: int | float = total
 
+    def _parse(self, desc: Optional[str]) -> None:
+        assert desc is not None
+        self.name, status = desc.split(" ", 1)
+        self.status = status[1:-1]  # remove brackets
+
+    @property
+    def desc(self) -> str:
+        return f"{self.name} ({self.status})"
+
     def __str__(self) -> str:
         info = None
-        name, status = self.desc.split(" ", 1)
-        status = status[1:-1]  # remove brackets
-        if status in (
-            FinalStatus.SUCCESS.value,
-            FinalStatus.ERROR.value,
-            FinalStatus.CANCELLED.value,
-            FinalStatus.NO_UPDATES.value,
-        ):
+        status = self.status
+        if status in SimpleTerminalBar.FINAL_STATUSES:
             if SimpleTerminalBar.DOWNLOAD_ONLY:
                 return ""
             info = status.replace(" ", "_")
@@ -220,42 +802,113 @@ class SimpleTerminalBar:
             if self.progress is None:
                 return ""
             info = str(self.progress)
-        return f"{name} {status} {info}"
+        return f"{self.name} {status} {info}"
 
     def reset(self, total: int | float | None = None) -> None:
         if total is not None:
             self.total = total
         self.progress = None
         assert SimpleTerminalBar.PARENT_MULTI_BAR is not None
-        SimpleTerminalBar.PARENT_MULTI_BAR.print()
+        SimpleTerminalBar.PARENT_MULTI_BAR.changed(self)
 
     def update(self, progress: float) -> None:
         if self.progress is None:
             self.progress = 0.0
         self.progress += progress
         assert SimpleTerminalBar.PARENT_MULTI_BAR is not None
-        SimpleTerminalBar.PARENT_MULTI_BAR.print()
+        SimpleTerminalBar.PARENT_MULTI_BAR.changed(self)
 
     def set_description(self, desc: str) -> None:
-        self.desc = desc
+        self._parse(desc)
         assert SimpleTerminalBar.PARENT_MULTI_BAR is not None
-        SimpleTerminalBar.PARENT_MULTI_BAR.print()
+        SimpleTerminalBar.PARENT_MULTI_BAR.changed(
+            self, force=self.status in SimpleTerminalBar.FINAL_STATUSES
+        )
 
     def close(self) -> None:
         """Implementation of tqdm API"""
 
     @staticmethod
-    def reinit_class(download_only: bool = False) -> None:
-        SimpleTerminalBar.PARENT_MULTI_BAR = TerminalMultiBar()
+    def reinit_class(
+        download_only: bool = False, summary: bool = False
+    ) -> None:
+        SimpleTerminalBar.PARENT_MULTI_BAR = TerminalMultiBar(summary)
         SimpleTerminalBar.DOWNLOAD_ONLY = download_only
 
 
+class JsonEvents:
+    """
+    Newline-delimited JSON records describing the update.
+
+    Each record has `event` and `time` keys:
+    `pending`, `updating` (with `progress`) and `done` (with `status`)
+    for transitions of qubes, `line` (with `stream` and `message`)
+    for output of qubes, `timings` (with `phases`) for durations
+    of update phases and `exit` with exit codes of the whole run.
+    Records are written in batches.
+    """
+
+    # maximal delay (in seconds) and size of a batch
+    FLUSH_INTERVAL = 0.2
+    BATCH_SIZE = 256
+
+    def __init__(self, stream: Optional[IO[str]] = None) -> None:
+        self.stream = stream or sys.stdout
+        self.buffer: list[str] = []
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def emit(self, event: str, **fields: Any) -> None:
+        record = {"event": event, "time": round(time.time(), 3), **fields}
+        with self.lock:
+            self.buffer.append(json.dumps(record))
+            if (
+                len(self.buffer) < self.BATCH_SIZE
+                and time.monotonic() - self.flushed_at < self.FLUSH_INTERVAL
+            ):
+                return
+        self.flush()
+
+    def status(self, feed: StatusInfo) -> None:
+        if feed.status == Status.DONE:
+            assert isinstance(feed.info, FinalStatus)
+            self.emit("done", qube=feed.qname, status=feed.info.value)
+        elif feed.status == Status.UPDATING:
+            self.emit("updating", qube=feed.qname, progress=feed.info)
+        else:
+            self.emit(feed.status.value, qube=feed.qname)
+
+    def line(self, feed: Any) -> None:
+        if isinstance(feed, FormatedLine):
+            self.emit(
+                "line",
+                qube=feed.qname,
+                stream=feed.stream,
+                message=feed.message,
+            )
+        else:
+            self.emit("line", message=str(feed))
+
+    def flush(self) -> None:
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+            self.flushed_at = time.monotonic()
+            if buffer:
+                self.stream.write("\n".join(buffer) + "\n")
+                self.stream.flush()
+
+
 Bar = Union[SimpleTerminalBar, tqdm]
 
 
 class MultipleUpdateMultipleProgressBar:
     """
     Show update info for each qube in the terminal.
+
+    One instance is an execution context (workers, status channel, progress
+    bars, durations of updates) which could be shared by all update phases
+    of one invocation.
+    Workers are started on the first use and stopped by `close`.
     """
 
     def __init__(
@@ -264,39 +917,153 @@ class MultipleUpdateMultipleProgressBar:
         output: Callable[..., Bar],
         max_concurrency: int,
         printer: Optional[Callable],
+        engine: str = "pool",
+        summary: bool = False,
+        events: Optional["JsonEvents"] = None,
+        tracer: Optional[Tracer] = None,
+        timing_store: Optional[TimingStore] = None,
     ) -> None:
         self.dummy = dummy
+        self.summary = summary
+        self.max_concurrency = max_concurrency
+        self.engine = engine
+
+        self.manager: Any = None
+        self.termination: Any = None
+        self.status_notifier: Any = None
+        self.pool: Any = None
+        self.original_sigint_handler: Any = None
 
-        self.manager = multiprocessing.Manager()
-        self.termination = self.manager.Value("b", False)
-        self.status_notifier = self.manager.Queue()
+        self.progresses: dict[str, int | float] = {}
+        self.progress_bars: dict[str, SimpleTerminalBar | tqdm] = {}
+        self.statuses: dict[str, FinalStatus] = {}
+        # bars of the current batch without final status
+        self.pending: set[str] = set()
+        self.output_class = output
+        self.print = printer
+        # machine-readable output, see `JsonEvents`
+        self.events = events
+        # spans of update phases of all qubes, see `--trace`
+        self.tracer = tracer or Tracer(enabled=False)
+        # durations of updates of all phases, see `TimingStore`
+        self.timing_store = timing_store
+        # estimation of time left, shown above progress bars of qubes
+        self.eta: Optional[Callable[[], Optional[float]]] = None
+        self.eta_bar: Optional[tqdm] = None
+        self._eta_shown_at = 0.0
+
+    @classmethod
+    def from_args(
+        cls,
+        args: argparse.Namespace,
+        size: int = 0,
+        events: Optional["JsonEvents"] = None,
+        tracer: Optional[Tracer] = None,
+        timing_store: Optional[TimingStore] = None,
+    ) -> "MultipleUpdateMultipleProgressBar":
+        """
+        Create a context for the given `qubes-vm-update` arguments.
+
+        If `size` qubes do not fit into the terminal, the progress of all
+        of them is summarized in a single line.
+        """
+        if events is None and args.json_events:
+            events = JsonEvents()
+        show_progress = (
+            not args.quiet and not args.no_progress and not args.json_events
+        )
+        summary = (
+            show_progress
+            and not args.just_print_progress
+            and size > shutil.get_terminal_size().lines - 2
+        )
+        SimpleTerminalBar.reinit_class(args.download_only, summary)
+        return cls(
+            dummy=not show_progress,
+            output=(
+                SimpleTerminalBar
+                if args.just_print_progress or summary
+                else tqdm
+            ),
+            # downloads of the two-stage update may use more workers
+            max_concurrency=max(
+                args.max_concurrency or os.cpu_count() or 1,
+                args.download_concurrency or 0,
+            ),
+            printer=None,
+            engine=args.engine,
+            summary=summary,
+            events=events,
+            tracer=tracer,
+            timing_store=timing_store,
+        )
+
+    def __enter__(self) -> "MultipleUpdateMultipleProgressBar":
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
+
+    @property
+    def started(self) -> bool:
+        return self.pool is not None
+
+    def start(self) -> None:
+        """
+        Start workers and the status channel, do nothing if already started.
+        """
+        if self.started:
+            return
+
+        if self.engine == "pool":
+            self.manager = multiprocessing.Manager()
+            self.termination = self.manager.Value("b", False)
+            self.status_notifier = self.manager.Queue()
+        else:
+            self.termination = Flag()
+            self.status_notifier = queue.Queue()
 
         # save original signal handler for SIGINT
         self.original_sigint_handler = signal.getsignal(signal.SIGINT)
         # set SIGINT handler to ignore, it will be inherited by processes
         # in pool
         signal.signal(signal.SIGINT, signal.SIG_IGN)
-        self.pool = multiprocessing.Pool(max_concurrency)
+        if self.engine == "pool":
+            self.pool = multiprocessing.Pool(self.max_concurrency)
+        else:
+            self.pool = AsyncPool(self.max_concurrency)
         # set SIGINT handler to graceful termination
         signal.signal(signal.SIGINT, self.signal_handler_during_feeding)
 
-        self.progresses: dict[str, int | float] = {}
-        self.progress_bars: dict[str, SimpleTerminalBar | tqdm] = {}
-        self.statuses: dict[str, FinalStatus] = {}
-        self.output_class = output
-        self.print = printer
-
     def add_bar(self, qname: str) -> None:
         """
         Add progress bar for a qube given by the name.
         """
-        if self.dummy:
+        if self.dummy and self.events is None:
             return
 
+        self.pending.add(qname)
+        self.statuses.pop(qname, None)
+        if self.events is not None:
+            self.events.emit("pending", qube=qname)
+        if self.dummy:
+            return
+        if qname in self.progress_bars:
+            # the same qube in the next phase, reuse its line
+            self.progresses[qname] = 0
+            self.progress_bars[qname].reset(total=100)
+            self.progress_bars[qname].set_description(
+                f"{qname} ({Status.PENDING.value})"
+            )
+            return
+        interactive = self.output_class is tqdm or self.summary
+        if interactive and self.eta_bar is None:
+            self.eta_bar = tqdm(total=0, position=0, bar_format="{desc}")
         self.progresses[qname] = 0
         self.progress_bars[qname] = self.output_class(
             total=100,
-            position=len(self.progress_bars),
+            position=len(self.progress_bars)
+            + (self.output_class is tqdm and self.eta_bar is not None),
             desc=f"{qname} ({Status.PENDING.value})",
         )
 
@@ -304,36 +1071,75 @@ class MultipleUpdateMultipleProgressBar:
         """
         Consume info from queues and update progress bars.
 
-        The loop is terminated when status `done` for all qubes is consumed.
+        The loop is terminated when status `done` for all qubes of the current
+        batch is consumed.
         """
-        if self.dummy:
+        if self.dummy and self.events is None:
             return
 
-        left_to_finish = len(self.progresses)
-        while left_to_finish:
+        while self.pending:
             try:
-                feed: Optional[StatusInfo | str] = self.status_notifier.get(
-                    block=True
-                )
-                if feed is None:
-                    continue
-                if isinstance(feed, StatusInfo):
-                    status_name = feed.status.value
-                    if feed.status == Status.DONE:
-                        left_to_finish -= 1
-                        assert isinstance(feed.info, FinalStatus)
-                        status_name = feed.info.value
-                        self.statuses[feed.qname] = FinalStatus(status_name)
-                    self.progress_bars[feed.qname].set_description(
-                        f"{feed.qname} ({status_name})"
+                # wake up in time to show changes held back by rate limits
+                feed: Optional[StatusInfo | FormatedLine | StatusBatch] = (
+                    self.status_notifier.get(
+                        block=True, timeout=1 / TerminalMultiBar.FPS
                     )
-                    if feed.status == Status.UPDATING:
-                        assert isinstance(feed.info, float)
-                        self._update(feed.qname, feed.info)
-                elif self.print is not None:
-                    self.print(str(feed))
+                )
+                if isinstance(feed, StatusBatch):
+                    for event in feed:
+                        self._feed(event)
+                elif feed is not None:
+                    self._feed(feed)
             except queue.Empty:
-                pass
+                if self.events is not None:
+                    self.events.flush()
+                if SimpleTerminalBar.PARENT_MULTI_BAR is not None:
+                    SimpleTerminalBar.PARENT_MULTI_BAR.flush()
+            self._show_eta()
+        self._show_eta(force=True)
+        if self.events is not None:
+            self.events.flush()
+        if SimpleTerminalBar.PARENT_MULTI_BAR is not None:
+            SimpleTerminalBar.PARENT_MULTI_BAR.print()
+
+    def _feed(self, feed: StatusInfo | FormatedLine) -> None:
+        if isinstance(feed, StatusInfo):
+            if feed.qname not in self.pending:
+                # late info about qube from the previous batch
+                return
+            status_name = feed.status.value
+            if feed.status == Status.DONE:
+                self.pending.discard(feed.qname)
+                assert isinstance(feed.info, FinalStatus)
+                status_name = feed.info.value
+                self.statuses[feed.qname] = FinalStatus(status_name)
+            if self.events is not None:
+                self.events.status(feed)
+            if self.dummy:
+                return
+            self.progress_bars[feed.qname].set_description(
+                f"{feed.qname} ({status_name})"
+            )
+            if feed.status == Status.UPDATING:
+                assert isinstance(feed.info, float)
+                self._update(feed.qname, feed.info)
+        elif self.events is not None:
+            self.events.line(feed)
+        elif self.print is not None:
+            self.print(str(feed))
+
+    def _show_eta(self, force: bool = False) -> None:
+        if self.eta_bar is None or self.eta is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._eta_shown_at < 1:
+            return
+        self._eta_shown_at = now
+        eta = self.eta() if self.pending else 0.0
+        self.eta_bar.set_description_str(
+            "Estimated time left: "
+            + ("unknown" if eta is None else tqdm.format_interval(eta))
+        )
 
     def _update(self, qname: str, value: float) -> None:
         current = value
@@ -348,15 +1154,26 @@ class MultipleUpdateMultipleProgressBar:
 
     def close(self) -> None:
         """
-        This method should be called after `multiprocessing.Pool.join`
+        Wait for workers, restore SIGINT handler and close progress bars.
         """
-        signal.signal(signal.SIGINT, self.original_sigint_handler)
+        if self.events is not None:
+            self.events.flush()
+        if self.started:
+            self.pool.close()
+            self.pool.join()
+            signal.signal(signal.SIGINT, self.original_sigint_handler)
+            if self.manager is not None:
+                self.manager.shutdown()
 
         if self.dummy:
             return
 
         for pbar in self.progress_bars.values():
             pbar.close()
+        if self.eta_bar is not None:
+            self.eta_bar.close()
+        if SimpleTerminalBar.PARENT_MULTI_BAR is not None:
+            SimpleTerminalBar.PARENT_MULTI_BAR.close()
 
 
 def update_qube(
@@ -366,7 +1183,8 @@ def update_qube(
     status_notifier: Any,
     termination: Any,
     dom0: bool,
-) -> Tuple[str, ProcessResult]:
+    prestarted: bool = False,
+) -> Tuple[str, ProcessResult, dict[str, float], list[dict]]:
     """
     Create and run `UpdateAgentManager` for qube.
 
@@ -377,7 +1195,10 @@ def update_qube(
     :param termination: signal to gracefully terminate subprocess
     :param dom0: whether to use qubes-dom0-update (do download&install)
                  or just update agent to install prepared updates
-    :return:
+    :param prestarted: the qube was started in advance by the caller
+                       and should be shut down after update
+    :return: name of the qube, result, durations of update phases
+             and their spans (if `agent_args.trace`)
     """
     if agent_args.display_name is not None:
         status_notifier = StatusNotifierWrapper(
@@ -385,9 +1206,16 @@ def update_qube(
         )
 
     if termination.value:
+        if prestarted:
+            try:
+                qube.shutdown()
+            except qubesadmin.exc.QubesException:
+                pass
         status_notifier.put(StatusInfo.done(qube, FinalStatus.CANCELLED))
-        return qube.name, ProcessResult(EXIT.SIGINT, "Canceled")
+        return qube.name, ProcessResult(EXIT.SIGINT, "Canceled"), {}, []
 
+    timings: dict[str, float] = {}
+    spans: list[dict] = []
     try:
         runner = UpdateAgentManager(
             qube.app,
@@ -395,18 +1223,31 @@ def update_qube(
             agent_args=agent_args,
             show_progress=show_progress,
             dom0=dom0,
+            prestarted=prestarted,
         )
-        result = runner.run_agent(
-            agent_args=agent_args,
-            status_notifier=status_notifier,
-            termination=termination,
-        )
+        try:
+            result = runner.run_agent(
+                agent_args=agent_args,
+                status_notifier=status_notifier,
+                termination=termination,
+            )
+        finally:
+            timings = runner.timings
+            spans = runner.spans
+    except NotEnoughMemoryError:
+        # the qube is not started, the caller decides when to retry
+        raise
     except Exception as exc:  # pylint: disable=broad-except
         status_notifier.put(StatusInfo.done(qube, FinalStatus.ERROR))
-        return qube.name, ProcessResult(
-            EXIT.ERR_VM_UNHANDLED, f"ERROR (exception {str(exc)})"
+        return (
+            qube.name,
+            ProcessResult(
+                EXIT.ERR_VM_UNHANDLED, f"ERROR (exception {str(exc)})"
+            ),
+            timings,
+            spans,
         )
-    return qube.name, result
+    return qube.name, result, timings, spans
 
 
 class UpdateAgentManager:
@@ -427,10 +1268,12 @@ class UpdateAgentManager:
         agent_args: argparse.Namespace,
         show_progress: bool,
         dom0: bool,
+        prestarted: bool = False,
     ) -> None:
         self.qube = qube
         self.app = app
         self.dom0 = dom0
+        self.prestarted = prestarted
 
         (
             self.log,
@@ -446,9 +1289,27 @@ class UpdateAgentManager:
             truncate_file=False,
             qname=qube.name,
         )
+        # agent logs already have timestamp, so they are written
+        # by a separate handler without formatting
+        self.agent_log = logging.getLogger(f"{qube.name}.agent")
+        self.agent_log.propagate = False
+        self.agent_log_handler = logging.FileHandler(
+            self.log_path, encoding="utf-8"
+        )
+        self.agent_log_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.agent_log.addHandler(self.agent_log_handler)
 
         self.cleanup = not agent_args.no_cleanup
         self.show_progress = show_progress
+        # durations of update phases in seconds
+        self.timings: dict[str, float] = {}
+        self.tracer = Tracer(
+            enabled=agent_args.trace, process=qube.name, thread="dom0"
+        )
+
+    @property
+    def spans(self) -> list[dict]:
+        return self.tracer.spans
 
     def run_agent(
         self,
@@ -464,9 +1325,18 @@ class UpdateAgentManager:
             # using UpdateVM to download updates
             new_status_notifier = StatusNotifierWrapper(status_notifier, "dom0")
 
-        result = self._run_agent(agent_args, new_status_notifier, termination)
-
-        self._log_output(result, agent_args.show_output)
+        try:
+            result = self._run_agent(
+                agent_args, new_status_notifier, termination
+            )
+            self._log_output(result, agent_args.show_output)
+        finally:
+            # the same qube may be updated again by this process
+            # (e.g. in the next stage), which adds a new handler
+            self.log.removeHandler(self.log_handler)
+            self.log_handler.close()
+            self.agent_log.removeHandler(self.agent_log_handler)
+            self.agent_log_handler.close()
         return result
 
     def _run_agent(
@@ -477,8 +1347,9 @@ class UpdateAgentManager:
     ) -> ProcessResult:
         self.log.info("Running update agent for %s", self.qube.name)
         dest_dir: Optional[str] = None
-        src_dir: Optional[str] = None
+        src_arch: Optional[str] = None
         cleanup = False
+        bootstrap = False
         if self.qube.klass == "AdminVM":
             if self.dom0:
                 entrypoint_cmd = ["sudo", "qubes-dom0-update", "-y"]
@@ -493,10 +1364,26 @@ class UpdateAgentManager:
                 entrypoint = join(this_dir, UpdateAgentManager.ENTRYPOINT)
         else:
             cleanup = self.cleanup
-            dest_dir = UpdateAgentManager.WORKDIR
-            entrypoint = os.path.join(dest_dir, UpdateAgentManager.ENTRYPOINT)
             this_dir = os.path.dirname(os.path.realpath(__file__))
-            src_dir = join(this_dir, UpdateAgentManager.AGENT_RELATIVE_DIR)
+            try:
+                src_arch = bundle.build(
+                    join(this_dir, UpdateAgentManager.AGENT_RELATIVE_DIR)
+                )
+            except OSError as exc:
+                self.log.error("Cannot build agent archive: %s", str(exc))
+                status_notifier.put(
+                    StatusInfo.done(self.qube, FinalStatus.ERROR)
+                )
+                return ProcessResult(
+                    EXIT.ERR_VM, "", f"Cannot build agent archive: {exc}"
+                )
+            # the archive is named after the version of the agent,
+            # it is transferred only if the qube does not have it yet
+            dest_dir = join(
+                UpdateAgentManager.WORKDIR, os.path.basename(src_arch)
+            )
+            entrypoint = dest_dir
+            bootstrap = agent_args.bootstrap and not agent_args.download_only
 
         with QubeConnection(
             self.qube,
@@ -505,29 +1392,62 @@ class UpdateAgentManager:
             self.log,
             self.show_progress,
             status_notifier,
+            prestarted=self.prestarted,
+            tracer=self.tracer,
+            agent_log=(
+                self._write_agent_line if isinstance(entrypoint, str) else None
+            ),
         ) as qconn:
-            result = self._transfer_agent(qconn, src_dir)
+            # the connection adds durations of start, cleanup and shutdown
+            self.timings = qconn.timings
+            if bootstrap:
+                assert src_arch is not None
+                if termination.value:
+                    qconn.status = FinalStatus.CANCELLED
+                    return ProcessResult(EXIT.SIGINT, "", "Cancelled")
+                self.log.info(
+                    "Bootstrapping the agent in qube: %s", self.qube.name
+                )
+                with timed(self.timings, "update", self.tracer):
+                    result, untrusted_log, untrusted_trace = qconn.bootstrap(
+                        src_arch, agent_args
+                    )
+                if not result and qconn.status != FinalStatus.NO_UPDATES:
+                    qconn.status = FinalStatus.SUCCESS
+                self._write_agent_log(untrusted_log)
+                if self.tracer.enabled:
+                    self._load_trace(untrusted_trace)
+                return result
+
+            with timed(self.timings, "transfer", self.tracer):
+                result = self._transfer_agent(qconn, src_arch)
 
             if termination.value:
                 qconn.status = FinalStatus.CANCELLED
                 return ProcessResult(EXIT.SIGINT, "", "Cancelled")
 
-            result += self._run_entrypoint(qconn, entrypoint, agent_args)
+            with timed(self.timings, "update", self.tracer):
+                result += self._run_entrypoint(qconn, entrypoint, agent_args)
 
-            self._read_logs(qconn)
+            if not isinstance(entrypoint, str):
+                # the agent log is streamed during the update
+                with self.tracer.span("read_logs"):
+                    self._read_logs(qconn)
+            if self.tracer.enabled and isinstance(entrypoint, str):
+                self._read_trace(qconn)
 
         return result
 
     def _transfer_agent(
-        self, qconn: QubeConnection, src_dir: Optional[str]
+        self, qconn: QubeConnection, src_arch: Optional[str]
     ) -> ProcessResult:
         result = ProcessResult()
         if self.qube.klass != "AdminVM":
-            assert src_dir is not None
+            assert src_arch is not None
             self.log.info(
                 "Transferring files to destination qube: %s", self.qube.name
             )
-            result += qconn.transfer_agent(src_dir)
+            result += qconn.transfer_agent(src_arch)
             if result:
                 self.log.error("Qube communication error code: %i", result.code)
                 return result
@@ -557,13 +1477,32 @@ class UpdateAgentManager:
                 self.qube.name,
                 result_logs.code,
             )
-        # agent logs already have timestamp
-        self.log_handler.setFormatter(logging.Formatter("%(message)s"))
-        # critical -> always write agent logs
-        for log_line in result_logs.out.split("\n"):
-            if log_line:
-                self.log.critical("%s", log_line)
-        self.log_handler.setFormatter(self.log_formatter)
+        self._write_agent_log(result_logs.out)
+
+    def _write_agent_log(self, untrusted_log: str) -> None:
+        for log_line in untrusted_log.split("\n"):
+            self._write_agent_line(log_line)
+
+    def _write_agent_line(self, untrusted_line: str) -> None:
+        if untrusted_line:
+            # critical -> always write agent logs
+            self.agent_log.critical("%s", untrusted_line)
+
+    def _read_trace(self, qconn: QubeConnection) -> None:
+        result_trace = qconn.read_trace()
+        if result_trace:
+            self.log.warning(
+                "Cannot collect trace from %s, return code: %i",
+                self.qube.name,
+                result_trace.code,
+            )
+            return
+        self._load_trace(result_trace.out)
+
+    def _load_trace(self, untrusted_trace: str) -> None:
+        agent = Tracer(process=self.qube.name, thread="agent")
+        agent.load_untrusted(untrusted_trace)
+        self.tracer.extend(agent.spans)
 
     def _log_output(self, result: ProcessResult, show_output: bool) -> None:
         output = result.out.split("\n") + result.err.split("\n")
@@ -587,7 +1526,9 @@ class StatusNotifierWrapper:
         self.status_notifier = status_notifier
         self.qube_name = qube_name
 
-    def put(self, message: StatusInfo | FormatedLine) -> None:
-        if isinstance(message, (StatusInfo, FormatedLine)):
-            message.qname = self.qube_name
+    def put(self, message: StatusInfo | FormatedLine | StatusBatch) -> None:
+        events = message if isinstance(message, StatusBatch) else [message]
+        for event in events:
+            if isinstance(event, (StatusInfo, FormatedLine)):
+                event.qname = self.qube_name
         self.status_notifier.put(message)
@@ -19,11 +19,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 import asyncio
+import os
+import subprocess
 from datetime import datetime
 from logging import Logger
-from typing import Any
+from typing import Any, Optional
 
 import qubesadmin.exc
+from qubesadmin.app import QubesBase
 from qubesadmin.vm import QubesVM
 from qubesadmin.events.utils import wait_for_domain_shutdown
 from vmupdate.agent.source.common.exit_codes import EXIT
@@ -75,17 +78,24 @@ def get_boolean_feature(
     return result
 
 
-def is_stale(vm: QubesVM, expiration_period: int) -> bool:
+def is_stale(
+    vm: QubesVM,
+    expiration_period: int,
+    snapshot: Optional["QubesSnapshot"] = None,
+) -> bool:
     """Return True if VM has not been checked for updates recently."""
+    if snapshot is None:
+        snapshot = QubesSnapshot()
     today = datetime.today()
     try:
         if not (
-            "qrexec" in vm.features.keys()
-            and vm.features.get("os", "") == "Linux"
+            snapshot.has_feature(vm, "qrexec")
+            and snapshot.get_feature(vm, "os", "") == "Linux"
         ):
             return False
 
-        last_update_str = vm.features.check_with_template(
+        last_update_str = snapshot.check_with_template(
+            vm,
             "last-updates-check",
             datetime.fromtimestamp(0).strftime("%Y-%m-%d %H:%M:%S"),
         )
@@ -95,3 +105,169 @@ def is_stale(vm: QubesVM, expiration_period: int) -> bool:
     except qubesadmin.exc.QubesDaemonCommunicationError:
         pass
     return False
+
+
+class QubesSnapshot:
+    """
+    In-memory view of qube properties and features used by target selection.
+
+    The list of domains with their power state is fetched by a single
+    admin.vm.List call and all properties of a qube by a single
+    admin.vm.property.GetAll call. If qubesd does not allow the call for
+    a qube, its values are fetched separately, but at most once. The Admin
+    API has no call returning all features of a qube, so the list of feature
+    names is fetched once and only features present in the qube are fetched.
+    """
+
+    _MISSING = object()
+    # power states of admin.vm.List in which the qube is not running
+    _NOT_RUNNING = ("Halted", "NA")
+
+    def __init__(self) -> None:
+        self._domains: Optional[list[QubesVM]] = None
+        self._by_name: dict[str, QubesVM] = {}
+        self._properties: dict[tuple[str, str], Any] = {}
+        self._all_properties: set[str] = set()
+        self._running: dict[str, bool] = {}
+        self._feature_names: dict[str, Optional[set[str]]] = {}
+        self._features: dict[tuple[str, str], Any] = {}
+
+    def domains(self, app: QubesBase) -> list[QubesVM]:
+        """List all domains with a single call."""
+        if self._domains is None:
+            data = self._qubesd_call(app, "dom0", "admin.vm.List")
+            if data:
+                self._domains = []
+                for line in data.splitlines():
+                    # "<name> class=<class> state=<state>"
+                    name, _, props_str = line.partition(" ")
+                    if not name:
+                        continue
+                    props = dict(
+                        prop.partition("=")[::2] for prop in props_str.split()
+                    )
+                    self._domains.append(app.domains.get_blind(name))
+                    if "state" in props:
+                        self._running[name] = (
+                            props["state"] not in self._NOT_RUNNING
+                        )
+            else:
+                self._domains = list(app.domains)
+            self._by_name = {vm.name: vm for vm in self._domains}
+        return self._domains
+
+    @staticmethod
+    def _qubesd_call(app: QubesBase, dest: str, method: str) -> str:
+        """
+        Make a bulk call, return an empty string if it is not available.
+        """
+        try:
+            return app.qubesd_call(dest, method).decode()
+        except qubesadmin.exc.QubesException:
+            # e.g. denied by the policy, fall back to single values
+            return ""
+
+    def _fetch_properties(self, vm: QubesVM) -> None:
+        self._all_properties.add(vm.name)
+        data = self._qubesd_call(vm.app, vm.name, "admin.vm.property.GetAll")
+        for line in data.split("\n"):
+            # "<name> default=<bool> type=<type> <value>"
+            fields = line.split(" ", 3)
+            if len(fields) < 3 or not fields[2].startswith("type="):
+                continue
+            name, prop_type = fields[0], fields[2][len("type=") :]
+            value = fields[3] if len(fields) == 4 else ""
+            parsed = self._parse_property(prop_type, value)
+            if parsed is not self._MISSING:
+                self._properties[(vm.name, name)] = parsed
+
+    def _parse_property(self, prop_type: str, value: str) -> Any:
+        if prop_type == "bool":
+            return value == "True"
+        if prop_type == "int":
+            return int(value) if value else None
+        if prop_type == "vm":
+            if not value:
+                return None
+            return self._by_name.get(value, self._MISSING)
+        if prop_type == "str" and "\\" not in value:
+            # escaped values are left to qubesadmin
+            return value
+        # other types are fetched by qubesadmin on demand
+        return self._MISSING
+
+    def get_property(self, vm: QubesVM, name: str, default: Any = None) -> Any:
+        key = (vm.name, name)
+        if key not in self._properties and vm.name not in self._all_properties:
+            self._fetch_properties(vm)
+        if key not in self._properties:
+            try:
+                self._properties[key] = getattr(vm, name, default)
+            except qubesadmin.exc.QubesDaemonAccessError:
+                self._properties[key] = default
+        return self._properties[key]
+
+    def is_running(self, vm: QubesVM) -> bool:
+        if vm.name not in self._running:
+            self._running[vm.name] = vm.is_running()
+        return self._running[vm.name]
+
+    def has_feature(self, vm: QubesVM, name: str) -> bool:
+        names = self._get_feature_names(vm)
+        if names is None:
+            return (
+                self.get_feature(vm, name, self._MISSING) is not self._MISSING
+            )
+        return name in names
+
+    def get_feature(self, vm: QubesVM, name: str, default: Any = None) -> Any:
+        """Get feature, with a working default value."""
+        names = self._get_feature_names(vm)
+        if names is not None and name not in names:
+            return default
+        key = (vm.name, name)
+        if key not in self._features:
+            self._features[key] = get_feature(vm, name, self._MISSING)
+        value = self._features[key]
+        return default if value is self._MISSING else value
+
+    def check_with_template(
+        self, vm: QubesVM, name: str, default: Any = None
+    ) -> Any:
+        """Get feature from the qube or the closest of its templates."""
+        while vm is not None:
+            value = self.get_feature(vm, name, self._MISSING)
+            if value is not self._MISSING:
+                return value
+            vm = self.get_property(vm, "template", None)
+        return default
+
+    def _get_feature_names(self, vm: QubesVM) -> Optional[set[str]]:
+        if vm.name not in self._feature_names:
+            try:
+                self._feature_names[vm.name] = set(vm.features.keys())
+            except qubesadmin.exc.QubesDaemonAccessError:
+                # fall back to fetching features one by one
+                self._feature_names[vm.name] = None
+        return self._feature_names[vm.name]
+
+
+def get_free_memory() -> int | None:
+    """
+    Return free Xen memory in MiB or None if it cannot be determined.
+    """
+    command = ["xl", "info"]
+    if os.geteuid() != 0:
+        command = ["sudo", "-n", *command]
+    try:
+        output = subprocess.check_output(
+            command, stderr=subprocess.DEVNULL, timeout=30
+        )
+        for line in output.decode("ascii", errors="ignore").splitlines():
+            key, _, value = line.partition(":")
+            if key.strip() == "free_memory":
+                return int(value)
+    except Exception:  # pylint: disable=broad-except
+        # do it on the best effort basis
+        pass
+    return None
@@ -21,13 +21,18 @@ from vmupdate.utils import (
     get_feature,
     get_boolean_feature,
     is_stale,
+    QubesSnapshot,
 )
 from . import update_manager
+from .engine import ENGINES
 from .agent.source.args import AgentArgs
+from .agent.source.common.tracing import Tracer
+from .timings import TimingStore
 
 DEFAULT_UPDATE_IF_STALE = 7
 LOGPATH = "/var/log/qubes/qubes-vm-update.log"
 LOG_FORMAT = "%(asctime)s %(message)s"
+TRACEPATH = "/var/log/qubes/qubes-vm-update-trace.json"
 
 
 class ArgumentError(Exception):
@@ -54,8 +59,43 @@ def main(
         # do it on the best effort basis
         pass
 
+    events = update_manager.JsonEvents() if parsed_args.json_events else None
+    tracer = Tracer(
+        enabled=parsed_args.trace, process="qubes-vm-update", thread="main"
+    )
+    exit_codes: dict[str, int] = {}
+    with tracer.span("qubes-vm-update"):
+        ret_code = _update_all(
+            parsed_args, app, log, events, exit_codes, tracer
+        )
+    if tracer.enabled:
+        try:
+            tracer.dump(TRACEPATH)
+        except OSError as err:
+            log.warning("Cannot write trace: %s", str(err))
+    if events is not None:
+        events.emit("exit", code=ret_code, **exit_codes)
+        events.flush()
+    return ret_code
+
+
+def _update_all(
+    parsed_args: argparse.Namespace,
+    app: QubesBase,
+    log: logging.Logger,
+    events: update_manager.JsonEvents | None,
+    exit_codes: dict[str, int],
+    tracer: Tracer,
+) -> int:
+    """
+    Update selected targets and apply updates, return the exit code.
+
+    Exit codes of each step are stored in `exit_codes`,
+    spans of each step are recorded by `tracer`.
+    """
     try:
-        targets = get_targets(parsed_args, app)
+        with tracer.span("selection"):
+            targets = get_targets(parsed_args, app)
     except ArgumentError as err:
         print(str(err), file=sys.stderr)
         log.error(str(err))
@@ -81,58 +121,106 @@ def main(
         if target.klass not in ("AdminVM", "TemplateVM", "StandaloneVM")
     ]
 
-    no_updates = True
-    ret_code_admin = EXIT.OK
-    if admin:
-        message = f"The admin VM ({admin[0].name}) will be updated."
-    else:
-        message = "The admin VM will not be updated."
-    if parsed_args.dry_run:
-        print(message)
-    elif admin:
-        log.debug(message)
-        if parsed_args.just_print_progress and parsed_args.no_refresh:
-            # internal usage just for installing ready updates, use carefully
-            ret_code_admin, admin_status = run_update(
-                admin, parsed_args, log, "admin VM"
-            )
+    # one execution context (workers, status channel, progress bars,
+    # durations of updates) is shared by all update phases
+    with update_manager.MultipleUpdateMultipleProgressBar.from_args(
+        parsed_args, len(targets), events, tracer, TimingStore(log)
+    ) as context:
+        no_updates = True
+        ret_code_admin = EXIT.OK
+        if admin:
+            message = f"The admin VM ({admin[0].name}) will be updated."
         else:
-            # use qubes-dom0-update to update dom0
-            ret_code_admin, admin_status = run_update(
-                admin, parsed_args, log, "admin VM", dom0=True
+            message = "The admin VM will not be updated."
+        if parsed_args.dry_run:
+            print(message)
+        elif admin:
+            log.debug(message)
+            with tracer.span("admin"):
+                if parsed_args.just_print_progress and parsed_args.no_refresh:
+                    # internal usage just for installing ready updates, use carefully
+                    ret_code_admin, admin_status = run_update(
+                        admin, parsed_args, log, "admin VM", context=context
+                    )
+                else:
+                    # use qubes-dom0-update to update dom0
+                    ret_code_admin, admin_status = run_update(
+                        admin,
+                        parsed_args,
+                        log,
+                        "admin VM",
+                        dom0=True,
+                        context=context,
+                    )
+            no_updates = all(
+                stat == FinalStatus.NO_UPDATES for stat in admin_status.values()
             )
-        no_updates = all(
-            stat == FinalStatus.NO_UPDATES for stat in admin_status.values()
-        )
-    if ret_code_admin == EXIT.SIGINT:
-        return EXIT.SIGINT
-
-    # independent qubes first (TemplateVMs, StandaloneVMs)
-    ret_code_independent, templ_statuses = run_update(
-        independent, parsed_args, log, "templates and standalones"
-    )
-    no_updates = (
-        all(stat == FinalStatus.NO_UPDATES for stat in templ_statuses.values())
-        and no_updates
-    )
-    if ret_code_independent == EXIT.SIGINT:
-        return EXIT.SIGINT
-    # then derived qubes (AppVMs...)
-    ret_code_appvm, app_statuses = run_update(derived, parsed_args, log)
+        exit_codes["admin"] = ret_code_admin
+        if ret_code_admin == EXIT.SIGINT:
+            return EXIT.SIGINT
+
+        # independent qubes (TemplateVMs, StandaloneVMs) are updated together
+        # with derived qubes (AppVMs...), each derived qube waits only for
+        # its template
+        with tracer.span("qubes"):
+            to_update = independent
+            ret_code_download, download_statuses, qube_args = EXIT.OK, {}, {}
+            if parsed_args.download_concurrency and independent:
+                with tracer.span("download"):
+                    ret_code_download, download_statuses = run_update(
+                        independent,
+                        phase_args(parsed_args, install=False),
+                        log,
+                        "templates and standalones (download)",
+                        context=context,
+                    )
+                if ret_code_download == EXIT.SIGINT:
+                    exit_codes["qubes"] = ret_code_download
+                    return EXIT.SIGINT
+                # only qubes with downloaded updates are updated again
+                to_update = [
+                    target
+                    for target in independent
+                    if download_statuses.get(target.name) == FinalStatus.SUCCESS
+                ]
+                install_args = phase_args(parsed_args, install=True)
+                qube_args = {target.name: install_args for target in to_update}
+            ret_code_qubes, statuses = run_update(
+                to_update,
+                parsed_args,
+                log,
+                "templates and standalones",
+                derived=derived,
+                context=context,
+                qube_args=qube_args,
+            )
+            ret_code_qubes = max(ret_code_download, ret_code_qubes)
+            statuses = {**download_statuses, **statuses}
+    exit_codes["qubes"] = ret_code_qubes
+    templ_statuses = {
+        name: stat
+        for name, stat in statuses.items()
+        if name in {target.name for target in independent}
+    }
+    app_statuses = {
+        name: stat
+        for name, stat in statuses.items()
+        if name not in templ_statuses
+    }
     no_updates = (
-        all(stat == FinalStatus.NO_UPDATES for stat in app_statuses.values())
+        all(stat == FinalStatus.NO_UPDATES for stat in statuses.values())
         and no_updates
     )
-    if ret_code_appvm == EXIT.SIGINT:
+    if ret_code_qubes == EXIT.SIGINT:
         return EXIT.SIGINT
 
-    ret_code_restart = apply_updates_to_appvm(
-        parsed_args, independent, templ_statuses, app_statuses, log
-    )
+    with tracer.span("apply"):
+        ret_code_restart = apply_updates_to_appvm(
+            parsed_args, independent, templ_statuses, app_statuses, log
+        )
+    exit_codes["restart"] = ret_code_restart
 
-    ret_code = max(
-        ret_code_admin, ret_code_independent, ret_code_appvm, ret_code_restart
-    )
+    ret_code = max(ret_code_admin, ret_code_qubes, ret_code_restart)
     if ret_code == EXIT.OK and no_updates and parsed_args.signal_no_updates:
         return EXIT.OK_NO_UPDATES
     if ret_code == EXIT.OK_NO_UPDATES and not parsed_args.signal_no_updates:
@@ -159,6 +247,55 @@ def parse_args(args: list[str] | None, app: QubesBase) -> argparse.Namespace:
         "(default: number of cpus)",
         type=int,
     )
+    parser.add_argument(
+        "--engine",
+        action="store",
+        choices=ENGINES,
+        default="pool",
+        help="How qubes are updated simultaneously: by a pool of processes "
+        "(pool, default) or by worker threads driven by a single event "
+        "loop (async)",
+    )
+    parser.add_argument(
+        "--memory-admission",
+        action="store_true",
+        help="Start next qube only if there is enough free Xen memory for it, "
+        "not counting memory which qmemman could take back from running "
+        "qubes",
+    )
+    parser.add_argument(
+        "--prestart",
+        action="store",
+        help="Start up to N queued qubes in advance, while other qubes "
+        "are updated (default: %(default)d)",
+        type=int,
+        default=0,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--prestart-memory",
+        action="store",
+        help="Maximal memory (MiB) of qubes started in advance "
+        "(default: not limited, but no more qubes are started in advance "
+        "once a start fails for lack of memory)",
+        type=int,
+        metavar="MIB",
+    )
+    parser.add_argument(
+        "--download-concurrency",
+        action="store",
+        help="Update templates and standalones in two stages: first download "
+        "updates by up to N qubes at once, then install them with "
+        "--max-concurrency (default: one stage)",
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        action="store_true",
+        help="Transfer and run the agent, and collect its logs, by a single "
+        "qrexec call per qube (the agent is sent even if already present)",
+    )
     parser.add_argument(
         "--dry-run", action="store_true", help="Just print what happens."
     )
@@ -255,24 +392,58 @@ def parse_args(args: list[str] | None, app: QubesBase) -> argparse.Namespace:
         "--display-name", action="store", help=argparse.SUPPRESS
     )
 
+    parser.add_argument(
+        "--json-events",
+        action="store_true",
+        help="Print progress as newline-delimited JSON records to stdout "
+        "instead of human-readable output, implies --quiet, "
+        "cannot be used with --show-output or --dry-run",
+    )
+
     AgentArgs.add_arguments(parser)
     parsed_args = parser.parse_args(args)
 
+    if parsed_args.json_events:
+        if parsed_args.show_output:
+            parser.error("--json-events cannot be used with --show-output")
+        if parsed_args.dry_run:
+            parser.error("--json-events cannot be used with --dry-run")
+        # stdout is reserved for records
+        parsed_args.quiet = True
+
     if parsed_args.update_if_stale < 0:
         raise ArgumentError("Wrong value for --update-if-stale")
+    if parsed_args.prestart < 0:
+        raise ArgumentError("Wrong value for --prestart")
+    if (
+        parsed_args.download_concurrency is not None
+        and parsed_args.download_concurrency < 1
+    ):
+        raise ArgumentError("Wrong value for --download-concurrency")
 
     return parsed_args
 
 
 def get_targets(args: argparse.Namespace, app: QubesBase) -> Set[QubesVM]:
-    preselected_targets = preselect_targets(args, app)
-    selected_targets = select_targets(preselected_targets, args)
+    # properties and features of all qubes are fetched once for selection
+    snapshot = QubesSnapshot()
+    preselected_targets = preselect_targets(args, app, snapshot)
+    selected_targets = select_targets(preselected_targets, args, snapshot)
     return selected_targets
 
 
-def preselect_targets(args: argparse.Namespace, app: QubesBase) -> Set[QubesVM]:
+def preselect_targets(
+    args: argparse.Namespace,
+    app: QubesBase,
+    snapshot: QubesSnapshot | None = None,
+) -> Set[QubesVM]:
+    if snapshot is None:
+        snapshot = QubesSnapshot()
+    domains = snapshot.domains(app)
     targets = set()
-    updatable = {vm for vm in app.domains if getattr(vm, "updateable", False)}
+    updatable = {
+        vm for vm in domains if snapshot.get_property(vm, "updateable", False)
+    }
     default_targeting = (
         not args.templates
         and not args.standalones
@@ -284,7 +455,7 @@ def preselect_targets(args: argparse.Namespace, app: QubesBase) -> Set[QubesVM]:
         targets = {
             vm
             for vm in updatable
-            if vm.klass not in ("AppVM", "DispVM") or vm.is_running()
+            if vm.klass not in ("AppVM", "DispVM") or snapshot.is_running(vm)
         }
     else:
         # if not all updatable are included, target a specific classes
@@ -298,15 +469,15 @@ def preselect_targets(args: argparse.Namespace, app: QubesBase) -> Set[QubesVM]:
             targets.update(
                 {
                     vm
-                    for vm in app.domains
-                    if vm.klass == "AppVM" and vm.is_running()
+                    for vm in domains
+                    if vm.klass == "AppVM" and snapshot.is_running(vm)
                 }
             )
 
     # user can target non-updatable vm if she like
     if args.targets:
         names = args.targets.split(",")
-        explicit_targets = {vm for vm in app.domains if vm.name in names}
+        explicit_targets = {vm for vm in domains if vm.name in names}
         if len(names) != len(explicit_targets):
             target_names = {q.name for q in explicit_targets}
             unknowns = set(names) - target_names
@@ -326,31 +497,35 @@ def preselect_targets(args: argparse.Namespace, app: QubesBase) -> Set[QubesVM]:
         targets = {
             vm
             for vm in targets
-            if not bool(vm.features.get("skip-update", False))
+            if not bool(snapshot.get_feature(vm, "skip-update", False))
         }
 
     return targets
 
 
 def select_targets(
-    targets: Set[QubesVM], args: argparse.Namespace
+    targets: Set[QubesVM],
+    args: argparse.Namespace,
+    snapshot: QubesSnapshot | None = None,
 ) -> Set[QubesVM]:
     # try to update all preselected targets
     if args.force_update:
         return targets
 
+    if snapshot is None:
+        snapshot = QubesSnapshot()
     selected = set()
     for vm in targets:
         try:
-            to_update = vm.features.get("updates-available", False)
+            to_update = snapshot.get_feature(vm, "updates-available", False)
         except qubesadmin.exc.QubesDaemonCommunicationError:
             to_update = False
         try:
-            prohibit_start = vm.features.get("prohibit-start", False)
+            prohibit_start = snapshot.get_feature(vm, "prohibit-start", False)
         except qubesadmin.exc.QubesDaemonCommunicationError:
             prohibit_start = False
         try:
-            skip_update = vm.features.get("skip-update", False)
+            skip_update = snapshot.get_feature(vm, "skip-update", False)
         except qubesadmin.exc.QubesDaemonCommunicationError:
             skip_update = False
 
@@ -376,7 +551,9 @@ def select_targets(
                 )
             continue
 
-        if is_stale(vm, expiration_period=args.update_if_stale):
+        if is_stale(
+            vm, expiration_period=args.update_if_stale, snapshot=snapshot
+        ):
             selected.add(vm)
         else:
             if not args.quiet:
@@ -394,26 +571,42 @@ def run_update(
     log: logging.Logger,
     qube_klass: str = "qubes",
     dom0: bool = False,
+    derived: list[QubesVM] | None = None,
+    context: update_manager.MultipleUpdateMultipleProgressBar | None = None,
+    qube_args: Dict[str, argparse.Namespace] | None = None,
 ) -> Tuple[int, Dict[str, FinalStatus]]:
-    if targets:
-        message = f"Following {qube_klass} will be updated: " + ", ".join(
-            (target.name for target in targets)
-        )
-    else:
-        if qube_klass == "qubes":
-            message = ""  # no need to inform about app VMs etc.
-        else:
-            message = f"No {qube_klass} will be updated."
+    """
+    Update targets and then derived qubes.
+
+    Derived qubes are scheduled in the same batch, each of them is started
+    as soon as its template (if it is one of targets) is done.
+    If `context` is given, its workers and progress bars are reused.
+    `qube_args` replace `args` for the agent of particular qubes.
+    """
+    derived = derived or []
+    messages = [_update_message(targets, qube_klass)]
+    messages.append(_update_message(derived, "qubes"))
+    messages = [message for message in messages if message]
     if args.dry_run:
-        if message:
+        for message in messages:
             print(message)
-        return EXIT.OK, {target.name: FinalStatus.SUCCESS for target in targets}
-    log.debug(message)
+        return EXIT.OK, {
+            target.name: FinalStatus.SUCCESS for target in targets + derived
+        }
+    for message in messages:
+        log.debug(message)
 
-    if not targets:
+    if not targets and not derived:
         return EXIT.OK, {}
 
-    runner = update_manager.UpdateManager(targets, args, log=log, dom0=dom0)
+    runner = update_manager.UpdateManager(
+        targets + derived,
+        args,
+        log=log,
+        dom0=dom0,
+        context=context,
+        qube_args=qube_args,
+    )
     ret_code, statuses = runner.run(agent_args=args)
     if ret_code:
         log.error("Updating fails with code: %d", ret_code)
@@ -424,6 +617,33 @@ def run_update(
     return ret_code, statuses
 
 
+def phase_args(args: argparse.Namespace, install: bool) -> argparse.Namespace:
+    """
+    Return args of a stage of the two-stage update.
+
+    Packages are downloaded by up to `--download-concurrency` qubes at once,
+    then installed (with `--max-concurrency`) from the cache, without
+    refreshing available packages again.
+    """
+    new_args = argparse.Namespace(**vars(args))
+    if install:
+        new_args.no_refresh = True
+    else:
+        new_args.no_install = True
+        new_args.max_concurrency = args.download_concurrency
+    return new_args
+
+
+def _update_message(targets: list[QubesVM], qube_klass: str) -> str:
+    if targets:
+        return f"Following {qube_klass} will be updated: " + ", ".join(
+            (target.name for target in targets)
+        )
+    if qube_klass == "qubes":
+        return ""  # no need to inform about app VMs etc.
+    return f"No {qube_klass} will be updated."
+
+
 def apply_updates_to_appvm(
     args: argparse.Namespace,
     vm_updated: Iterable,